@@ -0,0 +1,174 @@
+import json
+import sqlite3
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from db import init_db, configure_connection, get_sync_state
+from fetch_store_emails import get_credentials, build_service
+from concurrent_fetch import ConcurrentFetcher, TokenBucket
+from label_registry import LabelRegistry
+from rules_manager import RulesManager
+from sync import iter_sync, store_sync_event, HISTORY_ID_KEY
+from process_rules import apply_rules
+from config import (
+    RULES_FILE, FETCH_BATCH_SIZE, FETCH_PROFILE, RULES_SQL_PUSHDOWN, GMAIL_QUOTA_UNITS_PER_SECOND,
+    ACCOUNT_WORKERS, ACCOUNT_CHUNK_SIZE
+)
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+class AccountConfigError(ValueError):
+    pass
+
+
+class Account:
+    __slots__ = ('name', 'token_file', 'db_file', 'rules_file')
+
+    def __init__(self, name, token_file=None, db_file=None, rules_file=RULES_FILE):
+        self.name = name
+        self.token_file = token_file or f"token_{name}.json"
+        self.db_file = db_file or f"emails_{name}.db"
+        self.rules_file = rules_file
+
+    def __repr__(self):
+        return f"Account({self.name!r})"
+
+
+def load_accounts(path):
+    # A JSON list of {"name", "token_file", "db_file", "rules_file"}; only
+    # name is required. Every account needs its own token and database.
+    with open(path, 'r') as f:
+        entries = json.load(f)
+    if not isinstance(entries, list):
+        raise AccountConfigError(f"{path} must contain a list of accounts")
+    accounts = []
+    for position, entry in enumerate(entries):
+        if not isinstance(entry, dict) or not isinstance(entry.get('name'), str) or not entry['name'].strip():
+            raise AccountConfigError(f"account {position}: missing name")
+        unknown = sorted(set(entry) - set(Account.__slots__))
+        if unknown:
+            raise AccountConfigError(f"account {entry['name']!r}: unknown keys {unknown}")
+        accounts.append(Account(**entry))
+    for key in ('name', 'token_file', 'db_file'):
+        values = [getattr(account, key) for account in accounts]
+        duplicates = sorted({value for value in values if values.count(value) > 1})
+        if duplicates:
+            raise AccountConfigError(f"Accounts must not share a {key}: {duplicates}")
+    logger.info(f"Loaded {len(accounts)} accounts from {path}.")
+    return accounts
+
+
+def authorize_accounts(accounts):
+    # Runs any browser authorization (missing or revoked tokens) one account
+    # at a time, before the pool starts
+    for account in accounts:
+        logger.info(f"Checking credentials of account {account.name}...")
+        get_credentials(account.token_file)
+
+
+class AccountContext:
+    # Everything one mailbox needs, opened on first use. Steps of one account
+    # never run concurrently, so its client and connection can move between
+    # pool threads.
+    def __init__(self, account, rate=GMAIL_QUOTA_UNITS_PER_SECOND):
+        self.account = account
+        # Gmail's quota is per user, so every account gets its own bucket
+        self.rate_limiter = TokenBucket(rate=rate)
+        self.manager = RulesManager(account.rules_file)
+        self.service = None
+        self.conn = None
+        self.registry = None
+        self.fetcher = None
+        self.stored = 0
+        self.error = None
+
+    @property
+    def name(self):
+        return self.account.name
+
+    def open(self):
+        if self.service is not None:
+            return
+        self.conn = configure_connection(sqlite3.connect(self.account.db_file, check_same_thread=False))
+        init_db(self.conn)
+        # Runs on a pool thread: a missing or revoked token fails the account
+        # rather than blocking the worker on a browser flow
+        self.service = build_service(get_credentials(self.account.token_file, interactive=False))
+        self.registry = LabelRegistry(self.service, self.conn)
+        self.fetcher = ConcurrentFetcher(lambda: self.service, workers=0, rate_limiter=self.rate_limiter)
+
+    def steps(self, batch_size=FETCH_BATCH_SIZE, chunk_size=ACCOUNT_CHUNK_SIZE, profile=FETCH_PROFILE,
+              use_sql=RULES_SQL_PUSHDOWN):
+        # One sync-and-rules cycle, yielding after every stored chunk so the
+        # scheduler can hand the thread to another account.
+        self.open()
+        yield
+        events = iter_sync(self.service, get_sync_state(self.conn, HISTORY_ID_KEY), batch_size, chunk_size,
+                           self.fetcher, profile)
+        for event in events:
+            self.stored += store_sync_event(self.conn, event)
+            yield
+        apply_rules(self.service, self.conn, use_sql=use_sql, registry=self.registry, manager=self.manager)
+
+    def summary(self):
+        return {'account': self.name, 'stored': self.stored, 'quota_units': self.rate_limiter.consumed,
+                'error': str(self.error) if self.error else None}
+
+    def close(self):
+        if self.fetcher is not None:
+            self.fetcher.close()
+        if self.conn is not None:
+            self.conn.close()
+        self.service = self.conn = self.fetcher = self.registry = None
+
+
+def _advance(steps):
+    return next(steps, _DONE)
+
+
+class MultiAccountRunner:
+    # Round-robin over accounts on one bounded thread pool: each account has
+    # at most one step in flight and goes to the back of the line after it,
+    # so a mailbox with a huge backlog only ever holds one worker.
+    def __init__(self, accounts, workers=ACCOUNT_WORKERS, context_factory=AccountContext):
+        self.workers = workers
+        self.contexts = [context_factory(account) for account in accounts]
+
+    def run_once(self):
+        ready = deque((context, context.steps()) for context in self.contexts)
+        in_flight = {}
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='account') as executor:
+            while ready or in_flight:
+                while ready and len(in_flight) < self.workers:
+                    context, steps = ready.popleft()
+                    in_flight[executor.submit(_advance, steps)] = (context, steps)
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    context, steps = in_flight.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        # One broken mailbox (revoked token, bad rules) doesn't stop the rest
+                        context.error = e
+                        logger.exception(f"Account {context.name} failed: {e}")
+                        continue
+                    if result is not _DONE:
+                        ready.append((context, steps))
+        summaries = [context.summary() for context in self.contexts]
+        for summary in summaries:
+            logger.info(f"Account {summary['account']}: stored {summary['stored']} emails, "
+                        f"used {summary['quota_units']} quota units.")
+        return summaries
+
+    def close(self):
+        for context in self.contexts:
+            context.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
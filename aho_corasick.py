@@ -0,0 +1,65 @@
+from collections import deque
+
+
+class Automaton:
+    # Aho-Corasick automaton compiled into a full transition table, so a
+    # search is one dict lookup per character of the text regardless of how
+    # many patterns were added.
+    def __init__(self):
+        self._goto = [{}]
+        self._outputs = [set()]
+        self._empty = set()
+        self._delta = None
+        self._out = None
+
+    def add(self, pattern, value):
+        if not pattern:
+            # The empty string is contained in every text
+            self._empty.add(value)
+            return
+        state = 0
+        for ch in pattern:
+            nxt = self._goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][ch] = nxt
+                self._goto.append({})
+                self._outputs.append(set())
+            state = nxt
+        self._outputs[state].add(value)
+        self._delta = None
+
+    def build(self):
+        size = len(self._goto)
+        fail = [0] * size
+        delta = [None] * size
+        out = [None] * size
+        delta[0] = dict(self._goto[0])
+        out[0] = frozenset(self._outputs[0])
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            # Transitions not in the trie fall back to those of the failure state,
+            # which BFS order guarantees is already built.
+            delta[state] = dict(delta[fail[state]])
+            delta[state].update(self._goto[state])
+            out[state] = frozenset(self._outputs[state] | out[fail[state]])
+            for ch, nxt in self._goto[state].items():
+                fail[nxt] = delta[fail[state]].get(ch, 0)
+                queue.append(nxt)
+        self._delta = delta
+        self._out = out
+        return self
+
+    def find(self, text):
+        if self._delta is None:
+            self.build()
+        delta = self._delta
+        out = self._out
+        hits = set(self._empty)
+        state = 0
+        for ch in text:
+            state = delta[state].get(ch, 0)
+            if out[state]:
+                hits |= out[state]
+        return hits
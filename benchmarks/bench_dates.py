@@ -0,0 +1,59 @@
+"""Microbenchmarks for the received-date predicates: the original
+dateutil parse + datetime.now() per check versus the precomputed epoch
+cutoff.
+
+    python benchmarks/bench_dates.py --number 200000
+"""
+import os
+import sys
+import timeit
+import argparse
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from dateutil.parser import parse
+from db import legacy_date_to_epoch_ms
+from rule_engine import compile_rule, date_cutoff_ms
+
+RECEIVED = datetime.now() - timedelta(days=12, hours=3)
+RECEIVED_STR = RECEIVED.strftime('%Y-%m-%d %H:%M:%S')
+RECEIVED_MS = int(RECEIVED.timestamp() * 1000)
+
+
+def old_check():
+    # What match_condition did for every email x date condition
+    email_date = parse(RECEIVED_STR)
+    return (datetime.now() - email_date) > timedelta(days=30)
+
+
+def strptime_check(cutoff=date_cutoff_ms('greater_than_days', 30, datetime.now())):
+    return legacy_date_to_epoch_ms(RECEIVED_STR) < cutoff
+
+
+def epoch_check(cutoff=date_cutoff_ms('greater_than_days', 30, datetime.now())):
+    return RECEIVED_MS < cutoff
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--number', type=int, default=200000)
+    args = parser.parse_args()
+
+    rule = compile_rule({"conditions": [{"field": "received", "predicate": "greater_than_days", "value": 30}]})
+    view = {"received": RECEIVED_MS}
+    cases = [
+        ("dateutil parse + now()", old_check),
+        ("strptime fast path", strptime_check),
+        ("epoch int comparison", epoch_check),
+        ("compiled condition", lambda: rule.conditions[0](view)),
+    ]
+    baseline = None
+    for name, func in cases:
+        elapsed = timeit.timeit(func, number=args.number)
+        per_call = elapsed / args.number * 1e9
+        baseline = baseline or per_call
+        print(f"{name:24} {per_call:10.0f} ns/check  {baseline / per_call:8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
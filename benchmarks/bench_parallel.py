@@ -0,0 +1,55 @@
+"""Measure how parallel rule evaluation scales with the number of worker
+processes on a synthetic backlog.
+
+    python benchmarks/bench_parallel.py --emails 200000 --rules 100
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from bench_rules import make_emails, make_rules
+from db import init_db, store_emails, connect
+from rule_engine import compile_rules
+from process_rules import find_matches
+from parallel_rules import find_matches_parallel
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--emails', type=int, default=200000)
+    parser.add_argument('--rules', type=int, default=100)
+    parser.add_argument('--chunk-size', type=int, default=5000)
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = connect(os.path.join(tmp, "bench.db"))
+        init_db(conn)
+        store_emails((dict(e, internal_date=e.pop("received")) for e in make_emails(args.emails)), conn)
+        raw_rules = make_rules(args.rules)
+        rules = compile_rules(raw_rules)
+
+        start = time.perf_counter()
+        find_matches(conn, rules)
+        baseline = time.perf_counter() - start
+        print(f"in-process   {baseline:8.2f}s  {args.emails / baseline:10,.0f} emails/s")
+
+        workers = 1
+        while workers <= args.max_workers:
+            start = time.perf_counter()
+            find_matches_parallel(conn, raw_rules, rules, workers=workers, chunk_size=args.chunk_size)
+            elapsed = time.perf_counter() - start
+            print(f"{workers:3} workers  {elapsed:8.2f}s  {args.emails / elapsed:10,.0f} emails/s  "
+                  f"speed-up {baseline / elapsed:5.2f}x")
+            workers *= 2
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""Run main.py's pipeline (full sync, rules, then an incremental sync and
+rules again) against the offline Gmail simulator and report throughput, API
+usage, per-request latency and peak memory.
+
+    python benchmarks/bench_pipeline.py --emails 100000 --latency 0.05 --workers 8
+    python benchmarks/bench_pipeline.py --emails 1000000 --min-rate 2000   # fails below 2000 emails/s
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+import resource
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from db import init_db, connect
+from gmail_simulator import SimulatedMailbox
+from concurrent_fetch import ConcurrentFetcher, TokenBucket
+from sync import sync_mailbox
+from process_rules import apply_rules
+from rules_manager import RulesManager
+
+DEFAULT_RULES = os.path.join(os.path.dirname(__file__), '..', 'rules.JSON')
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def run_pipeline(mailbox, conn, manager, workers, batch_size, profile, quota):
+    limiter = TokenBucket(rate=quota) if quota else TokenBucket(rate=1e9)
+    service = mailbox.service()
+    with ConcurrentFetcher(mailbox.service, workers=workers, rate_limiter=limiter, profile=profile) as fetcher:
+        stored = sync_mailbox(service, conn, batch_size=batch_size, fetcher=fetcher, profile=profile)
+    apply_rules(service, conn, manager=manager)
+    return stored
+
+
+def report(name, elapsed, emails, before, after):
+    calls = {method: after['calls'].get(method, 0) - before['calls'].get(method, 0) for method in after['calls']}
+    print(f"{name:12} {elapsed:8.2f}s  {emails / elapsed if elapsed else 0:10,.0f} emails/s  "
+          f"{sum(calls.values()):8,} API calls  {after['round_trips'] - before['round_trips']:7,} HTTP requests")
+    for method, count in sorted(calls.items()):
+        if count:
+            print(f"{'':14}{method:22} {count:10,}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--emails', type=int, default=10000, help="synthetic mailbox size (1k to 1M)")
+    parser.add_argument('--new', type=int, default=100, help="messages arriving before the incremental sync")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds per HTTP request")
+    parser.add_argument('--per-item-latency', type=float, default=0.0, help="extra seconds per call in a batch")
+    parser.add_argument('--quota', type=float, default=0, help="simulated quota units/s (0 = unlimited)")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of calls failing with 503")
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--batch-size', type=int, default=50)
+    parser.add_argument('--profile', choices=('metadata', 'full'), default='metadata')
+    parser.add_argument('--rules', default=DEFAULT_RULES)
+    parser.add_argument('--tracemalloc', action='store_true', help="also report peak Python heap (slower)")
+    parser.add_argument('--min-rate', type=float, default=None,
+                        help="exit with status 1 if the full sync is slower than this many emails/s")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    mailbox = SimulatedMailbox(size=args.emails, latency=args.latency, per_item_latency=args.per_item_latency,
+                               quota_per_second=args.quota or None, error_rate=args.error_rate)
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = connect(os.path.join(tmp, "bench.db"))
+        init_db(conn)
+        manager = RulesManager(args.rules)
+
+        before = mailbox.stats()
+        start = time.perf_counter()
+        stored = run_pipeline(mailbox, conn, manager, args.workers, args.batch_size, args.profile, args.quota)
+        full_elapsed = time.perf_counter() - start
+        after = mailbox.stats()
+        report("full sync", full_elapsed, stored, before, after)
+
+        mailbox.add_messages(args.new)
+        before = after
+        start = time.perf_counter()
+        stored = run_pipeline(mailbox, conn, manager, args.workers, args.batch_size, args.profile, args.quota)
+        report("incremental", time.perf_counter() - start, stored, before, mailbox.stats())
+        conn.close()
+
+    stats = mailbox.stats()
+    print(f"latency      p50 {stats['latency_p50'] * 1000:8.2f}ms  p99 {stats['latency_p99'] * 1000:8.2f}ms  "
+          f"quota errors {stats['quota_errors']:,}")
+    print(f"memory       peak RSS {peak_rss_mb():8.1f}MB", end="")
+    if args.tracemalloc:
+        print(f"  peak Python heap {tracemalloc.get_traced_memory()[1] / (1024 * 1024):8.1f}MB", end="")
+    print()
+
+    rate = args.emails / full_elapsed
+    if args.min_rate is not None and rate < args.min_rate:
+        print(f"FAIL: {rate:,.0f} emails/s is below --min-rate {args.min_rate:,.0f}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
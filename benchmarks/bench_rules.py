@@ -0,0 +1,99 @@
+"""Compare the interpreted process_rules.match_rule with the compiled rule
+engine on synthetic emails and rules.
+
+    python benchmarks/bench_rules.py --emails 100000 --rules 100
+"""
+import os
+import sys
+import time
+import random
+import argparse
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from process_rules import match_rule
+from rule_engine import compile_rules
+
+WORDS = ['offer', 'sale', 'job', 'invoice', 'meeting', 'discount', 'hiring', 'report', 'update', 'welcome',
+         'alert', 'receipt', 'newsletter', 'security', 'reminder', 'order', 'shipping', 'review']
+DOMAINS = ['linkedin.com', 'ajio.in', 'github.com', 'example.com', 'bank.com', 'shop.io', 'news.org']
+
+
+def make_emails(count, seed=0):
+    rng = random.Random(seed)
+    now = datetime.now()
+    emails = []
+    for i in range(count):
+        received = now - timedelta(days=rng.randint(0, 365), seconds=rng.randint(0, 86400))
+        emails.append({
+            "id": f"e{i}",
+            "sender": f"{rng.choice(WORDS)}@{rng.choice(DOMAINS)}",
+            "subject": ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 8))),
+            "snippet": ' '.join(rng.choice(WORDS) for _ in range(12)),
+            "labels": "INBOX,UNREAD",
+            "received": int(received.timestamp() * 1000),
+        })
+    return emails
+
+
+def make_rules(count, seed=0, date_ratio=0.1):
+    rng = random.Random(seed)
+    rules = []
+    for i in range(count):
+        if rng.random() < date_ratio:
+            conditions = [{"field": "received", "predicate": rng.choice(["less_than_days", "greater_than_days"]),
+                           "value": rng.randint(1, 365)}]
+        else:
+            conditions = [{"field": rng.choice(["from", "subject"]),
+                           "predicate": rng.choice(["contains", "contains", "does_not_contain", "equals"]),
+                           "value": rng.choice(WORDS + DOMAINS)} for _ in range(rng.randint(1, 6))]
+        rules.append({"name": f"rule{i}", "predicate": rng.choice(["all", "any"]),
+                      "conditions": conditions, "actions": {"mark_as_read": True}})
+    return rules
+
+
+def run_interpreted(emails, rules):
+    start = time.perf_counter()
+    hits = 0
+    for email in emails:
+        for rule in rules:
+            if match_rule(email, rule):
+                hits += 1
+    return time.perf_counter() - start, hits
+
+
+def run_compiled(emails, rule_set):
+    start = time.perf_counter()
+    hits = 0
+    for email in emails:
+        hits += len(rule_set.matching_rules(email))
+    return time.perf_counter() - start, hits
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--emails', type=int, default=100000)
+    parser.add_argument('--rules', type=int, default=100)
+    parser.add_argument('--date-ratio', type=float, default=0.1, help="share of rules with a date condition")
+    parser.add_argument('--skip-interpreted', action='store_true', help="only time the compiled engine")
+    args = parser.parse_args()
+
+    emails = make_emails(args.emails)
+    rules = make_rules(args.rules, date_ratio=args.date_ratio)
+    evaluations = args.emails * args.rules
+
+    start = time.perf_counter()
+    compiled = compile_rules(rules)
+    compile_time = time.perf_counter() - start
+    new_time, new_hits = run_compiled(emails, compiled)
+    print(f"compiled:    {new_time:8.2f}s  {evaluations / new_time:12,.0f} rule evals/s  "
+          f"(compile {compile_time * 1000:.1f}ms, {new_hits} hits)")
+
+    if not args.skip_interpreted:
+        old_time, old_hits = run_interpreted(emails, rules)
+        print(f"interpreted: {old_time:8.2f}s  {evaluations / old_time:12,.0f} rule evals/s  ({old_hits} hits)")
+        print(f"speed-up:    {old_time / new_time:8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""Measure how long main.py takes to get going: the import time of `main`
+(from `python -X importtime`), which heavy libraries that import pulled in,
+and the wall time of a cold process building a Gmail client from the cached
+discovery document (no network or OAuth involved).
+
+    python benchmarks/bench_startup.py --runs 10
+    python benchmarks/bench_startup.py --budget-ms 150   # fails if importing main takes longer
+"""
+import os
+import sys
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# Libraries main.py should only import once a code path needs them
+DEFERRED_MODULES = ('googleapiclient.discovery', 'google_auth_oauthlib', 'google.oauth2.credentials',
+                    'google.auth.transport.requests', 'dateutil', 'multiprocessing', 'cProfile')
+
+CHECK_DEFERRED = f"""
+import sys
+import main
+print(','.join(m for m in {DEFERRED_MODULES!r} if m in sys.modules))
+"""
+
+BUILD_CLIENT = """
+import time
+start = time.perf_counter()
+from google.oauth2.credentials import Credentials
+from fetch_store_emails import build_service
+build_service(Credentials(token='offline'))
+print(time.perf_counter() - start)
+"""
+
+
+def run_python(args, cwd):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])))
+    return subprocess.run([sys.executable] + args, cwd=cwd, env=env, capture_output=True, text=True, check=True)
+
+
+def import_times(module, cwd):
+    # {module: (self us, cumulative us)} from one cold `python -X importtime` run
+    output = run_python(['-X', 'importtime', '-c', f'import {module}'], cwd).stderr
+    times = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help="cold interpreter runs per measurement")
+    parser.add_argument('--top', type=int, default=10, help="slowest imports to list")
+    parser.add_argument('--budget-ms', type=float, default=None,
+                        help="exit with status 1 if the median import time of main exceeds this")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as cwd:
+        # The first run writes the discovery cache the timed runs read
+        run_python(['-c', BUILD_CLIENT], cwd)
+        runs = [import_times('main', cwd) for _ in range(args.runs)]
+        build_ms = statistics.median(float(run_python(['-c', BUILD_CLIENT], cwd).stdout)
+                                     for _ in range(args.runs)) * 1000
+        deferred = run_python(['-c', CHECK_DEFERRED], cwd).stdout.strip()
+    main_ms = statistics.median(times['main'][1] for times in runs) / 1000
+
+    print(f"import main      {main_ms:8.1f}ms  (median of {args.runs})")
+    print(f"build client     {build_ms:8.1f}ms  (imports and cached discovery document)")
+    print(f"eagerly imported {deferred or 'none of the deferred libraries'}")
+    print("slowest imports (cumulative):")
+    slowest = sorted(((name, times) for name, times in runs[-1].items() if name != 'main'), key=lambda item: -item[1][1])
+    for name, (self_us, cumulative_us) in slowest[:args.top]:
+        print(f"  {name:40} {cumulative_us / 1000:8.1f}ms")
+
+    if args.budget_ms is not None and main_ms > args.budget_ms:
+        print(f"FAIL: importing main took {main_ms:,.1f}ms, over the {args.budget_ms:,.1f}ms budget")
+        sys.exit(1)
+    if deferred:
+        print(f"FAIL: main imported {deferred} eagerly")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""Measure db.store_emails throughput against the original row-at-a-time
+SELECT + INSERT loop, at one or more chunk sizes (one commit per chunk).
+
+    python benchmarks/bench_store.py --emails 1000000
+    python benchmarks/bench_store.py --emails 200000 --chunk-sizes 100 500 5000
+"""
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from db import init_db, store_emails
+from config import STORE_CHUNK_SIZE
+
+
+def make_emails(count, prefix="e"):
+    for i in range(count):
+        yield {
+            "id": f"{prefix}{i}",
+            "sender": f"user{i % 997}@example.com",
+            "subject": f"Subject {i}",
+            "snippet": "Lorem ipsum dolor sit amet, consectetur adipiscing elit",
+            "labels": "INBOX,UNREAD",
+            "internal_date": 1754827200000 + i,
+        }
+
+
+def store_emails_row_by_row(email_data, conn):
+    # The storage loop as it was before the bulk upsert, adapted to the email_labels table
+    cursor = conn.cursor()
+    count = 0
+    for e in email_data:
+        cursor.execute("SELECT processed FROM emails WHERE id=?", (e['id'],))
+        if cursor.fetchone() is None:
+            cursor.execute("""
+                INSERT INTO emails (id, sender, subject, snippet, internal_date, is_read, processed)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (e['id'], e['sender'], e['subject'], e['snippet'], e['internal_date'], 0, 0))
+            for label in e['labels'].split(','):
+                cursor.execute("INSERT INTO email_labels (email_id, label) VALUES (?, ?)", (e['id'], label))
+            count += 1
+    conn.commit()
+    return count
+
+
+def timed(name, store, count):
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = sqlite3.connect(os.path.join(tmp, "bench.db"))
+        init_db(conn)
+        start = time.perf_counter()
+        stored = store(make_emails(count), conn)
+        # Second pass: every email already exists
+        store(make_emails(count), conn)
+        elapsed = time.perf_counter() - start
+        conn.close()
+    print(f"{name:12} {elapsed:8.2f}s  {2 * count / elapsed:12,.0f} rows/s  ({stored} new)")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--emails', type=int, default=1000000)
+    parser.add_argument('--chunk-sizes', type=int, nargs='+', default=[STORE_CHUNK_SIZE],
+                        help="store_emails chunk sizes to time")
+    args = parser.parse_args()
+
+    before = timed("row-by-row", store_emails_row_by_row, args.emails)
+    for chunk_size in args.chunk_sizes:
+        after = timed(f"chunks {chunk_size}", lambda emails, conn: store_emails(emails, conn, chunk_size=chunk_size),
+                      args.emails)
+        print(f"speed-up:    {before / after:8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
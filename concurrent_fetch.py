@@ -0,0 +1,163 @@
+import time
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from googleapiclient.errors import HttpError
+from fetch_store_emails import parse_message, execute_get_batch, is_retryable_error, get_message_request
+from metrics import METRICS, record_request
+from config import (
+    FETCH_WORKERS, FETCH_MAX_RETRIES, GMAIL_MAX_BATCH_SIZE,
+    GMAIL_QUOTA_UNITS_PER_SECOND, GMAIL_GET_QUOTA_COST, FETCH_PROFILE
+)
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    # Thread-safe token bucket measured in Gmail quota units. A rate-limit
+    # response halves the refill rate (at most once per cooldown window) and
+    # every successful call restores a little of it.
+    def __init__(self, rate=GMAIL_QUOTA_UNITS_PER_SECOND, capacity=None, min_rate=None,
+                 recovery=0.05, cooldown=1.0, clock=time.monotonic, sleep=time.sleep):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.min_rate = min_rate or rate / 16
+        self.recovery = recovery
+        self.cooldown = cooldown
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = self.capacity
+        # Quota units handed out so far, for per-account reporting
+        self.consumed = 0
+        self.updated = clock()
+        self.last_backoff = None
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, cost=1):
+        # A call costing more than the bucket holds (a 100-message batch is
+        # 500 units) is paid in capacity-sized slices, so it still waits for
+        # its full cost
+        while cost > 0:
+            piece = min(cost, self.capacity)
+            self._acquire(piece)
+            cost -= piece
+
+    def _acquire(self, cost):
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= cost:
+                    self.tokens -= cost
+                    self.consumed += cost
+                    return
+                # Floor the wait so float rounding can't leave a deficit too small to ever refill
+                wait = max((cost - self.tokens) / self.rate, 1e-6)
+            self.sleep(wait)
+
+    def backoff(self):
+        with self.lock:
+            now = self.clock()
+            if self.last_backoff is not None and now - self.last_backoff < self.cooldown:
+                return
+            self._refill()
+            self.last_backoff = now
+            self.rate = max(self.min_rate, self.rate / 2)
+            # Drain the bucket so every worker pauses, not just the one that was throttled
+            self.tokens = 0
+        logger.warning(f"Rate limited by Gmail, slowing down to {self.rate:.0f} quota units/s.")
+
+    def recover(self):
+        with self.lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate * self.recovery)
+
+
+class ConcurrentFetcher:
+    # workers=0 fetches on the calling thread with a single client, for
+    # callers that bring their own thread pool (see accounts.py).
+    def __init__(self, service_factory, workers=FETCH_WORKERS, rate_limiter=None, max_retries=FETCH_MAX_RETRIES,
+                 profile=FETCH_PROFILE):
+        self.service_factory = service_factory
+        self.profile = profile
+        self.workers = workers
+        self.rate_limiter = rate_limiter or TokenBucket()
+        self.max_retries = max_retries
+        self._local = threading.local()
+        self._serial_service = None
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='gmail-fetch') if workers else None
+
+    def _service(self):
+        # googleapiclient's http object is not thread-safe, so every worker
+        # thread builds and keeps its own client.
+        if self._executor is None:
+            if self._serial_service is None:
+                self._serial_service = self.service_factory()
+            return self._serial_service
+        service = getattr(self._local, 'service', None)
+        if service is None:
+            service = self._local.service = self.service_factory()
+        return service
+
+    def _fetch_once(self, service, message_ids, results):
+        if len(message_ids) > 1:
+            return execute_get_batch(service, message_ids, results, self.profile)
+        msg_id = message_ids[0]
+        try:
+            record_request('messages.get')
+            response = get_message_request(service, msg_id, self.profile).execute()
+            results[msg_id] = parse_message(response, self.profile)
+        except HttpError as e:
+            if is_retryable_error(e):
+                return [msg_id]
+            METRICS.inc('api_errors', method='messages.get')
+            logger.warning(f"Failed to fetch message {msg_id}: {e}")
+        return []
+
+    def _fetch_chunk(self, message_ids):
+        service = self._service()
+        results = {}
+        pending = message_ids
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire(GMAIL_GET_QUOTA_COST * len(pending))
+            pending = self._fetch_once(service, pending, results)
+            if not pending:
+                self.rate_limiter.recover()
+                break
+            METRICS.inc('api_retries', len(pending), method='messages.get')
+            self.rate_limiter.backoff()
+        if pending:
+            logger.error(f"Giving up on {len(pending)} messages after {self.max_retries} retries.")
+        return results
+
+    def fetch(self, message_ids, batch_size=None):
+        message_ids = list(dict.fromkeys(message_ids))
+        size = max(1, min(batch_size or 1, GMAIL_MAX_BATCH_SIZE))
+        chunks = [message_ids[start:start + size] for start in range(0, len(message_ids), size)]
+        results = {}
+        mapper = self._executor.map if self._executor is not None else map
+        with METRICS.timer('stage', stage='fetch'):
+            for chunk_results in mapper(self._fetch_chunk, chunks):
+                results.update(chunk_results)
+        return [results[msg_id] for msg_id in message_ids if msg_id in results]
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def fetch_messages_concurrent(service_factory, message_ids, workers=FETCH_WORKERS, batch_size=None, rate_limiter=None,
+                              profile=FETCH_PROFILE):
+    with ConcurrentFetcher(service_factory, workers=workers, rate_limiter=rate_limiter, profile=profile) as fetcher:
+        return fetcher.fetch(message_ids, batch_size=batch_size)
@@ -1,11 +1,93 @@
 import logging
 
 SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
+GMAIL_API_VERSION = 'v1'
 CREDENTIALS_FILE = 'credentials.json'
 TOKEN_FILE = 'token.json'
 DB_FILE = 'emails.db'
 RULES_FILE = 'rules.json'
 
+# Clients are built from this local copy of the Gmail discovery document,
+# refreshed once it is older than DISCOVERY_CACHE_MAX_AGE seconds
+DISCOVERY_CACHE_FILE = f'gmail.{GMAIL_API_VERSION}.discovery.json'
+DISCOVERY_CACHE_MAX_AGE = 7 * 24 * 3600
+
+# Gmail batch requests accept at most 100 calls, but Google recommends staying
+# at or below 50 to avoid per-user rate limiting.
+GMAIL_MAX_BATCH_SIZE = 100
+FETCH_BATCH_SIZE = 50
+FETCH_MAX_RETRIES = 3
+FETCH_RETRY_BACKOFF = 1.0
+
+# What messages.get asks for. 'metadata' only downloads the headers the
+# rules use; 'full' also downloads and stores message bodies for body rules.
+FETCH_PROFILE = 'metadata'
+
+# messages.list returns at most 500 ids per page
+LIST_PAGE_SIZE = 500
+# Emails fetched per stored (and committed) chunk while syncing. 500 take
+# ~10s to fetch at the quota below but ~30ms to store (bench_store.py), so a
+# bigger chunk barely speeds up a sync while delaying the first stored rows
+# and putting more fetched emails at risk in a crash.
+STORE_CHUNK_SIZE = 500
+
+# Concurrent fetching. Gmail allows 250 quota units per user per second;
+# messages.get costs 5 units.
+FETCH_WORKERS = 8
+GMAIL_QUOTA_UNITS_PER_SECOND = 250
+GMAIL_GET_QUOTA_COST = 5
+
+# messages.batchModify accepts up to 1000 message ids per call
+GMAIL_BATCH_MODIFY_LIMIT = 1000
+
+# Emails whose rule actions are journaled, sent and committed together
+APPLY_BATCH_SIZE = 1000
+
+# How long the label name -> id map persisted in SQLite stays valid (seconds)
+LABEL_CACHE_TTL = 3600
+
+# Evaluate rules as SQL WHERE clauses where possible
+RULES_SQL_PUSHDOWN = True
+
+# Rule evaluation across processes for large backlogs; 1 keeps it in-process.
+# With RULES_SQL_PUSHDOWN the workers evaluate the rules SQL can't express.
+RULE_WORKERS = 1
+RULE_CHUNK_SIZE = 5000
+
+# Compiled rule sets are cached by content hash. Date cutoffs are fixed at
+# compile time, so sets with date conditions are recompiled this often (seconds).
+RULES_RECOMPILE_INTERVAL = 60
+RULES_CACHE_SIZE = 8
+
+# Daemon mode (main.py --daemon): seconds between sync and rule cycles, the
+# +/- fraction of random jitter applied to each, and how many fetched chunks
+# may wait for the database writer before fetching blocks.
+DAEMON_SYNC_INTERVAL = 60
+DAEMON_RULES_INTERVAL = 300
+DAEMON_JITTER = 0.1
+DAEMON_QUEUE_SIZE = 4
+
+# Multi-account runs (main.py --accounts FILE): threads shared by every
+# account and emails per scheduling step, so a large mailbox yields to the
+# others after each chunk.
+ACCOUNT_WORKERS = 8
+ACCOUNT_CHUNK_SIZE = 500
+
+# Metrics (see metrics.py): where main.py writes them at the end of a run
+# (.json for JSON, anything else Prometheus text; None disables), an optional
+# cProfile output file, and how often (1 in N emails) rule checks are timed.
+METRICS_FILE = None
+PROFILE_FILE = None
+RULE_TIMING_SAMPLE = 100
+
+# Full-text search (search.py, main.py --search): an FTS5 index over sender,
+# subject, snippet and body kept in sync by triggers on the emails table
+# (False drops it), whether contains/does_not_contain rules on the SQL path
+# look needles up in it, and how many results a search returns by default.
+SEARCH_INDEX = True
+RULES_USE_SEARCH_INDEX = True
+SEARCH_LIMIT = 20
+
 logging.basicConfig(
     level=logging.INFO,
     format='[%(asctime)s] %(levelname)s: %(message)s',
@@ -0,0 +1,160 @@
+import queue
+import random
+import signal
+import logging
+import threading
+import time
+from db import get_sync_state
+from sync import iter_sync, store_sync_event, HISTORY_ID, HISTORY_ID_KEY
+from process_rules import apply_rules
+from label_registry import LabelRegistry
+from metrics import export
+from config import (
+    FETCH_BATCH_SIZE, STORE_CHUNK_SIZE, FETCH_PROFILE, RULES_SQL_PUSHDOWN, RULE_WORKERS,
+    DAEMON_SYNC_INTERVAL, DAEMON_RULES_INTERVAL, DAEMON_JITTER, DAEMON_QUEUE_SIZE
+)
+
+logger = logging.getLogger(__name__)
+
+# Longest the writer waits on the queue before re-checking the stop flag
+POLL_INTERVAL = 1.0
+# Queued once the fetch thread has exited
+_FETCH_DONE = object()
+
+
+def jittered(interval, jitter=DAEMON_JITTER, rng=random.random):
+    # Spreads cycles out so several daemons don't hit the API in lockstep
+    return max(0.0, interval * (1 + jitter * (2 * rng() - 1)))
+
+
+class Daemon:
+    # Keeps the Gmail clients, label cache and compiled rules alive between
+    # cycles. A fetch thread runs sync cycles and hands the fetched chunks to
+    # the calling thread through a bounded queue; the calling thread owns the
+    # SQLite connection, stores each chunk and runs the rule cycles, so
+    # processing one chunk overlaps fetching the next.
+    #
+    # `service` is used by the writer thread (rule actions) and
+    # `fetch_service` by the fetch thread; httplib2 clients can't be shared
+    # across threads.
+    def __init__(self, service, fetch_service, conn, manager=None, fetcher=None, registry=None,
+                 sync_interval=DAEMON_SYNC_INTERVAL, rules_interval=DAEMON_RULES_INTERVAL, jitter=DAEMON_JITTER,
+                 queue_size=DAEMON_QUEUE_SIZE, batch_size=FETCH_BATCH_SIZE, chunk_size=STORE_CHUNK_SIZE,
+                 profile=FETCH_PROFILE, use_sql=RULES_SQL_PUSHDOWN, workers=RULE_WORKERS,
+                 metrics_file=None, clock=time.monotonic, rng=random.random):
+        self.service = service
+        self.fetch_service = fetch_service
+        self.conn = conn
+        self.manager = manager
+        self.fetcher = fetcher
+        self.registry = registry or LabelRegistry(service, conn)
+        self.sync_interval = sync_interval
+        self.rules_interval = rules_interval
+        self.jitter = jitter
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.profile = profile
+        self.use_sql = use_sql
+        self.workers = workers
+        self.metrics_file = metrics_file
+        self.clock = clock
+        self.rng = rng
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stopping = threading.Event()
+        self.sync_cycles = 0
+        self.rule_cycles = 0
+        # Only the fetch thread reads this after start
+        self._history_id = None
+
+    def stop(self, *args):
+        # Also usable as a signal handler
+        if not self.stopping.is_set():
+            logger.info("Stopping daemon after the current step...")
+        self.stopping.set()
+
+    def install_signal_handlers(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+    def _put(self, item):
+        # Blocks while the writer is behind, giving up if the daemon stops
+        while not self.stopping.is_set():
+            try:
+                self.queue.put(item, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _sync_once(self):
+        events = iter_sync(self.fetch_service, self._history_id, self.batch_size, self.chunk_size, self.fetcher,
+                           self.profile)
+        for event in events:
+            if not self._put(event):
+                return
+            if event[0] == HISTORY_ID:
+                # The writer saves it after storing every chunk queued before it
+                self._history_id = event[1]
+
+    def _fetch_loop(self):
+        try:
+            while not self.stopping.is_set():
+                try:
+                    self._sync_once()
+                except Exception as e:
+                    # The history id only advances after a complete cycle, so
+                    # the next cycle picks up whatever this one missed.
+                    logger.exception(f"Sync cycle failed: {e}")
+                self.stopping.wait(jittered(self.sync_interval, self.jitter, self.rng))
+        finally:
+            self.queue.put(_FETCH_DONE)
+
+    def _run_rules(self):
+        try:
+            apply_rules(self.service, self.conn, use_sql=self.use_sql, registry=self.registry, workers=self.workers,
+                        manager=self.manager)
+        except Exception as e:
+            logger.exception(f"Rule cycle failed: {e}")
+        self.rule_cycles += 1
+        if self.metrics_file:
+            # Rewritten every cycle so a scraper always sees current totals
+            export(self.metrics_file)
+
+    def run(self):
+        self._history_id = get_sync_state(self.conn, HISTORY_ID_KEY)
+        fetch_thread = threading.Thread(target=self._fetch_loop, name="gmail-fetch", daemon=True)
+        fetch_thread.start()
+        logger.info(f"Daemon started: sync every ~{self.sync_interval}s, rules every ~{self.rules_interval}s.")
+
+        new_emails = 0
+        next_rules = self.clock()
+        try:
+            while True:
+                if self.clock() >= next_rules and not self.stopping.is_set():
+                    self._run_rules()
+                    next_rules = self.clock() + jittered(self.rules_interval, self.jitter, self.rng)
+                try:
+                    item = self.queue.get(timeout=max(0.0, min(POLL_INTERVAL, next_rules - self.clock())))
+                except queue.Empty:
+                    continue
+                if item is _FETCH_DONE:
+                    break
+                # Store errors are fatal: saving a later history id would skip the lost chunk
+                new_emails += store_sync_event(self.conn, item)
+                if item[0] == HISTORY_ID:
+                    self.sync_cycles += 1
+                    # New mail is processed right away instead of waiting for the next rule cycle
+                    if new_emails and not self.stopping.is_set():
+                        self._run_rules()
+                        next_rules = self.clock() + jittered(self.rules_interval, self.jitter, self.rng)
+                    new_emails = 0
+        finally:
+            self.stopping.set()
+            # Let a fetch thread blocked on the full queue see the stop flag
+            while fetch_thread.is_alive():
+                try:
+                    self.queue.get(timeout=POLL_INTERVAL)
+                except queue.Empty:
+                    pass
+            fetch_thread.join()
+        logger.info(f"Daemon stopped after {self.sync_cycles} sync cycles and {self.rule_cycles} rule cycles.")
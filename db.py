@@ -1,53 +1,426 @@
 import sqlite3
+import hashlib
 import logging
-from config import DB_FILE
+from datetime import datetime
+from itertools import islice
+from metrics import METRICS
+from config import DB_FILE, STORE_CHUNK_SIZE, SEARCH_INDEX
 
 logger = logging.getLogger(__name__)
 
-def init_db(conn=None):
-    close_conn = False
-    if conn is None:
-        conn = sqlite3.connect(DB_FILE)
-        close_conn = True
+SCHEMA_VERSION = 4
+LEGACY_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+# Columns added to emails after schema v1: v2 added body (only filled by the
+# 'full' fetch profile), v3 the version of the rule set that last evaluated a
+# row, v4 the row's content/label fingerprint and its value at that evaluation
+ADDED_COLUMNS = (('body', 'TEXT'), ('rules_version', 'TEXT'), ('fingerprint', 'TEXT'),
+                 ('evaluated_fingerprint', 'TEXT'))
+# Stay below SQLite's host-parameter limit on older builds
+MAX_SQL_PARAMS = 900
 
-    cursor = conn.cursor()
+# Full-text index over these emails columns (see search.py). The trigram
+# tokenizer matches arbitrary substrings, so it can also serve `contains`
+# rules; it can't match terms shorter than a trigram.
+SEARCH_TABLE = 'emails_fts'
+SEARCH_COLUMNS = ('sender', 'subject', 'snippet', 'body')
+SEARCH_MIN_TERM = 3
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA foreign_keys=ON",
+)
+
+def configure_connection(conn):
+    # WAL lets readers run alongside the writer; NORMAL sync is safe with WAL
+    # and avoids an fsync on every commit. In-memory databases keep their own
+    # journal mode.
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+def connect(db_file=DB_FILE):
+    return configure_connection(sqlite3.connect(db_file))
+
+def split_labels(labels):
+    if isinstance(labels, str):
+        return [label for label in labels.split(',') if label]
+    return list(labels or [])
+
+def legacy_date_to_epoch_ms(value):
+    # Schema v0 stored internal_date as a local '%Y-%m-%d %H:%M:%S' string
+    if value is None or isinstance(value, int):
+        return value
+    try:
+        parsed = datetime.strptime(value, LEGACY_DATE_FORMAT)
+    except ValueError:
+        try:
+            from dateutil.parser import parse
+            parsed = parse(value)
+        except (ValueError, OverflowError):
+            logger.warning(f"Could not convert legacy date '{value}', leaving it empty.")
+            return None
+    return int(parsed.timestamp() * 1000)
+
+def _table_columns(conn, table):
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+def _create_schema(cursor):
     cursor.execute("""
     CREATE TABLE IF NOT EXISTS emails (
         id TEXT PRIMARY KEY,
         sender TEXT,
         subject TEXT,
         snippet TEXT,
-        labels TEXT,
-        internal_date TEXT,
+        internal_date INTEGER,
+        body TEXT,
         is_read INTEGER DEFAULT 0,
-        processed INTEGER DEFAULT 0  
+        processed INTEGER DEFAULT 0,
+        rules_version TEXT,
+        fingerprint TEXT,
+        evaluated_fingerprint TEXT
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS email_labels (
+        email_id TEXT NOT NULL REFERENCES emails(id) ON DELETE CASCADE,
+        label TEXT NOT NULL,
+        PRIMARY KEY (email_id, label)
+    ) WITHOUT ROWID
+    """)
+    # Covers the apply_rules selection (and its date filters) without touching the table
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_emails_unprocessed
+    ON emails (is_read, processed, internal_date, id)
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_emails_internal_date ON emails (internal_date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_emails_sender ON emails (sender)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_email_labels_label ON email_labels (label, email_id)")
+    # Gmail actions of the batch currently being applied (see unit_of_work)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS action_journal (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        email_id TEXT NOT NULL,
+        add_ids TEXT,
+        remove_ids TEXT,
+        is_read INTEGER
     )
     """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS label_cache (
+        name_key TEXT PRIMARY KEY,
+        name TEXT,
+        label_id TEXT
+    )
+    """)
+    # Fingerprints of the rules in each rule-set version (see rules_manager)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS rule_sets (
+        version TEXT NOT NULL,
+        fingerprint TEXT NOT NULL,
+        PRIMARY KEY (version, fingerprint)
+    ) WITHOUT ROWID
+    """)
+    # Per rule (by fingerprint): the clock its date cutoffs were last evaluated at
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS rule_watermarks (
+        fingerprint TEXT PRIMARY KEY,
+        evaluated_at TEXT NOT NULL
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS sync_state (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )
+    """)
+
+def email_fingerprint(sender, subject, snippet, body, labels):
+    # Changes whenever anything a rule can test changes, except the date
+    labels = sorted(set(split_labels(labels)))
+    fields = [sender or '', subject or '', snippet or '', body or ''] + labels
+    return hashlib.sha256('\x1f'.join(fields).encode('utf-8')).hexdigest()[:16]
+
+def refresh_fingerprints(conn, email_ids=None):
+    # Recomputes the fingerprint of the given emails (None: every email that
+    # has none yet) from the stored columns and labels. Doesn't commit.
+    conn.create_function("email_fingerprint", 5, email_fingerprint, deterministic=True)
+    update = """
+        UPDATE emails SET fingerprint = email_fingerprint(sender, subject, snippet, body,
+            (SELECT group_concat(label, ',') FROM email_labels WHERE email_id = emails.id))
+        WHERE {}
+    """
+    if email_ids is None:
+        conn.execute(update.format("fingerprint IS NULL"))
+        return
+    email_ids = list(email_ids)
+    for start in range(0, len(email_ids), MAX_SQL_PARAMS):
+        chunk = email_ids[start:start + MAX_SQL_PARAMS]
+        conn.execute(update.format(f"id IN ({','.join('?' * len(chunk))})"), chunk)
+
+def search_index_supported(conn):
+    # FTS5 is optional in SQLite builds and the trigram tokenizer needs 3.34+
+    try:
+        conn.execute("CREATE VIRTUAL TABLE temp.fts_probe USING fts5(x, tokenize='trigram')")
+    except sqlite3.OperationalError:
+        return False
+    conn.execute("DROP TABLE temp.fts_probe")
+    return True
+
+def has_search_index(conn):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (SEARCH_TABLE,)).fetchone() is not None
+
+def _create_search_index(cursor):
+    # External-content table: the text lives only in emails and the triggers
+    # keep the index in step with every insert, delete and text update (label
+    # and processed-flag updates don't touch it).
+    columns = ', '.join(SEARCH_COLUMNS)
+    old_values = ', '.join(f"old.{column}" for column in SEARCH_COLUMNS)
+    new_values = ', '.join(f"new.{column}" for column in SEARCH_COLUMNS)
+    cursor.execute(f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5(
+        {columns}, content='emails', content_rowid='rowid', tokenize='trigram'
+    )
+    """)
+    cursor.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS emails_fts_insert AFTER INSERT ON emails BEGIN
+        INSERT INTO {SEARCH_TABLE} (rowid, {columns}) VALUES (new.rowid, {new_values});
+    END
+    """)
+    cursor.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS emails_fts_delete AFTER DELETE ON emails BEGIN
+        INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}, rowid, {columns}) VALUES ('delete', old.rowid, {old_values});
+    END
+    """)
+    cursor.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS emails_fts_update AFTER UPDATE OF {columns} ON emails BEGIN
+        INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}, rowid, {columns}) VALUES ('delete', old.rowid, {old_values});
+        INSERT INTO {SEARCH_TABLE} (rowid, {columns}) VALUES (new.rowid, {new_values});
+    END
+    """)
+
+def _drop_search_index(cursor):
+    for trigger in ('emails_fts_insert', 'emails_fts_delete', 'emails_fts_update'):
+        cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    cursor.execute(f"DROP TABLE IF EXISTS {SEARCH_TABLE}")
+
+def rebuild_search_index(conn):
+    # Re-indexes every row. The index is keyed by emails' implicit rowid, which
+    # VACUUM may renumber, so run this after vacuuming the database.
+    conn.execute(f"INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}) VALUES ('rebuild')")
     conn.commit()
 
+def _create_scheduler_indexes(cursor):
+    # The rule scheduler's queues: rows that changed since the rules last saw
+    # them (a partial index, so it only holds the queued rows), and
+    # rows by the rule-set version that last evaluated them. Created after
+    # ADDED_COLUMNS, since older databases lack these columns until then.
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_emails_changed
+    ON emails (id) WHERE evaluated_fingerprint IS NOT fingerprint
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_emails_rules_version ON emails (rules_version)")
+
+def _migrate_v0(conn):
+    # v0 kept labels as a comma-joined TEXT column and internal_date as a
+    # formatted string; rebuild the table with epoch milliseconds and move
+    # labels into email_labels.
+    logger.info("Migrating emails table to schema version 1...")
+    cursor = conn.cursor()
+    cursor.execute("ALTER TABLE emails RENAME TO emails_v0")
+    _create_schema(cursor)
+    conn.create_function("legacy_date_to_epoch_ms", 1, legacy_date_to_epoch_ms)
+    cursor.execute("""
+        INSERT INTO emails (id, sender, subject, snippet, internal_date, is_read, processed)
+        SELECT id, sender, subject, snippet, legacy_date_to_epoch_ms(internal_date), is_read, processed
+        FROM emails_v0
+    """)
+    cursor.executemany(
+        "INSERT OR IGNORE INTO email_labels (email_id, label) VALUES (?, ?)",
+        ((email_id, label) for email_id, labels in conn.execute("SELECT id, labels FROM emails_v0")
+         for label in split_labels(labels))
+    )
+    cursor.execute("DROP TABLE emails_v0")
+
+def init_db(conn=None, search_index=SEARCH_INDEX):
+    close_conn = False
+    if conn is None:
+        conn = sqlite3.connect(DB_FILE)
+        close_conn = True
+
+    # Connection pragmas can't be changed inside a transaction; a caller that
+    # has one open is left with the settings its connection already has
+    if not conn.in_transaction:
+        configure_connection(conn)
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    cursor = conn.cursor()
+    # A savepoint rather than BEGIN, which fails inside a transaction the
+    # caller already has open; there the changes are committed with it.
+    cursor.execute("SAVEPOINT init_db")
+    try:
+        if version < 1 and 'labels' in _table_columns(conn, 'emails'):
+            _migrate_v0(conn)
+        _create_schema(cursor)
+        columns = _table_columns(conn, 'emails')
+        for column, column_type in ADDED_COLUMNS:
+            if column not in columns:
+                cursor.execute(f"ALTER TABLE emails ADD COLUMN {column} {column_type}")
+        if version < 4:
+            # Rows the rules have already seen count as evaluated in their
+            # current state; the rest are queued like new emails
+            refresh_fingerprints(conn)
+            cursor.execute("UPDATE emails SET evaluated_fingerprint=fingerprint "
+                           "WHERE processed=1 OR rules_version IS NOT NULL")
+        _create_scheduler_indexes(cursor)
+        if search_index and not has_search_index(conn):
+            if search_index_supported(conn):
+                _create_search_index(cursor)
+                # Index the rows stored before the index existed
+                cursor.execute(f"INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}) VALUES ('rebuild')")
+            else:
+                logger.warning("SQLite lacks FTS5 or its trigram tokenizer; search index disabled.")
+        elif not search_index:
+            _drop_search_index(cursor)
+        cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        cursor.execute("RELEASE init_db")
+    except Exception:
+        cursor.execute("ROLLBACK TO init_db")
+        cursor.execute("RELEASE init_db")
+        raise
+
     logger.info(f"Database initialized or already exists: {DB_FILE}")
+    if close_conn:
+        conn.close()
+
+def _store_chunk(conn, cursor, chunk):
+    # Already-stored emails are skipped entirely, preserving their processed
+    # flag and labels. The chunk is staged in a temp table so that a single
+    # INSERT ... RETURNING reports which ids were new, without reading first.
+    cursor.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS staged_emails (
+            id TEXT PRIMARY KEY, sender TEXT, subject TEXT, snippet TEXT, internal_date INTEGER, body TEXT,
+            fingerprint TEXT
+        )
+    """)
+    cursor.execute("DELETE FROM temp.staged_emails")
+    cursor.executemany("""
+        INSERT OR IGNORE INTO temp.staged_emails (id, sender, subject, snippet, internal_date, body, fingerprint)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, [(e['id'], e['sender'], e['subject'], e['snippet'], e['internal_date'], e.get('body'),
+           email_fingerprint(e['sender'], e['subject'], e['snippet'], e.get('body'), e['labels']))
+          for e in chunk])
+    # WHERE true keeps SQLite from parsing ON CONFLICT as a join constraint
+    inserted = {row[0] for row in cursor.execute("""
+        INSERT INTO emails (id, sender, subject, snippet, internal_date, body, fingerprint, is_read, processed)
+        SELECT id, sender, subject, snippet, internal_date, body, fingerprint, 0, 0 FROM temp.staged_emails WHERE true
+        ON CONFLICT(id) DO NOTHING
+        RETURNING id
+    """).fetchall()}
+    label_rows = [(e['id'], label) for e in chunk if e['id'] in inserted for label in split_labels(e['labels'])]
+    cursor.executemany("INSERT OR IGNORE INTO email_labels (email_id, label) VALUES (?, ?)", label_rows)
+    cursor.execute("DELETE FROM temp.staged_emails")
+    conn.commit()
+    METRICS.inc('db_rows', len(inserted), table='emails', op='insert')
+    METRICS.inc('db_rows', len(chunk) - len(inserted), table='emails', op='skip')
+    METRICS.inc('db_rows', len(label_rows), table='email_labels', op='insert')
+    logger.debug(f"Committed chunk of {len(chunk)} emails.")
+    return len(inserted)
 
-def store_emails(email_data, conn=None):
+def store_emails(email_data, conn=None, chunk_size=STORE_CHUNK_SIZE):
     close_conn = False
     if conn is None:
         conn = sqlite3.connect(DB_FILE)
         close_conn = True
 
+    # email_data may be a generator; consume it in bounded chunks, each
+    # inserted with one executemany inside its own transaction, so memory
+    # stays flat and rows land as soon as they arrive.
+    emails = iter(email_data)
     cursor = conn.cursor()
     count = 0
-    for e in email_data:
-        cursor.execute("SELECT processed FROM emails WHERE id=?", (e['id'],))
-        row = cursor.fetchone()
-        if row is None:
-            cursor.execute("""
-                INSERT INTO emails (id, sender, subject, snippet, labels, internal_date, is_read, processed)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, (e['id'], e['sender'], e['subject'], e['snippet'], e['labels'], e['internal_date'], 0, 0))
-            count += 1
-        else:
-            # Skip updating existing email to preserve processed flag
-            pass
+    while True:
+        chunk = list(islice(emails, chunk_size))
+        if not chunk:
+            break
+        with METRICS.timer('stage', stage='store'):
+            count += _store_chunk(conn, cursor, chunk)
+
+    logger.info(f"Stored {count} new emails in database.")
+    if close_conn:
+        conn.close()
+    return count
+
+def update_email_labels(email_data, conn):
+    # Replace the labels of already-stored emails without touching the processed flag
+    email_data = list(email_data)
+    cursor = conn.cursor()
+    cursor.executemany("DELETE FROM email_labels WHERE email_id=?", [(e['id'],) for e in email_data])
+    cursor.executemany("""
+        INSERT OR IGNORE INTO email_labels (email_id, label)
+        SELECT id, ? FROM emails WHERE id=?
+    """, [(label, e['id']) for e in email_data for label in split_labels(e['labels'])])
+    # Only a real change re-queues the email for the rules
+    refresh_fingerprints(conn, [e['id'] for e in email_data])
+    conn.commit()
+    return len(email_data)
+
+def get_labels(conn, email_id):
+    return [row[0] for row in conn.execute(
+        "SELECT label FROM email_labels WHERE email_id=? ORDER BY label", (email_id,))]
+
+def emails_with_label(conn, label):
+    # Served by idx_email_labels_label
+    return [row[0] for row in conn.execute("SELECT email_id FROM email_labels WHERE label=?", (label,))]
+
+def get_sync_state(conn, key, default=None):
+    row = conn.execute("SELECT value FROM sync_state WHERE key=?", (key,)).fetchone()
+    return row[0] if row else default
+
+def set_sync_state(conn, key, value):
+    conn.execute("""
+        INSERT INTO sync_state (key, value) VALUES (?, ?)
+        ON CONFLICT(key) DO UPDATE SET value=excluded.value
+    """, (key, str(value)))
+    conn.commit()
+
+def load_label_cache(conn):
+    return conn.execute("SELECT name, label_id FROM label_cache").fetchall()
+
+def save_label_cache(conn, labels, replace=False):
+    # labels: iterable of (name, label_id); replace drops every cached entry first
+    if replace:
+        conn.execute("DELETE FROM label_cache")
+    conn.executemany("""
+        INSERT INTO label_cache (name_key, name, label_id) VALUES (?, ?, ?)
+        ON CONFLICT(name_key) DO UPDATE SET name=excluded.name, label_id=excluded.label_id
+    """, [(name.lower(), name, label_id) for name, label_id in labels])
+    conn.commit()
+
+def save_rule_set(conn, version, fingerprints):
+    conn.executemany("INSERT OR IGNORE INTO rule_sets (version, fingerprint) VALUES (?, ?)",
+                     [(version, fingerprint) for fingerprint in fingerprints])
+    conn.commit()
+
+def load_rule_set(conn, version):
+    # None for a version this database has never seen
+    fingerprints = {row[0] for row in conn.execute("SELECT fingerprint FROM rule_sets WHERE version=?", (version,))}
+    return fingerprints or None
+
+def rule_set_versions(conn):
+    return [row[0] for row in conn.execute("SELECT DISTINCT version FROM rule_sets")]
 
+def save_rule_watermarks(conn, fingerprints, evaluated_at):
+    conn.executemany("""
+        INSERT INTO rule_watermarks (fingerprint, evaluated_at) VALUES (?, ?)
+        ON CONFLICT(fingerprint) DO UPDATE SET evaluated_at=excluded.evaluated_at
+    """, [(fingerprint, evaluated_at.isoformat()) for fingerprint in fingerprints])
     conn.commit()
 
-    logger.info(f"Stored {count} new emails in database.")
\ No newline at end of file
+def load_rule_watermarks(conn, fingerprints):
+    # {fingerprint: datetime} for the rules that have one
+    fingerprints = list(fingerprints)
+    placeholders = ','.join('?' * len(fingerprints))
+    return {fingerprint: datetime.fromisoformat(evaluated_at) for fingerprint, evaluated_at in conn.execute(
+        f"SELECT fingerprint, evaluated_at FROM rule_watermarks WHERE fingerprint IN ({placeholders})", fingerprints)}
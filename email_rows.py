@@ -0,0 +1,50 @@
+from metrics import METRICS
+
+# Shared by the in-process (process_rules) and worker-process (parallel_rules)
+# rule paths: which rows they select and how a row becomes an email dict.
+
+EMAIL_COLUMNS = ("id, sender, subject, snippet, "
+                 "(SELECT group_concat(label, ',') FROM email_labels WHERE email_id = emails.id), internal_date, body")
+UNPROCESSED_FILTER = "is_read=0 AND processed=0"
+# Rows the scheduler (process_rules.evaluation_scopes) picks from; its scopes
+# narrow them down. The unary + keeps SQLite from choosing an index on is_read
+# (or on rowid) over the scope's own, far more selective one.
+PENDING_FILTER = "+is_read=0"
+# Served by the partial index idx_emails_changed, so finding the changed rows
+# doesn't scan the table
+CHANGED_FILTER = "rowid IN (SELECT rowid FROM emails WHERE evaluated_fingerprint IS NOT fingerprint)"
+UNCHANGED_FILTER = "evaluated_fingerprint IS fingerprint"
+MAX_ROWID_FILTER = "+rowid <= ?"
+
+
+def selection_filter(scope=None):
+    # Without a scope: every unprocessed email. A scope (clause, params) from
+    # evaluation_scopes selects among the unread emails instead.
+    if scope is None:
+        return UNPROCESSED_FILTER, []
+    clause, params = scope
+    return f"{PENDING_FILTER} AND ({clause})", list(params)
+
+
+def row_to_email(row):
+    email_id, sender, subject, snippet, labels, internal_date, body = row
+    return {
+        "id": email_id,
+        "sender": sender,
+        "subject": subject,
+        "snippet": snippet,
+        "labels": labels or "",
+        "received": internal_date,  # Add received date for date predicates
+        "body": body or ""  # Only stored when fetching with the 'full' profile
+    }
+
+
+def record_rule_metrics(rules, evaluated, matches):
+    hits = {}
+    for _, matched in matches:
+        for rule in matched:
+            hits[id(rule)] = hits.get(id(rule), 0) + 1
+    for rule in rules:
+        if evaluated:
+            METRICS.inc('rule_evaluations', evaluated, rule=rule.name)
+        METRICS.inc('rule_hits', hits.get(id(rule), 0), rule=rule.name)
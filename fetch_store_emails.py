@@ -1,61 +1,331 @@
 import os
+import json
+import time
+import base64
 import logging
-from datetime import datetime
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from config import CREDENTIALS_FILE, TOKEN_FILE, SCOPES
+import threading
+import importlib
+from googleapiclient.errors import HttpError
+from metrics import METRICS, record_request
+from config import (
+    CREDENTIALS_FILE, TOKEN_FILE, SCOPES,
+    GMAIL_MAX_BATCH_SIZE, FETCH_BATCH_SIZE, FETCH_MAX_RETRIES, FETCH_RETRY_BACKOFF,
+    LIST_PAGE_SIZE, FETCH_PROFILE, GMAIL_API_VERSION, DISCOVERY_CACHE_FILE, DISCOVERY_CACHE_MAX_AGE
+)
 
 logger = logging.getLogger(__name__)
 
-def gmail_authenticate():
+# The Google auth and client libraries take a few hundred milliseconds to
+# import, and the database, rules and search code paths (and most tests) never
+# need them. They are imported on first use instead: as module attributes
+# through __getattr__, or by _ensure_imported before a function uses them.
+LAZY_IMPORTS = {
+    'Credentials': ('google.oauth2.credentials', 'Credentials'),
+    'InstalledAppFlow': ('google_auth_oauthlib.flow', 'InstalledAppFlow'),
+    'Request': ('google.auth.transport.requests', 'Request'),
+    'RefreshError': ('google.auth.exceptions', 'RefreshError'),
+    'build_from_document': ('googleapiclient.discovery', 'build_from_document'),
+}
+
+DISCOVERY_URL = 'https://gmail.googleapis.com/$discovery/rest?version={version}'
+
+_discovery_document = None
+_discovery_lock = threading.Lock()
+
+def __getattr__(name):
+    if name not in LAZY_IMPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module_name, attribute = LAZY_IMPORTS[name]
+    value = getattr(importlib.import_module(module_name), attribute)
+    # setdefault: a name already patched in (tests) stays as it is
+    return globals().setdefault(name, value)
+
+def _ensure_imported(*names):
+    for name in names:
+        if name not in globals():
+            __getattr__(name)
+
+class AuthorizationRequiredError(Exception):
+    pass
+
+def _save_credentials(creds, token_file):
+    with open(token_file, 'w') as token:
+        token.write(creds.to_json())
+
+def get_credentials(token_file=TOKEN_FILE, interactive=True):
+    # interactive=False raises AuthorizationRequiredError instead of starting
+    # the browser flow, for callers that can't block on a user (pool threads)
+    _ensure_imported('Credentials', 'InstalledAppFlow')
     creds = None
-    if os.path.exists(TOKEN_FILE):
-        creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
+    if os.path.exists(token_file):
+        creds = Credentials.from_authorized_user_file(token_file, SCOPES)
         logger.info("Loaded credentials from token file.")
+    if creds and not creds.valid and creds.expired and creds.refresh_token:
+        # A still-valid access token is used as is; an expired one is
+        # refreshed here, once, rather than by every client that uses it
+        _ensure_imported('Request', 'RefreshError')
+        try:
+            creds.refresh(Request())
+            _save_credentials(creds, token_file)
+            logger.info("Refreshed expired access token.")
+        except RefreshError as e:
+            logger.warning(f"Could not refresh access token, re-authorizing: {e}")
     if not creds or not creds.valid:
+        if not interactive:
+            raise AuthorizationRequiredError(f"No valid credentials in {token_file}; authorize it interactively first")
         logger.info("No valid credentials found, starting OAuth flow...")
         flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_FILE, SCOPES)
         creds = flow.run_local_server(port=0)
-        with open(TOKEN_FILE, 'w') as token:
-            token.write(creds.to_json())
+        _save_credentials(creds, token_file)
         logger.info("OAuth flow complete and token saved.")
-    return build('gmail', 'v1', credentials=creds)
+    return creds
+
+def _read_discovery_cache(cache_file, max_age):
+    try:
+        if time.time() - os.path.getmtime(cache_file) > max_age:
+            return None
+        with open(cache_file) as f:
+            document = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # The file name carries the API version, but check the content too
+    if document.get('version') != GMAIL_API_VERSION:
+        return None
+    return document
+
+def _fetch_discovery_document():
+    # The client library bundles discovery documents since 2.0; otherwise download it
+    try:
+        from googleapiclient.discovery_cache import get_static_doc
+        content = get_static_doc('gmail', GMAIL_API_VERSION)
+    except ImportError:
+        content = None
+    if content is None:
+        import urllib.request
+        with urllib.request.urlopen(DISCOVERY_URL.format(version=GMAIL_API_VERSION), timeout=30) as response:
+            content = response.read().decode('utf-8')
+    return json.loads(content)
+
+def load_discovery_document(cache_file=DISCOVERY_CACHE_FILE, max_age=DISCOVERY_CACHE_MAX_AGE):
+    # Parsed once per process and shared by every client built from it (each
+    # fetch worker builds its own). On disk it is cached per API version and
+    # re-read from the library (or Google) once it is max_age seconds old.
+    global _discovery_document
+    with _discovery_lock:
+        if _discovery_document is None:
+            document = _read_discovery_cache(cache_file, max_age)
+            if document is None:
+                document = _fetch_discovery_document()
+                tmp_file = f"{cache_file}.tmp"
+                with open(tmp_file, 'w') as f:
+                    json.dump(document, f)
+                os.replace(tmp_file, cache_file)
+                logger.info(f"Cached Gmail API {GMAIL_API_VERSION} discovery document "
+                            f"(revision {document.get('revision')}) in {cache_file}.")
+            _discovery_document = document
+        return _discovery_document
+
+def build_service(creds):
+    _ensure_imported('build_from_document')
+    return build_from_document(load_discovery_document(), credentials=creds)
+
+def gmail_authenticate():
+    return build_service(get_credentials())
+
+# messages.get parameters per fetch profile. The fields mask trims the JSON
+# response down to what parse_message reads.
+FETCH_PROFILES = {
+    'metadata': {
+        'format': 'metadata',
+        'metadataHeaders': ['From', 'Subject'],
+        'fields': 'id,snippet,labelIds,internalDate,payload/headers',
+    },
+    'full': {
+        'format': 'full',
+        'fields': 'id,snippet,labelIds,internalDate,payload',
+    },
+}
 
-def fetch_top_emails(service, max_results=10):
+def get_message_request(service, msg_id, profile=FETCH_PROFILE):
+    return service.users().messages().get(userId='me', id=msg_id, **FETCH_PROFILES[profile])
+
+def _iter_parts(part):
+    yield part
+    for child in part.get('parts', []):
+        yield from _iter_parts(child)
+
+def extract_body(payload):
+    # First text/plain part, falling back to text/html
+    parts = list(_iter_parts(payload))
+    for mime_type in ('text/plain', 'text/html'):
+        for part in parts:
+            data = part.get('body', {}).get('data')
+            if part.get('mimeType') == mime_type and data:
+                return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4)).decode('utf-8', errors='replace')
+    return ""
+
+def parse_message(msg, profile=FETCH_PROFILE):
+    headers = msg.get('payload', {}).get('headers', [])
+    sender = next((h['value'] for h in headers if h['name'] == 'From'), "")
+    subject = next((h['value'] for h in headers if h['name'] == 'Subject'), "")
+    snippet = msg.get('snippet', "")
+    labels = list(msg.get('labelIds', []))
+    # Epoch milliseconds, exactly as Gmail reports them
+    internal_date = int(msg['internalDate'])
+
+    email = {
+        'id': msg['id'],
+        'sender': sender,
+        'subject': subject,
+        'snippet': snippet,
+        'labels': labels,
+        'internal_date': internal_date
+    }
+    if profile == 'full':
+        email['body'] = extract_body(msg.get('payload', {}))
+    # UTF-8 size of the text fields that get stored
+    METRICS.inc('message_bytes', sum(len(value.encode('utf-8'))
+                                     for value in (sender, subject, snippet, email.get('body') or '')))
+    return email
+
+def is_retryable_error(error):
+    # Rate limits and transient server errors are worth retrying, anything
+    # else (404 for a deleted message, 400 for a bad id) is not.
+    if not isinstance(error, HttpError):
+        return False
+    status = error.resp.status
+    if status in (429, 500, 502, 503, 504):
+        return True
+    return status == 403 and 'rate' in str(error.reason).lower()
+
+def execute_get_batch(service, message_ids, results, profile=FETCH_PROFILE):
+    failed = []
+
+    def callback(request_id, response, exception):
+        if exception is None:
+            results[request_id] = parse_message(response, profile)
+        elif is_retryable_error(exception):
+            failed.append(request_id)
+        else:
+            METRICS.inc('api_errors', method='messages.get')
+            logger.warning(f"Failed to fetch message {request_id}: {exception}")
+
+    batch = service.new_batch_http_request(callback=callback)
+    for msg_id in message_ids:
+        batch.add(get_message_request(service, msg_id, profile), request_id=msg_id)
+    record_request('messages.get', len(message_ids))
+    try:
+        batch.execute()
+    except HttpError as e:
+        if not is_retryable_error(e):
+            raise
+        logger.warning(f"Batch request failed, will retry: {e}")
+        failed = [msg_id for msg_id in message_ids if msg_id not in results]
+    return failed
+
+def fetch_messages_batched(service, message_ids, batch_size=FETCH_BATCH_SIZE,
+                           max_retries=FETCH_MAX_RETRIES, backoff=FETCH_RETRY_BACKOFF, profile=FETCH_PROFILE):
+    batch_size = max(1, min(batch_size, GMAIL_MAX_BATCH_SIZE))
+    # Request ids inside a batch must be unique
+    message_ids = list(dict.fromkeys(message_ids))
+    results = {}
+    with METRICS.timer('stage', stage='fetch'):
+        _fetch_with_retries(service, message_ids, results, batch_size, max_retries, backoff, profile)
+    return [results[msg_id] for msg_id in message_ids if msg_id in results]
+
+def _fetch_with_retries(service, pending, results, batch_size, max_retries, backoff, profile):
+    attempt = 0
+    while pending:
+        failed = []
+        for start in range(0, len(pending), batch_size):
+            failed.extend(execute_get_batch(service, pending[start:start + batch_size], results, profile))
+        if not failed:
+            break
+        attempt += 1
+        if attempt > max_retries:
+            logger.error(f"Giving up on {len(failed)} messages after {max_retries} retries.")
+            break
+        delay = backoff * (2 ** (attempt - 1))
+        logger.info(f"Retrying {len(failed)} failed messages in {delay:.1f}s (attempt {attempt}/{max_retries})...")
+        METRICS.inc('api_retries', len(failed), method='messages.get')
+        time.sleep(delay)
+        pending = failed
+
+def fetch_top_emails(service, max_results=10, batch_size=None, profile=FETCH_PROFILE):
     logger.info(f"Fetching top {max_results} emails from Gmail inbox...")
+    record_request('messages.list')
     results = service.users().messages().list(userId='me', maxResults=max_results, labelIds=['INBOX']).execute()
     messages = results.get('messages', [])
-    email_data = []
-
-    for msg in messages:
-        full_msg = service.users().messages().get(userId='me', id=msg['id']).execute()
-        headers = full_msg['payload']['headers']
-        sender = next((h['value'] for h in headers if h['name'] == 'From'), "")
-        subject = next((h['value'] for h in headers if h['name'] == 'Subject'), "")
-        snippet = full_msg.get('snippet', "")
-        labels = ','.join(full_msg.get('labelIds', []))
-        internal_date = datetime.fromtimestamp(int(full_msg['internalDate'])/1000).strftime('%Y-%m-%d %H:%M:%S')
-
-        email_data.append({
-            'id': msg['id'],
-            'sender': sender,
-            'subject': subject,
-            'snippet': snippet,
-            'labels': labels,
-            'internal_date': internal_date
-        })
-        logger.debug(f"Fetched email: {subject} from {sender}")
+
+    if batch_size:
+        email_data = fetch_messages_batched(service, [msg['id'] for msg in messages], batch_size=batch_size,
+                                            profile=profile)
+    else:
+        email_data = []
+        for msg in messages:
+            record_request('messages.get')
+            full_msg = get_message_request(service, msg['id'], profile).execute()
+            email = parse_message(dict(full_msg, id=msg['id']), profile)
+            email_data.append(email)
+            logger.debug(f"Fetched email: {email['subject']} from {email['sender']}")
 
     logger.info(f"Fetched {len(email_data)} emails.")
     return email_data
 
+def iter_message_ids(service, label_ids=('INBOX',), page_size=LIST_PAGE_SIZE, max_messages=None):
+    page_token = None
+    seen = 0
+    while True:
+        if max_messages is not None:
+            page_size = min(page_size, max_messages - seen)
+        request = {'userId': 'me', 'maxResults': page_size, 'labelIds': list(label_ids)}
+        if page_token:
+            request['pageToken'] = page_token
+        record_request('messages.list')
+        results = service.users().messages().list(**request).execute()
+        for msg in results.get('messages', []):
+            yield msg['id']
+            seen += 1
+        page_token = results.get('nextPageToken')
+        if not page_token or (max_messages is not None and seen >= max_messages):
+            return
+
+def fetch_messages(service, message_ids, batch_size=FETCH_BATCH_SIZE, fetcher=None, profile=FETCH_PROFILE):
+    # A ConcurrentFetcher spreads the ids over its worker pool (with its own
+    # profile), otherwise the batches are sent one after another on the given service.
+    if fetcher is not None:
+        return fetcher.fetch(message_ids, batch_size=batch_size)
+    return fetch_messages_batched(service, message_ids, batch_size=batch_size, profile=profile)
+
+def iter_inbox_emails(service, page_size=LIST_PAGE_SIZE, batch_size=FETCH_BATCH_SIZE, max_messages=None,
+                      fetcher=None, profile=FETCH_PROFILE):
+    # Lazily walks every page of the inbox listing, fetching each page's
+    # messages in batches so callers can store them before the listing ends.
+    logger.info("Streaming emails from Gmail inbox...")
+    chunk_size = batch_size * (max(1, fetcher.workers) if fetcher is not None else 1)
+    fetched = 0
+    pending = []
+    for msg_id in iter_message_ids(service, page_size=page_size, max_messages=max_messages):
+        pending.append(msg_id)
+        if len(pending) >= chunk_size:
+            for email in fetch_messages(service, pending, batch_size, fetcher, profile):
+                fetched += 1
+                yield email
+            pending = []
+    if pending:
+        for email in fetch_messages(service, pending, batch_size, fetcher, profile):
+            fetched += 1
+            yield email
+    logger.info(f"Fetched {fetched} emails.")
+
 def get_or_create_label(service, label_name):
+    record_request('labels.list')
     labels_list = service.users().labels().list(userId='me').execute().get('labels', [])
     for lbl in labels_list:
         if lbl['name'].lower() == label_name.lower():
             logger.debug(f"Found existing label '{label_name}' with id {lbl['id']}")
             return lbl['id']
+    record_request('labels.create')
     new_label = service.users().labels().create(
         userId='me',
         body={"name": label_name, "labelListVisibility": "labelShow", "messageListVisibility": "show"}
@@ -0,0 +1,402 @@
+import json
+import time
+import base64
+import random
+import threading
+from collections import deque
+import httplib2
+from googleapiclient.errors import HttpError
+
+# Offline stand-in for the parts of the Gmail API this project calls, for
+# end-to-end tests and benchmarks (see benchmarks/bench_pipeline.py). Messages
+# are generated from their position on demand, so mailboxes of a million
+# messages cost no more memory than the labels that were changed.
+
+# Quota units per method, as documented by Gmail
+QUOTA_COSTS = {
+    'messages.list': 5,
+    'messages.get': 5,
+    'messages.batchModify': 50,
+    'labels.list': 1,
+    'labels.create': 5,
+    'history.list': 2,
+    'getProfile': 1,
+}
+
+SYSTEM_LABELS = ('INBOX', 'UNREAD', 'IMPORTANT', 'CATEGORY_PROMOTIONS', 'CATEGORY_UPDATES', 'SENT', 'TRASH', 'SPAM')
+
+SENDERS = ('jobs@linkedin.com', 'alerts@hirist.tech', 'offers@mailer.ajio.in', 'news@medium.com',
+           'team@github.com', 'friend@example.com', 'billing@aws.amazon.com', 'noreply@google.com')
+SUBJECTS = ('New job openings for you', 'Your application was viewed', 'Mega sale: 50% discount',
+            'Weekly digest', 'Pull request review requested', 'Lunch tomorrow?', 'Your invoice is ready',
+            'Security alert')
+
+# History records older than this many changes are "expired" (history.list returns 404)
+HISTORY_RETENTION = 100000
+
+
+def http_error(status, message):
+    content = json.dumps({'error': {'code': status, 'message': message}}).encode('utf-8')
+    return HttpError(httplib2.Response({'status': status}), content)
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class SimulatedMailbox:
+    # Shared state behind every SimulatedService client: messages, labels,
+    # history, quota and call statistics.
+    def __init__(self, size=1000, latency=0.0, per_item_latency=0.0, quota_per_second=None, error_rate=0.0,
+                 seed=0, base_date_ms=1754827200000, clock=time.monotonic, sleep=time.sleep):
+        self.size = size
+        self.latency = latency
+        self.per_item_latency = per_item_latency
+        self.quota_per_second = quota_per_second
+        self.error_rate = error_rate
+        self.seed = seed
+        self.base_date_ms = base_date_ms
+        self.clock = clock
+        self.sleep = sleep
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        # Labels of messages that differ from their generated defaults
+        self.label_overrides = {}
+        self.added = []
+        self.labels = {name: {'id': name, 'name': name, 'type': 'system'} for name in SYSTEM_LABELS}
+        self.history = deque(maxlen=HISTORY_RETENTION)
+        self.history_id = 1000
+        self.quota_tokens = quota_per_second or 0
+        self.quota_updated = clock()
+        self.calls = {}
+        self.round_trips = 0
+        self.quota_errors = 0
+        self.latencies = []
+
+    # -- synthetic messages --
+
+    def message_id(self, index):
+        return f"{index:016x}"
+
+    def _index(self, msg_id):
+        try:
+            index = int(msg_id, 16)
+        except (TypeError, ValueError):
+            return None
+        return index if 0 <= index < self.total() else None
+
+    def _default_labels(self, index):
+        labels = ['INBOX']
+        if index % 3:
+            labels.append('UNREAD')
+        if index % 5 == 0:
+            labels.append('CATEGORY_UPDATES')
+        return labels
+
+    def message_labels(self, index):
+        if index in self.label_overrides:
+            return self.label_overrides[index]
+        return self._default_labels(index)
+
+    def _headers(self, index):
+        return [{'name': 'From', 'value': SENDERS[(index * 7 + self.seed) % len(SENDERS)]},
+                {'name': 'To', 'value': 'me@example.com'},
+                {'name': 'Subject', 'value': f"{SUBJECTS[(index * 3 + self.seed) % len(SUBJECTS)]} #{index}"}]
+
+    def _body(self, index):
+        text = f"Hello,\n\nThis is synthetic message {index}.\n\nRegards"
+        return base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii').rstrip('=')
+
+    def message_resource(self, index, format='full', metadata_headers=None):
+        # Generated messages get older with their index; added ones are newer than all of them
+        msg = {
+            'id': self.message_id(index),
+            'threadId': self.message_id(index),
+            'labelIds': list(self.message_labels(index)),
+            'snippet': f"This is synthetic message {index}.",
+            'internalDate': str(self.base_date_ms + (index - self.size + 1 if index >= self.size else -index) * 60000),
+        }
+        headers = self._headers(index)
+        if format == 'metadata':
+            if metadata_headers:
+                headers = [h for h in headers if h['name'] in metadata_headers]
+            msg['payload'] = {'headers': headers}
+        elif format != 'minimal':
+            msg['payload'] = {'mimeType': 'multipart/alternative', 'headers': headers, 'parts': [
+                {'mimeType': 'text/plain', 'body': {'data': self._body(index)}},
+                {'mimeType': 'text/html', 'body': {'data': self._body(index)}},
+            ]}
+        return msg
+
+    def total(self):
+        return self.size + len(self.added)
+
+    def index_at(self, position):
+        # Listing order is newest first: messages added during the run come
+        # before the generated ones
+        added = len(self.added)
+        return self.size + added - 1 - position if position < added else position - added
+
+    # -- mutations, recorded in the history --
+
+    def _record(self, key, index, label_ids=None):
+        self.history_id += 1
+        item = {'message': {'id': self.message_id(index), 'labelIds': list(self.message_labels(index))}}
+        if label_ids is not None:
+            item['labelIds'] = list(label_ids)
+        self.history.append({'id': str(self.history_id), key: [item]})
+
+    def add_messages(self, count):
+        # New mail arriving in the inbox, newest last
+        with self.lock:
+            ids = []
+            for _ in range(count):
+                index = self.size + len(self.added)
+                self.added.append(index)
+                self._record('messagesAdded', index)
+                ids.append(self.message_id(index))
+            return ids
+
+    def modify_labels(self, msg_id, add=(), remove=()):
+        with self.lock:
+            self._modify(self._index(msg_id), add, remove)
+
+    def _modify(self, index, add, remove):
+        labels = [label for label in self.message_labels(index) if label not in remove]
+        labels += [label for label in add if label not in labels]
+        self.label_overrides[index] = labels
+        if add:
+            self._record('labelsAdded', index, add)
+        if remove:
+            self._record('labelsRemoved', index, remove)
+
+    # -- request plumbing --
+
+    def _take_quota(self, cost):
+        if not self.quota_per_second:
+            return True
+        now = self.clock()
+        self.quota_tokens = min(self.quota_per_second,
+                                self.quota_tokens + (now - self.quota_updated) * self.quota_per_second)
+        self.quota_updated = now
+        if self.quota_tokens < cost:
+            self.quota_errors += 1
+            return False
+        self.quota_tokens -= cost
+        return True
+
+    def call(self, method, handler):
+        # Runs one API call under the lock, raising the errors Gmail would
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            if not self._take_quota(QUOTA_COSTS[method]):
+                raise http_error(429, "User-rate limit exceeded")
+            if self.error_rate and self.rng.random() < self.error_rate:
+                raise http_error(503, "Backend Error")
+            return handler()
+
+    def round_trip(self, items=1):
+        # One HTTP request carrying `items` calls; the latency is paid outside the lock
+        start = time.perf_counter()
+        delay = self.latency + self.per_item_latency * items
+        if delay:
+            self.sleep(delay)
+        with self.lock:
+            self.round_trips += 1
+        return start
+
+    def finish_round_trip(self, start):
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.latencies.append(elapsed)
+
+    def service(self):
+        # A new client sharing this mailbox; like googleapiclient, give each thread its own
+        return SimulatedService(self)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'calls': dict(self.calls),
+                'api_calls': sum(self.calls.values()),
+                'round_trips': self.round_trips,
+                'quota_errors': self.quota_errors,
+                'latency_p50': percentile(self.latencies, 0.50),
+                'latency_p99': percentile(self.latencies, 0.99),
+            }
+
+
+class SimulatedRequest:
+    def __init__(self, mailbox, method, handler):
+        self.mailbox = mailbox
+        self.method = method
+        self.handler = handler
+
+    def execute(self):
+        start = self.mailbox.round_trip()
+        try:
+            return self.mailbox.call(self.method, self.handler)
+        finally:
+            self.mailbox.finish_round_trip(start)
+
+
+class SimulatedBatch:
+    def __init__(self, mailbox, callback):
+        self.mailbox = mailbox
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        if len(self.requests) >= 1000:
+            raise ValueError("Exceeded maximum calls (1000) in a single batch request.")
+        request_id = request_id if request_id is not None else str(len(self.requests))
+        self.requests.append((request_id, request, callback or self.callback))
+
+    def execute(self):
+        start = self.mailbox.round_trip(len(self.requests))
+        try:
+            for request_id, request, callback in self.requests:
+                try:
+                    response = self.mailbox.call(request.method, request.handler)
+                except HttpError as e:
+                    callback(request_id, None, e)
+                else:
+                    callback(request_id, response, None)
+        finally:
+            self.mailbox.finish_round_trip(start)
+
+
+class SimulatedService:
+    # Mirrors the googleapiclient resource tree: service.users().messages().get(...)
+    def __init__(self, mailbox):
+        self.mailbox = mailbox
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return _Messages(self.mailbox)
+
+    def labels(self):
+        return _Labels(self.mailbox)
+
+    def history(self):
+        return _History(self.mailbox)
+
+    def getProfile(self, userId):
+        mailbox = self.mailbox
+        return SimulatedRequest(mailbox, 'getProfile', lambda: {
+            'emailAddress': 'me@example.com',
+            'messagesTotal': mailbox.total(),
+            'historyId': str(mailbox.history_id),
+        })
+
+    def new_batch_http_request(self, callback=None):
+        return SimulatedBatch(self.mailbox, callback)
+
+
+class _Messages:
+    def __init__(self, mailbox):
+        self.mailbox = mailbox
+
+    def list(self, userId, maxResults=100, labelIds=None, pageToken=None, **params):
+        mailbox = self.mailbox
+
+        def handler():
+            # The page token is the listing position to continue from
+            position = int(pageToken or 0)
+            wanted = set(labelIds or ())
+            ids = []
+            total = mailbox.total()
+            while position < total and len(ids) < min(maxResults, 500):
+                index = mailbox.index_at(position)
+                if wanted <= set(mailbox.message_labels(index)):
+                    ids.append({'id': mailbox.message_id(index), 'threadId': mailbox.message_id(index)})
+                position += 1
+            response = {'messages': ids, 'resultSizeEstimate': len(ids)}
+            if position < total:
+                response['nextPageToken'] = str(position)
+            return response
+
+        return SimulatedRequest(mailbox, 'messages.list', handler)
+
+    def get(self, userId, id, format='full', metadataHeaders=None, fields=None):
+        # The fields mask is accepted but not applied; the response already
+        # only has what `format` asks for.
+        mailbox = self.mailbox
+
+        def handler():
+            index = mailbox._index(id)
+            if index is None:
+                raise http_error(404, "Requested entity was not found.")
+            return mailbox.message_resource(index, format, metadataHeaders)
+
+        return SimulatedRequest(mailbox, 'messages.get', handler)
+
+    def batchModify(self, userId, body):
+        mailbox = self.mailbox
+
+        def handler():
+            ids = body.get('ids', [])
+            if len(ids) > 1000:
+                raise http_error(400, "Too many messages in batchModify")
+            add, remove = body.get('addLabelIds', []), body.get('removeLabelIds', [])
+            for label_id in list(add) + list(remove):
+                if label_id not in mailbox.labels:
+                    raise http_error(400, f"Invalid label: {label_id}")
+            for msg_id in ids:
+                index = mailbox._index(msg_id)
+                if index is not None:
+                    mailbox._modify(index, add, remove)
+            return ''
+
+        return SimulatedRequest(mailbox, 'messages.batchModify', handler)
+
+
+class _Labels:
+    def __init__(self, mailbox):
+        self.mailbox = mailbox
+
+    def list(self, userId):
+        mailbox = self.mailbox
+        return SimulatedRequest(mailbox, 'labels.list', lambda: {'labels': [dict(l) for l in mailbox.labels.values()]})
+
+    def create(self, userId, body):
+        mailbox = self.mailbox
+
+        def handler():
+            if any(l['name'].lower() == body['name'].lower() for l in mailbox.labels.values()):
+                raise http_error(409, "Label name exists or conflicts")
+            label_id = f"Label_{len(mailbox.labels) + 1}"
+            mailbox.labels[label_id] = dict(body, id=label_id, type='user')
+            return dict(mailbox.labels[label_id])
+
+        return SimulatedRequest(mailbox, 'labels.create', handler)
+
+
+class _History:
+    def __init__(self, mailbox):
+        self.mailbox = mailbox
+
+    def list(self, userId, startHistoryId, historyTypes=None, labelId=None, maxResults=100, pageToken=None):
+        mailbox = self.mailbox
+
+        def handler():
+            start = int(startHistoryId)
+            oldest = int(mailbox.history[0]['id']) if mailbox.history else mailbox.history_id + 1
+            if start < oldest - 1:
+                raise http_error(404, "Requested entity was not found.")
+            keys = {'messageAdded': 'messagesAdded', 'labelAdded': 'labelsAdded', 'labelRemoved': 'labelsRemoved'}
+            wanted = {keys[t] for t in historyTypes} if historyTypes else set(keys.values())
+            records = [r for r in mailbox.history if int(r['id']) > start and wanted & r.keys()]
+            offset = int(pageToken or 0)
+            page = records[offset:offset + min(maxResults, 500)]
+            response = {'history': page, 'historyId': str(mailbox.history_id)}
+            if offset + len(page) < len(records):
+                response['nextPageToken'] = str(offset + len(page))
+            return response
+
+        return SimulatedRequest(mailbox, 'history.list', handler)
@@ -0,0 +1,81 @@
+import time
+import logging
+from googleapiclient.errors import HttpError
+from metrics import record_request
+from db import load_label_cache, save_label_cache, get_sync_state, set_sync_state
+from config import LABEL_CACHE_TTL
+
+logger = logging.getLogger(__name__)
+
+LABELS_FETCHED_AT_KEY = 'labels_fetched_at'
+
+
+def is_missing_label_error(error):
+    if not isinstance(error, HttpError):
+        return False
+    return error.resp.status == 404 or (error.resp.status == 400 and 'label' in str(error.reason).lower())
+
+
+class LabelRegistry:
+    # Case-insensitive label name -> id map. Labels are listed at most once
+    # per TTL; the map is kept in memory and, when a connection is given,
+    # persisted in SQLite so later runs can skip labels.list entirely.
+    def __init__(self, service, conn=None, ttl=LABEL_CACHE_TTL, clock=time.time):
+        self.service = service
+        self.conn = conn
+        self.ttl = ttl
+        self.clock = clock
+        self._labels = None
+
+    def _load_persisted(self):
+        if self.conn is None:
+            return False
+        fetched_at = get_sync_state(self.conn, LABELS_FETCHED_AT_KEY)
+        if fetched_at is None or self.clock() - float(fetched_at) > self.ttl:
+            return False
+        self._labels = {name.lower(): label_id for name, label_id in load_label_cache(self.conn)}
+        logger.debug(f"Loaded {len(self._labels)} labels from cache.")
+        return True
+
+    def refresh(self):
+        record_request('labels.list')
+        labels_list = self.service.users().labels().list(userId='me').execute().get('labels', [])
+        self._labels = {lbl['name'].lower(): lbl['id'] for lbl in labels_list}
+        if self.conn is not None:
+            save_label_cache(self.conn, [(lbl['name'], lbl['id']) for lbl in labels_list], replace=True)
+            set_sync_state(self.conn, LABELS_FETCHED_AT_KEY, self.clock())
+        logger.info(f"Listed {len(self._labels)} Gmail labels.")
+
+    def _ensure_loaded(self):
+        if self._labels is None and not self._load_persisted():
+            self.refresh()
+
+    def get(self, label_name):
+        self._ensure_loaded()
+        return self._labels.get(label_name.lower())
+
+    def get_or_create(self, label_name):
+        label_id = self.get(label_name)
+        if label_id is not None:
+            logger.debug(f"Found existing label '{label_name}' with id {label_id}")
+            return label_id
+        record_request('labels.create')
+        new_label = self.service.users().labels().create(
+            userId='me',
+            body={"name": label_name, "labelListVisibility": "labelShow", "messageListVisibility": "show"}
+        ).execute()
+        self._labels[label_name.lower()] = new_label['id']
+        if self.conn is not None:
+            save_label_cache(self.conn, [(label_name, new_label['id'])])
+        logger.info(f"Created new label '{label_name}' with id {new_label['id']}")
+        return new_label['id']
+
+    def resolve_all(self, label_names):
+        # At most one labels.list call, plus one create per label that doesn't exist yet
+        return {name: self.get_or_create(name) for name in label_names}
+
+    def invalidate(self):
+        self._labels = None
+        if self.conn is not None:
+            set_sync_state(self.conn, LABELS_FETCHED_AT_KEY, 0)
+        logger.info("Label cache invalidated.")
@@ -1,25 +1,93 @@
-import sqlite3
-from db import init_db, store_emails
-from fetch_store_emails import gmail_authenticate, fetch_top_emails
+import argparse
+from db import init_db, connect
+from fetch_store_emails import get_credentials, build_service
+from concurrent_fetch import ConcurrentFetcher
+from sync import sync_mailbox
 from process_rules import apply_rules
-from config import logger, DB_FILE
+from rules_manager import RulesManager
+from daemon import Daemon
+from accounts import load_accounts, authorize_accounts, MultiAccountRunner
+from metrics import export, profiled
+from search import search, format_result
+from config import (
+    logger, DB_FILE, FETCH_BATCH_SIZE, STORE_CHUNK_SIZE, FETCH_WORKERS, RULES_SQL_PUSHDOWN,
+    RULE_WORKERS, RULES_FILE, METRICS_FILE, PROFILE_FILE, SEARCH_LIMIT
+)
+
+
+def run_accounts(args):
+    accounts = load_accounts(args.accounts)
+    authorize_accounts(accounts)
+    with MultiAccountRunner(accounts) as runner:
+        runner.run_once()
+
+
+def run_search(args):
+    # Offline: only reads the local database
+    conn = connect(DB_FILE)
+    init_db(conn)
+    for result in search(conn, args.search, limit=args.limit):
+        print(format_result(result))
+    conn.close()
 
-if __name__ == '__main__':
-    logger.info("Starting Gmail processor script...")
 
+def run_mailbox(args):
     # Open shared DB connection
-    conn = sqlite3.connect(DB_FILE)
+    conn = connect(DB_FILE)
 
     # Pass connection to functions that use DB
     init_db(conn)
-    service = gmail_authenticate()
+    creds = get_credentials()
+    service = build_service(creds)
 
-    emails = fetch_top_emails(service)
-    store_emails(emails, conn)
+    # Validates rules.json and records which rule-set version evaluated each email
+    rules_manager = RulesManager(RULES_FILE)
 
-    apply_rules(service, conn)
+    # Each fetch worker gets its own client since the http object isn't thread-safe.
+    with ConcurrentFetcher(lambda: build_service(creds), workers=FETCH_WORKERS) as fetcher:
+        if args.daemon:
+            daemon = Daemon(service, build_service(creds), conn, manager=rules_manager, fetcher=fetcher,
+                            metrics_file=args.metrics)
+            daemon.install_signal_handlers()
+            daemon.run()
+        else:
+            # Incremental sync via historyId, falling back to a full streamed resync.
+            sync_mailbox(service, conn, batch_size=FETCH_BATCH_SIZE, chunk_size=STORE_CHUNK_SIZE, fetcher=fetcher)
+
+    if not args.daemon:
+        apply_rules(service, conn, use_sql=RULES_SQL_PUSHDOWN, workers=RULE_WORKERS, manager=rules_manager)
 
     # Close the shared DB connection at the end
     conn.close()
 
-    logger.info("Processing complete.")
\ No newline at end of file
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Sync a Gmail inbox and apply rules.json to it.")
+    parser.add_argument('--daemon', action='store_true',
+                        help="keep running, syncing and applying rules on a schedule until SIGTERM")
+    parser.add_argument('--accounts', metavar='FILE',
+                        help="process every mailbox listed in FILE once, each with its own token, database and rules")
+    parser.add_argument('--search', metavar='QUERY',
+                        help="search the stored emails instead of syncing, e.g. 'invoice from:amazon'")
+    parser.add_argument('--limit', type=int, default=SEARCH_LIMIT, help="maximum number of search results")
+    parser.add_argument('--metrics', metavar='FILE', default=METRICS_FILE,
+                        help="write run metrics to FILE (.json for JSON, otherwise Prometheus text)")
+    parser.add_argument('--profile', metavar='FILE', default=PROFILE_FILE,
+                        help="run under cProfile and write the stats to FILE")
+    args = parser.parse_args()
+
+    if args.search is not None:
+        run_search(args)
+        raise SystemExit(0)
+
+    logger.info("Starting Gmail processor script...")
+
+    with profiled(args.profile):
+        if args.accounts:
+            run_accounts(args)
+        else:
+            run_mailbox(args)
+    if args.metrics:
+        export(args.metrics)
+
+    logger.info("Processing complete.")
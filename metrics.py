@@ -0,0 +1,145 @@
+import io
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Prefix of every exported metric name
+NAMESPACE = 'gmail_processor'
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+class Metrics:
+    # Thread-safe counters and timers, each identified by a name plus labels
+    # (e.g. api_calls{method="messages.get"}). Timers keep count/sum/max.
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.timers = {}
+
+    def inc(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            count, total, longest = self.timers.get(key, (0, 0.0, 0.0))
+            self.timers[key] = (count + 1, total + seconds, max(longest, seconds))
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.observe(name, self.clock() - start, **labels)
+
+    def counter(self, name, **labels):
+        return self.counters.get(_key(name, labels), 0)
+
+    def timing(self, name, **labels):
+        # (count, total seconds, longest) of a timer
+        return self.timers.get(_key(name, labels), (0, 0.0, 0.0))
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.timers.clear()
+
+    def snapshot(self):
+        with self.lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self.counters.items())]
+            timers = [{'name': name, 'labels': dict(labels), 'count': count, 'sum': total, 'max': longest}
+                      for (name, labels), (count, total, longest) in sorted(self.timers.items())]
+        return {'counters': counters, 'timers': timers}
+
+
+# Shared by every module; main.py exports it at the end of a run
+METRICS = Metrics()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + '}'
+
+
+def to_prometheus(metrics=METRICS):
+    # Prometheus text exposition format: counters as *_total, timers as
+    # summaries in seconds plus a *_seconds_max gauge.
+    snapshot = metrics.snapshot()
+    lines = []
+    declared = set()
+    for counter in snapshot['counters']:
+        name = f"{NAMESPACE}_{counter['name']}_total"
+        if name not in declared:
+            lines.append(f"# TYPE {name} counter")
+            declared.add(name)
+        lines.append(f"{name}{_labels(counter['labels'])} {counter['value']}")
+    for timer in snapshot['timers']:
+        name = f"{NAMESPACE}_{timer['name']}_seconds"
+        if name not in declared:
+            lines.append(f"# TYPE {name} summary")
+            lines.append(f"# TYPE {name}_max gauge")
+            declared.add(name)
+        labels = timer['labels']
+        lines.append(f"{name}_count{_labels(labels)} {timer['count']}")
+        lines.append(f"{name}_sum{_labels(labels)} {timer['sum']:.6f}")
+        lines.append(f"{name}_max{_labels(labels)} {timer['max']:.6f}")
+    return '\n'.join(lines) + '\n'
+
+
+def export(path, metrics=METRICS):
+    # .json files get the raw snapshot, anything else Prometheus text (for
+    # node_exporter's textfile collector, for instance)
+    if str(path).endswith('.json'):
+        content = json.dumps(metrics.snapshot(), indent=2)
+    else:
+        content = to_prometheus(metrics)
+    with open(path, 'w') as f:
+        f.write(content)
+    logger.info(f"Wrote metrics to {path}.")
+
+
+@contextmanager
+def profiled(path=None, top=25):
+    # Optional cProfile around a block: stats go to `path` (for snakeviz or
+    # pstats) and the top functions by cumulative time to the debug log.
+    if not path:
+        yield None
+        return
+    import pstats
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        logger.info(f"Wrote profile to {path}.")
+        if logger.isEnabledFor(logging.DEBUG):
+            # print_stats writes to the stats' stream, stdout unless given one
+            buffer = io.StringIO()
+            pstats.Stats(profiler, stream=buffer).sort_stats('cumulative').print_stats(top)
+            logger.debug(f"Top {top} functions by cumulative time:\n{buffer.getvalue()}")
+
+
+def record_request(method, calls=1):
+    # One HTTP request carrying `calls` API calls (more than one for a batch)
+    METRICS.inc('api_calls', calls, method=method)
+    METRICS.inc('http_requests')
@@ -0,0 +1,77 @@
+import sqlite3
+import logging
+from pathlib import Path
+from datetime import datetime
+from db import MAX_SQL_PARAMS
+from email_rows import EMAIL_COLUMNS, selection_filter, row_to_email, record_rule_metrics
+from rule_engine import compile_rules
+from config import RULE_WORKERS, RULE_CHUNK_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Per-process state set up once by _init_worker
+_worker = {}
+
+
+def database_path(conn):
+    # Workers need the file behind the parent's connection; in-memory
+    # databases can't be shared across processes.
+    for _, name, path in conn.execute("PRAGMA database_list"):
+        if name == 'main':
+            return path or None
+    return None
+
+
+def _init_worker(db_path, raw_rules, now):
+    uri = Path(db_path).resolve().as_uri() + "?mode=ro"
+    _worker['conn'] = sqlite3.connect(uri, uri=True)
+    # Compiled rules hold closures that can't be pickled, so every worker compiles its own copy
+    _worker['rules'] = compile_rules(raw_rules, now=now)
+
+
+def _evaluate_chunk(email_ids):
+    # Returns [(email, [rule positions])]; rule objects themselves can't cross the process boundary
+    conn, rules = _worker['conn'], _worker['rules']
+    position = {id(rule): i for i, rule in enumerate(rules)}
+    matches = []
+    for start in range(0, len(email_ids), MAX_SQL_PARAMS):
+        batch = email_ids[start:start + MAX_SQL_PARAMS]
+        placeholders = ','.join('?' * len(batch))
+        cursor = conn.execute(f"SELECT {EMAIL_COLUMNS} FROM emails WHERE id IN ({placeholders})", batch)
+        for row in cursor:
+            email = row_to_email(row)
+            matched = rules.matching_rules(email)
+            if matched:
+                matches.append((email, [position[id(rule)] for rule in matched]))
+    return matches
+
+
+def find_matches_parallel(conn, raw_rules, rules, workers=RULE_WORKERS, chunk_size=RULE_CHUNK_SIZE, now=None,
+                          scope=None):
+    # Splits the unprocessed ids into chunks evaluated in a process pool, each
+    # worker reading through its own read-only connection. Returns the same
+    # [(email, [rules])] shape as process_rules.find_matches, with `rules`
+    # being the parent's compiled copies.
+    db_path = database_path(conn)
+    if db_path is None:
+        raise ValueError("Parallel rule evaluation needs a file-backed database")
+    now = now or datetime.now()
+    # Readers only see committed data
+    conn.commit()
+
+    where, params = selection_filter(scope)
+    email_ids = [row[0] for row in conn.execute(f"SELECT id FROM emails WHERE {where}", params)]
+    chunks = [email_ids[start:start + chunk_size] for start in range(0, len(email_ids), chunk_size)]
+    logger.info(f"Evaluating {len(email_ids)} emails in {len(chunks)} chunks on {workers} worker processes...")
+
+    rule_list = list(rules)
+    matches = []
+    # Imported here: multiprocessing is only worth loading when workers are used
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(db_path, raw_rules, now)) as executor:
+        for chunk_matches in executor.map(_evaluate_chunk, chunks):
+            matches.extend((email, [rule_list[i] for i in positions]) for email, positions in chunk_matches)
+    # Counters can't be collected from the workers, so they are derived here
+    record_rule_metrics(rule_list, len(email_ids), matches)
+    return matches
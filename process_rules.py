@@ -1,10 +1,22 @@
 import json
-import sqlite3
+import time
 import logging
 from datetime import datetime, timedelta
-from dateutil.parser import parse
-from db import DB_FILE
-from fetch_store_emails import get_or_create_label
+from db import (
+    split_labels, save_rule_set, load_rule_set, rule_set_versions, has_search_index, save_rule_watermarks,
+    load_rule_watermarks
+)
+from label_registry import LabelRegistry
+from unit_of_work import UnitOfWork, PendingAction, recover_pending
+from rule_engine import compile_rules, resolve_field, subtract_months, date_cutoff_ms, CompiledRuleSet, DATE_PREDICATES
+from sql_rules import rule_to_sql
+from email_rows import (
+    EMAIL_COLUMNS, PENDING_FILTER, CHANGED_FILTER, UNCHANGED_FILTER, MAX_ROWID_FILTER, selection_filter, row_to_email,
+    record_rule_metrics
+)
+import parallel_rules
+from metrics import METRICS
+from config import APPLY_BATCH_SIZE, RULE_WORKERS, RULE_CHUNK_SIZE, RULE_TIMING_SAMPLE, RULES_USE_SEARCH_INDEX
 
 logger = logging.getLogger(__name__)
 RULES_FILE = 'rules.json'
@@ -17,7 +29,7 @@ def load_rules():
     return rules
 
 def match_condition(email, condition):
-    field = condition['field'].lower()
+    field = resolve_field(condition['field'])
     predicate = condition['predicate'].lower()
     value = condition['value']
 
@@ -27,17 +39,25 @@ def match_condition(email, condition):
     # For 'received' field, parse date from email
     if field == "received":
         try:
-            # Assuming email['received'] is a string date, parse it
-            email_date = parse(email_val)
+            # internal_date is epoch milliseconds; older rows may hold a date string
+            if isinstance(email_val, int):
+                email_date = datetime.fromtimestamp(email_val / 1000)
+            else:
+                from dateutil.parser import parse
+                email_date = parse(email_val)
         except Exception as e:
             logger.warning(f"Invalid date format in email: {email_val}")
             return False
 
-        # value is number of days (int)
+        # value is number of days or calendar months (int)
         if predicate == "less_than_days":
             return (datetime.now() - email_date) < timedelta(days=int(value))
         elif predicate == "greater_than_days":
             return (datetime.now() - email_date) > timedelta(days=int(value))
+        elif predicate == "less_than_months":
+            return email_date > subtract_months(datetime.now(), int(value))
+        elif predicate == "greater_than_months":
+            return email_date < subtract_months(datetime.now(), int(value))
         else:
             logger.warning(f"Unknown predicate for date: {predicate}")
             return False
@@ -46,6 +66,10 @@ def match_condition(email, condition):
     email_val_lower = str(email_val).lower()
     value_lower = str(value).lower()
 
+    if field == "labels" and predicate in ("equals", "does_not_equal"):
+        # Compared with each label, as the compiled rules do
+        matched = value_lower in email_val_lower.split(',')
+        return matched if predicate == "equals" else not matched
     if predicate == "contains":
         return value_lower in email_val_lower
     elif predicate == "does_not_contain":
@@ -75,80 +99,321 @@ def match_rule(email, rule):
         logger.warning(f"Unknown rule predicate '{rule_predicate}', defaulting to all")
         return all(results)
 
-def apply_rules(service, conn):
-    rules = load_rules()
+def timed_matching_rules(rules, email, weight):
+    # matching_rules with every rule timed separately; the times are scaled by
+    # `weight` (the sampling interval) to estimate the cost over all emails.
+    start = time.perf_counter()
+    view = rules.prepare(email)
+    METRICS.inc('rule_seconds', (time.perf_counter() - start) * weight, rule='(prepare)')
+    matched = []
+    for rule in rules:
+        start = time.perf_counter()
+        if rule.matches_view(view):
+            matched.append(rule)
+        METRICS.inc('rule_seconds', (time.perf_counter() - start) * weight, rule=rule.name)
+    return matched
 
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, sender, subject, snippet, labels, internal_date, is_read, processed FROM emails WHERE is_read=0 AND processed=0")
-    emails = cursor.fetchall()
+def find_matches(conn, rules, scope=None, timing_sample=RULE_TIMING_SAMPLE):
+    # Returns [(email, [matching rules])] for every unprocessed email. One in
+    # `timing_sample` emails has its rule checks timed individually.
+    where, params = selection_filter(scope)
+    cursor = conn.execute(f"SELECT {EMAIL_COLUMNS} FROM emails WHERE {where}", params)
+    matches = []
+    evaluated = 0
+    for row in cursor:
+        email = row_to_email(row)
+        if timing_sample and evaluated % timing_sample == 0:
+            matched = timed_matching_rules(rules, email, timing_sample)
+        else:
+            matched = rules.matching_rules(email)
+        evaluated += 1
+        if matched:
+            matches.append((email, matched))
+    record_rule_metrics(rules, evaluated, matches)
+    return matches
+
+def find_matches_sql(conn, rules, now=None, scope=None, use_index=RULES_USE_SEARCH_INDEX, workers=1,
+                     chunk_size=RULE_CHUNK_SIZE):
+    # One set-based query per rule; rules with conditions SQL can't express
+    # are evaluated in Python over the unprocessed rows instead, on `workers`
+    # processes when there is more than one.
+    now = now or datetime.now()
+    use_index = use_index and has_search_index(conn)
+    base_where, base_params = selection_filter(scope)
+    matches = {}
+    fallback = []
+    # Every rule is evaluated against the same selected rows, as on the Python path
+    evaluated = None
+    for rule in rules:
+        sql = rule_to_sql(rule.source, now, use_index)
+        if sql is None:
+            fallback.append(rule)
+            continue
+        where, params = sql
+        start = time.perf_counter()
+        cursor = conn.execute(f"SELECT {EMAIL_COLUMNS} FROM emails WHERE {base_where} AND ({where})",
+                              base_params + params)
+        hits = 0
+        for row in cursor:
+            matches.setdefault(row[0], (row_to_email(row), []))[1].append(rule)
+            hits += 1
+        METRICS.inc('rule_seconds', time.perf_counter() - start, rule=rule.name)
+        METRICS.inc('rule_hits', hits, rule=rule.name)
+        if evaluated is None:
+            evaluated = conn.execute(f"SELECT COUNT(*) FROM emails WHERE {base_where}", base_params).fetchone()[0]
+        if evaluated:
+            METRICS.inc('rule_evaluations', evaluated, rule=rule.name)
+
+    if fallback:
+        logger.info(f"Evaluating {len(fallback)} rules in Python (not expressible in SQL).")
+        fallback = CompiledRuleSet(fallback)
+        if workers > 1:
+            fallback_matches = parallel_rules.find_matches_parallel(
+                conn, [rule.source for rule in fallback], fallback, workers=workers, chunk_size=chunk_size,
+                now=now, scope=scope)
+        else:
+            fallback_matches = find_matches(conn, fallback, scope)
+        for email, matched in fallback_matches:
+            matches.setdefault(email["id"], (email, []))[1].extend(matched)
+
+    # Keep each email's rules in rule-file order, as the Python path does
+    order = {id(rule): position for position, rule in enumerate(rules)}
+    for email, matched in matches.values():
+        matched.sort(key=lambda rule: order[id(rule)])
+    return list(matches.values())
+
+def rule_label_name(rule):
+    label_name = rule.actions.get('move_to_folder') or rule.actions.get('label')
+    return label_name.strip() if label_name else label_name
+
+def rule_label_changes(registry, rule):
+    add_labels = []
+    remove_labels = []
+
+    # Mark as read/unread action
+    if rule.actions.get('mark_as_read') is True:
+        remove_labels.append("UNREAD")
+    elif rule.actions.get('mark_as_read') is False:
+        add_labels.append("UNREAD")
 
-    logger.info(f"Applying rules to {len(emails)} unread emails...")
+    # Move message (apply label)
+    label_name = rule.actions.get('move_to_folder') or rule.actions.get('label')
+    label_id = None
+    if label_name:
+        label_name = label_name.strip()
+        if label_name:
+            try:
+                label_id = registry.get_or_create(label_name)
+                add_labels.append(label_id)
+            except Exception as e:
+                logger.error(f"Failed to create or get label '{label_name}': {e}")
+        else:
+            logger.warning(f"Skipping empty label name in rule '{rule.name}'")
+    else:
+        logger.debug(f"No label to apply for rule '{rule.name}'")
+
+    return add_labels, remove_labels, label_name, label_id
+
+def merge_label_changes(changes):
+    # Net effect of several rules on one message, later rules winning on conflicts
+    add_labels, remove_labels = [], []
+    for rule_add, rule_remove in changes:
+        for label in rule_add:
+            if label in remove_labels:
+                remove_labels.remove(label)
+            if label not in add_labels:
+                add_labels.append(label)
+        for label in rule_remove:
+            if label in add_labels:
+                add_labels.remove(label)
+            if label not in remove_labels:
+                remove_labels.append(label)
+    return tuple(sorted(add_labels)), tuple(sorted(remove_labels))
+
+def apply_actions(service, conn, matches, registry=None, batch_size=APPLY_BATCH_SIZE, rules_version=None):
+    registry = registry or LabelRegistry(service, conn)
+    rule_changes = {}
+    rule_counts = {}
     processed_count = 0
+    # Per-email lines only at DEBUG; INFO gets one aggregated line per rule
+    log_each = logger.isEnabledFor(logging.DEBUG)
+
+    with UnitOfWork(service, conn, registry, batch_size, rules_version) as uow:
+        for email, matched_rules in matches:
+            original = split_labels(email["labels"])
+            is_read = 0
+            changes = []
+            for rule in matched_rules:
+                # Labels are resolved once per rule, not once per matched email
+                if id(rule) not in rule_changes:
+                    rule_changes[id(rule)] = rule_label_changes(registry, rule)
+                add_labels, remove_labels, label_name, _ = rule_changes[id(rule)]
+                changes.append((add_labels, remove_labels))
 
-    for email in emails:
-        email_id, sender, subject, snippet, labels, internal_date, is_read, processed = email
-        email_dict = {
-            "id": email_id,
-            "sender": sender,
-            "subject": subject,
-            "snippet": snippet,
-            "labels": labels,
-            "received": internal_date  # Add received date for date predicates
-        }
-
-        for rule in rules:
-            if match_rule(email_dict, rule):
-                add_labels = []
-                remove_labels = []
-
-                # Mark as read/unread action
-                if rule['actions'].get('mark_as_read') is True:
-                    remove_labels.append("UNREAD")
-                elif rule['actions'].get('mark_as_read') is False:
-                    add_labels.append("UNREAD")
-
-                # Move message (apply label)
-                label_name = rule['actions'].get('move_to_folder') or rule['actions'].get('label')
-                label_id = None
-                if label_name:
-                    label_name = label_name.strip()
-                    if label_name:
-                        try:
-                            label_id = get_or_create_label(service, label_name)
-                            add_labels.append(label_id)
-                        except Exception as e:
-                            logger.error(f"Failed to create or get label '{label_name}': {e}")
-                    else:
-                        logger.warning(f"Skipping empty label name in rule '{rule['name']}'")
-                else:
-                    logger.debug(f"No label to apply for rule '{rule['name']}'")
-
-                service.users().messages().modify(
-                    userId='me',
-                    id=email_id,
-                    body={
-                        "removeLabelIds": remove_labels,
-                        "addLabelIds": add_labels
-                    }
-                ).execute()
-
-                # Update DB labels string (add label name, remove UNREAD if marked read)
-                new_labels_str = labels
-                if label_name and label_id:
-                    if label_name not in new_labels_str.split(','):
-                        new_labels_str += ',' + label_name
-                if "UNREAD" in new_labels_str and "UNREAD" in remove_labels:
-                    new_labels_str = new_labels_str.replace("UNREAD", "")
-                elif "UNREAD" in add_labels:
-                    if "UNREAD" not in new_labels_str:
-                        new_labels_str += ",UNREAD"
-
-                cursor.execute("""
-                    UPDATE emails SET labels=?, is_read=?, processed=1 WHERE id=?
-                """, (new_labels_str.strip(','), 1 if rule['actions'].get('mark_as_read') else 0, email_id))
-                conn.commit()
-
-                logger.info(f"Email '{subject}' from '{sender}' matched rule '{rule['name']}'. Applied label '{label_name}' and marked as read: {rule['actions'].get('mark_as_read')}.")
+                is_read = 1 if rule.actions.get('mark_as_read') else 0
+                if log_each:
+                    logger.debug(f"Email '{email['subject']}' from '{email['sender']}' matched rule '{rule.name}'. Applied label '{label_name}' and marked as read: {rule.actions.get('mark_as_read')}.")
+                rule_counts.setdefault(id(rule), [rule, 0])[1] += 1
                 processed_count += 1
 
-    logger.info(f"Finished applying rules. Total emails processed: {processed_count}")
\ No newline at end of file
+            # Messages needing the same (addLabelIds, removeLabelIds) share batchModify
+            # calls; changes already in effect (say, on a re-evaluated email) aren't sent
+            add_ids, remove_ids = merge_label_changes(changes)
+            add_ids = tuple(label for label in add_ids if label not in original)
+            remove_ids = tuple(label for label in remove_ids if label in original)
+            uow.add(PendingAction(email["id"], add_ids, remove_ids, is_read))
+
+    for rule, count in rule_counts.values():
+        label_name = rule_changes[id(rule)][2]
+        logger.info(f"Rule '{rule.name}' matched {count} emails. Applied label '{label_name}' and marked as read: {rule.actions.get('mark_as_read')}.")
+    logger.info(f"Modified {uow.applied_count} emails with {uow.group_count} label change groups.")
+    return processed_count
+
+def date_windows(raw_rule, since, now):
+    # internal_date ranges (epoch ms) in which one of the rule's date
+    # conditions changed outcome between the cutoffs at `since` and at `now`
+    windows = []
+    for condition in raw_rule.get('conditions', []):
+        predicate = str(condition['predicate']).lower()
+        if resolve_field(str(condition['field'])) != 'received' or predicate not in DATE_PREDICATES:
+            continue
+        before = date_cutoff_ms(predicate, condition['value'], since)
+        after = date_cutoff_ms(predicate, condition['value'], now)
+        if before != after:
+            windows.append((min(before, after), max(before, after)))
+    return windows
+
+def has_rows(conn, scope):
+    where, params = selection_filter(scope)
+    return conn.execute(f"SELECT 1 FROM emails WHERE {where} LIMIT 1", params).fetchone() is not None
+
+def other_versions(conn, loaded):
+    # Every rule-set version other than the loaded one that emails may carry
+    return [None] + [version for version in rule_set_versions(conn) if version != loaded.version]
+
+def evaluation_scopes(conn, loaded, rules):
+    # The rule scheduler. Pairs groups of unread emails with only the rules
+    # that could give a different answer than last time:
+    #   - emails whose fingerprint changed (or that are new): every rule;
+    #   - unchanged emails last evaluated by another rule-set version: the
+    #     rules that version didn't have;
+    #   - unchanged emails whose date crossed a date rule's cutoff since that
+    #     rule's watermark: that rule.
+    # Each group is an index lookup, so a cycle's cost follows what changed,
+    # not the table size. Rows stored after this point are left for the next run.
+    max_rowid = conn.execute("SELECT coalesce(max(rowid), 0) FROM emails").fetchone()[0]
+    now = loaded.compiled_at
+    scopes = [(rules, (f"{CHANGED_FILTER} AND {MAX_ROWID_FILTER}", [max_rowid]))]
+
+    unchanged = f"{UNCHANGED_FILTER} AND {MAX_ROWID_FILTER}"
+    for version in other_versions(conn, loaded):
+        evaluated = load_rule_set(conn, version) if version is not None else None
+        subset = loaded.rules_to_evaluate(rules, evaluated)
+        if subset:
+            scopes.append((CompiledRuleSet(subset), (f"rules_version IS ? AND {unchanged}", [version, max_rowid])))
+
+    watermarks = load_rule_watermarks(conn, loaded.fingerprints)
+    for rule, fingerprint, dated in zip(rules, loaded.fingerprints, loaded.dated):
+        if not dated:
+            continue
+        since = watermarks.get(fingerprint)
+        if since is None:
+            # Never evaluated with a watermark: check every unchanged email once
+            scopes.append((CompiledRuleSet([rule]), (unchanged, [max_rowid])))
+            continue
+        windows = date_windows(rule.source, since, now)
+        if windows:
+            ranges = " OR ".join("internal_date BETWEEN ? AND ?" for _ in windows)
+            scopes.append((CompiledRuleSet([rule]), (f"({ranges}) AND {unchanged}",
+                                                     [bound for window in windows for bound in window] + [max_rowid])))
+    # Skip the queries for groups that turn out to be empty
+    return [(subset, scope) for subset, scope in scopes if has_rows(conn, scope)], max_rowid
+
+def merge_matches(matches, rules):
+    # One entry per email, its rules deduplicated and in rule-file order, for
+    # emails matched in several scopes
+    order = {id(rule): position for position, rule in enumerate(rules)}
+    merged = {}
+    for email, matched in matches:
+        merged.setdefault(email["id"], (email, {}))[1].update((id(rule), rule) for rule in matched)
+    return [(email, sorted(matched.values(), key=lambda rule: order[id(rule)])) for email, matched in merged.values()]
+
+def mark_evaluated(conn, loaded, max_rowid, matches):
+    # Unmatched queued emails are stamped with the version and their current
+    # fingerprint now; matched ones are stamped by the unit of work once their
+    # actions succeed, so a failed action is retried next run. Date rules
+    # advance their watermark to the cutoffs just used.
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS matched_ids (id TEXT PRIMARY KEY)")
+    conn.execute("DELETE FROM temp.matched_ids")
+    conn.executemany("INSERT OR IGNORE INTO temp.matched_ids (id) VALUES (?)", [(email["id"],) for email, _ in matches])
+    # Changed emails that were already read are stamped too, or they would
+    # linger in idx_emails_changed
+    stamped = [(CHANGED_FILTER, [])] + [(f"{PENDING_FILTER} AND rules_version IS ?", [version])
+                                        for version in other_versions(conn, loaded)]
+    for where, params in stamped:
+        conn.execute(f"""
+            UPDATE emails SET rules_version=?, evaluated_fingerprint=fingerprint
+            WHERE {where} AND {MAX_ROWID_FILTER} AND id NOT IN (SELECT id FROM temp.matched_ids)
+        """, [loaded.version] + params + [max_rowid])
+    conn.commit()
+    save_rule_watermarks(conn, [fingerprint for fingerprint, dated in zip(loaded.fingerprints, loaded.dated) if dated],
+                         loaded.compiled_at)
+
+def find_all_matches(conn, raw_rules, rules, use_sql, workers, chunk_size, now, scope=None):
+    # SQL pushdown takes precedence; with workers > 1 it hands the rules it
+    # can't express to the process pool.
+    if use_sql:
+        return find_matches_sql(conn, rules, now=now, scope=scope, workers=workers, chunk_size=chunk_size)
+    if workers > 1:
+        return parallel_rules.find_matches_parallel(conn, raw_rules, rules, workers=workers,
+                                                    chunk_size=chunk_size, now=now, scope=scope)
+    return find_matches(conn, rules, scope)
+
+def apply_rules(service, conn, use_sql=False, registry=None, workers=RULE_WORKERS, chunk_size=RULE_CHUNK_SIZE,
+                manager=None):
+    # Rules are compiled once per run (or taken from the manager's cache);
+    # match_rule/match_condition remain as the reference interpreter.
+    if manager is not None:
+        loaded = manager.current()
+        rules = loaded.compiled()
+        raw_rules = loaded.raw_rules
+        # The workers must compile with the same date cutoffs as the cached rules
+        now = loaded.compiled_at
+        save_rule_set(conn, loaded.version, loaded.fingerprints)
+    else:
+        loaded = None
+        raw_rules = load_rules()
+        now = datetime.now()
+        rules = compile_rules(raw_rules, now=now)
+
+    # Finish any batch an interrupted run left in the action journal
+    registry = registry or LabelRegistry(service, conn)
+    recover_pending(service, conn, registry)
+
+    # Resolve every label the rules reference up front: at most one labels.list call
+    label_names = {rule_label_name(rule) for rule in rules} - {None, ""}
+    try:
+        registry.resolve_all(sorted(label_names))
+    except Exception as e:
+        logger.error(f"Failed to resolve rule labels: {e}")
+
+    with METRICS.timer('stage', stage='match'):
+        if loaded is None:
+            matches = find_all_matches(conn, raw_rules, rules, use_sql, workers, chunk_size, now)
+        else:
+            # Only emails and rules whose outcome may have changed are evaluated
+            scopes, max_rowid = evaluation_scopes(conn, loaded, rules)
+            matches = []
+            for subset, scope in scopes:
+                matches.extend(find_all_matches(conn, [rule.source for rule in subset], subset, use_sql, workers,
+                                                chunk_size, now, scope))
+            if len(scopes) > 1:
+                matches = merge_matches(matches, rules)
+            mark_evaluated(conn, loaded, max_rowid, matches)
+
+    logger.info(f"Applying rules to {len(matches)} matching unread emails...")
+    with METRICS.timer('stage', stage='apply'):
+        processed_count = apply_actions(service, conn, matches, registry,
+                                        rules_version=loaded.version if loaded is not None else None)
+
+    logger.info(f"Finished applying rules. Total emails processed: {processed_count}")
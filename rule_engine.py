@@ -0,0 +1,249 @@
+import calendar
+import logging
+from itertools import count
+from functools import lru_cache
+from datetime import datetime, timedelta
+from aho_corasick import Automaton
+from db import legacy_date_to_epoch_ms
+
+logger = logging.getLogger(__name__)
+
+# Rule field names that differ from the keys of the email dicts built in apply_rules
+FIELD_ALIASES = {'from': 'sender'}
+
+STRING_PREDICATES = ('contains', 'does_not_contain', 'equals', 'does_not_equal')
+DATE_PREDICATES = ('less_than_days', 'greater_than_days', 'less_than_months', 'greater_than_months')
+SUBSTRING_PREDICATES = ('contains', 'does_not_contain')
+
+# Key of the prepared view holding the ids of every contains/does_not_contain
+# needle found in the email
+HITS = '__contains_hits__'
+
+# Below this many needles per field a plain `in` scan beats the pure-Python
+# automaton on typical subject/sender lengths.
+AUTOMATON_MIN_NEEDLES = 64
+
+
+def resolve_field(field):
+    field = field.lower()
+    return FIELD_ALIASES.get(field, field)
+
+
+def _never(view):
+    return False
+
+
+def _always(view):
+    return True
+
+
+def subtract_months(dt, months):
+    # Calendar months back from dt, clamping the day (Mar 31 - 1 month = Feb 28/29)
+    month_index = dt.year * 12 + dt.month - 1 - months
+    year, month = divmod(month_index, 12)
+    day = min(dt.day, calendar.monthrange(year, month + 1)[1])
+    return dt.replace(year=year, month=month + 1, day=day)
+
+
+def date_cutoff_ms(predicate, value, now):
+    # Epoch milliseconds the email date is compared with. A naive `now` is
+    # local time, matching how the interpreter compares against datetime.now().
+    if predicate.endswith('_months'):
+        cutoff = subtract_months(now, int(value))
+    else:
+        cutoff = now - timedelta(days=int(value))
+    return int(cutoff.timestamp() * 1000)
+
+
+@lru_cache(maxsize=1024)
+def _legacy_epoch_ms(value):
+    return legacy_date_to_epoch_ms(value)
+
+
+def epoch_ms(value):
+    # internal_date is stored as epoch milliseconds straight from the API;
+    # only rows written before the schema migration still hold strings.
+    if isinstance(value, int) or value is None:
+        return value
+    return _legacy_epoch_ms(str(value))
+
+
+def compile_date_condition(key, predicate, value, now):
+    # The cutoff is computed once per compile and the view already holds
+    # epoch milliseconds, so each check is one integer comparison.
+    cutoff = date_cutoff_ms(predicate, value, now)
+    if predicate.startswith('less_than'):
+        def check(view):
+            email_ms = view[key]
+            return email_ms is not None and email_ms > cutoff
+    else:
+        def check(view):
+            email_ms = view[key]
+            return email_ms is not None and email_ms < cutoff
+    return check
+
+
+class ContainsIndex:
+    # Groups every substring needle by field so one pass over each field
+    # returns all the needle ids it contains.
+    def __init__(self, needles, min_automaton_needles=AUTOMATON_MIN_NEEDLES):
+        by_field = {}
+        for needle_id, field, needle in needles:
+            by_field.setdefault(field, []).append((needle_id, needle))
+        self.scanners = {}
+        for field, entries in by_field.items():
+            if len(entries) >= min_automaton_needles:
+                automaton = Automaton()
+                for needle_id, needle in entries:
+                    automaton.add(needle, needle_id)
+                self.scanners[field] = automaton.build().find
+            else:
+                self.scanners[field] = self._linear_scanner(entries)
+
+    @staticmethod
+    def _linear_scanner(entries):
+        return lambda text: {needle_id for needle_id, needle in entries if needle in text}
+
+    def search(self, view):
+        hits = set()
+        for field, scan in self.scanners.items():
+            hits |= scan(view[field])
+        return hits
+
+
+def compile_string_condition(key, predicate, value, needle_id=None):
+    # Checks run against a prepared view whose string fields are already
+    # lowercased and whose substring hits were found by a ContainsIndex.
+    needle = str(value).lower()
+    if predicate == 'contains':
+        if needle_id is None:
+            return lambda view: needle in view[key]
+        return lambda view: needle_id in view[HITS]
+    if predicate == 'does_not_contain':
+        if needle_id is None:
+            return lambda view: needle not in view[key]
+        return lambda view: needle_id not in view[HITS]
+    if key == 'labels':
+        # Compared with each label, not the comma-joined list (whose order
+        # isn't even stable)
+        if predicate == 'equals':
+            return lambda view: needle in view[key].split(',')
+        return lambda view: needle not in view[key].split(',')
+    if predicate == 'equals':
+        return lambda view: view[key] == needle
+    return lambda view: view[key] != needle
+
+
+def compile_condition(condition, now=None, needle_id=None):
+    field = resolve_field(condition['field'])
+    predicate = condition['predicate'].lower()
+    value = condition['value']
+
+    if field == 'received':
+        if predicate not in DATE_PREDICATES:
+            logger.warning(f"Unknown predicate for date: {predicate}")
+            return _never
+        return compile_date_condition(field, predicate, value, now or datetime.now())
+
+    if predicate not in STRING_PREDICATES:
+        logger.warning(f"Unknown predicate '{predicate}' in condition")
+        return _never
+    return compile_string_condition(field, predicate, value, needle_id)
+
+
+def prepare_email(email, string_fields, date_fields):
+    view = {key: str(email.get(key, "")).lower() for key in string_fields}
+    for key in date_fields:
+        view[key] = epoch_ms(email.get(key))
+    return view
+
+
+def _condition_fields(conditions):
+    string_fields, date_fields = set(), set()
+    for condition in conditions:
+        field = resolve_field(condition['field'])
+        (date_fields if field == 'received' else string_fields).add(field)
+    return string_fields, date_fields
+
+
+class CompiledRule:
+    __slots__ = ('name', 'actions', 'conditions', 'match_any', 'string_fields', 'date_fields', 'needles', 'source',
+                 '_index')
+
+    def __init__(self, name, actions, conditions, match_any, string_fields=(), date_fields=(), needles=(),
+                 source=None):
+        self.name = name
+        self.actions = actions
+        self.conditions = conditions
+        self.match_any = match_any
+        self.string_fields = set(string_fields)
+        self.date_fields = set(date_fields)
+        self.needles = list(needles)
+        self.source = source
+        self._index = None
+
+    def matches_view(self, view):
+        # all()/any() over a generator short-circuit on the first decisive condition
+        if self.match_any:
+            return any(check(view) for check in self.conditions)
+        return all(check(view) for check in self.conditions)
+
+    def matches(self, email):
+        if self._index is None:
+            self._index = ContainsIndex(self.needles)
+        view = prepare_email(email, self.string_fields, self.date_fields)
+        view[HITS] = self._index.search(view)
+        return self.matches_view(view)
+
+
+class CompiledRuleSet:
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self.string_fields = set().union(*(rule.string_fields for rule in self.rules))
+        self.date_fields = set().union(*(rule.date_fields for rule in self.rules))
+        self.index = ContainsIndex(needle for rule in self.rules for needle in rule.needles)
+
+    def __iter__(self):
+        return iter(self.rules)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def prepare(self, email):
+        # Each field is lowercased once and scanned once for every rule's needles
+        view = prepare_email(email, self.string_fields, self.date_fields)
+        view[HITS] = self.index.search(view)
+        return view
+
+    def matching_rules(self, email):
+        view = self.prepare(email)
+        return [rule for rule in self.rules if rule.matches_view(view)]
+
+
+def compile_rule(rule, now=None, needle_ids=None):
+    now = now or datetime.now()
+    needle_ids = needle_ids if needle_ids is not None else count()
+    raw_conditions = rule.get('conditions', [])
+    conditions = []
+    needles = []
+    for cond in raw_conditions:
+        needle_id = None
+        if cond['predicate'].lower() in SUBSTRING_PREDICATES and resolve_field(cond['field']) != 'received':
+            needle_id = next(needle_ids)
+            needles.append((needle_id, resolve_field(cond['field']), str(cond['value']).lower()))
+        conditions.append(compile_condition(cond, now, needle_id))
+    rule_predicate = rule.get('predicate', 'All').lower()
+    if rule_predicate not in ('all', 'any'):
+        logger.warning(f"Unknown rule predicate '{rule_predicate}', defaulting to all")
+    if not conditions:
+        conditions = [_always]  # no conditions means match everything
+    string_fields, date_fields = _condition_fields(raw_conditions)
+    return CompiledRule(rule.get('name'), rule.get('actions', {}), conditions, rule_predicate == 'any',
+                        string_fields, date_fields, needles, rule)
+
+
+def compile_rules(rules, now=None):
+    # Needle ids are unique across the whole rule set so one ContainsIndex can serve every rule
+    now = now or datetime.now()
+    needle_ids = count()
+    return CompiledRuleSet(compile_rule(rule, now, needle_ids) for rule in rules)
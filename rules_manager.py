@@ -0,0 +1,176 @@
+import os
+import json
+import hashlib
+import logging
+from datetime import datetime
+from collections import OrderedDict
+from rule_engine import compile_rules, resolve_field, STRING_PREDICATES, DATE_PREDICATES
+from config import RULES_FILE, RULES_RECOMPILE_INTERVAL, RULES_CACHE_SIZE
+
+logger = logging.getLogger(__name__)
+
+# String fields a rule may test (after FIELD_ALIASES); 'received' is the only date field
+STRING_FIELDS = ('sender', 'subject', 'snippet', 'body', 'labels')
+ACTION_KEYS = ('mark_as_read', 'move_to_folder', 'label')
+
+
+class RuleValidationError(ValueError):
+    pass
+
+
+def _validate_condition(where, condition):
+    if not isinstance(condition, dict) or not {'field', 'predicate', 'value'} <= condition.keys():
+        raise RuleValidationError(f"{where}: every condition needs a field, predicate and value")
+    field = resolve_field(str(condition['field']))
+    predicate = str(condition['predicate']).lower()
+    if field == 'received':
+        if predicate not in DATE_PREDICATES:
+            raise RuleValidationError(f"{where}: unknown date predicate '{condition['predicate']}'")
+        if isinstance(condition['value'], bool):
+            raise RuleValidationError(f"{where}: date value must be a whole number")
+        try:
+            int(condition['value'])
+        except (TypeError, ValueError):
+            raise RuleValidationError(f"{where}: date value must be a whole number") from None
+    elif field not in STRING_FIELDS:
+        raise RuleValidationError(f"{where}: unknown field '{condition['field']}'")
+    elif predicate not in STRING_PREDICATES:
+        raise RuleValidationError(f"{where}: unknown predicate '{condition['predicate']}'")
+
+
+def validate_rules(rules):
+    if not isinstance(rules, list):
+        raise RuleValidationError("The rules file must contain a list of rules")
+    for position, rule in enumerate(rules):
+        if not isinstance(rule, dict):
+            raise RuleValidationError(f"rule {position}: must be an object")
+        where = f"rule {position} ({rule.get('name')!r})"
+        if not isinstance(rule.get('name'), str) or not rule['name'].strip():
+            raise RuleValidationError(f"{where}: missing name")
+        if str(rule.get('predicate', 'All')).lower() not in ('all', 'any'):
+            raise RuleValidationError(f"{where}: predicate must be 'all' or 'any'")
+        conditions = rule.get('conditions', [])
+        if not isinstance(conditions, list):
+            raise RuleValidationError(f"{where}: conditions must be a list")
+        for condition in conditions:
+            _validate_condition(where, condition)
+        actions = rule.get('actions', {})
+        if not isinstance(actions, dict):
+            raise RuleValidationError(f"{where}: actions must be an object")
+        unknown = sorted(set(actions) - set(ACTION_KEYS))
+        if unknown:
+            raise RuleValidationError(f"{where}: unknown actions {unknown}")
+        if 'mark_as_read' in actions and not isinstance(actions['mark_as_read'], bool):
+            raise RuleValidationError(f"{where}: mark_as_read must be true or false")
+        for key in ('move_to_folder', 'label'):
+            if key in actions and not isinstance(actions[key], str):
+                raise RuleValidationError(f"{where}: {key} must be a label name")
+    return rules
+
+
+def parse_rules(content):
+    try:
+        rules = json.loads(content)
+    except ValueError as e:
+        raise RuleValidationError(f"Invalid JSON: {e}") from e
+    return validate_rules(rules)
+
+
+def content_version(content):
+    return hashlib.sha256(content).hexdigest()[:16]
+
+
+def rule_fingerprint(rule):
+    # Stable across formatting-only edits of the file
+    return hashlib.sha256(json.dumps(rule, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def has_date_conditions(rule):
+    # Such rules can start or stop matching an unchanged email as the clock moves
+    return any(resolve_field(str(c['field'])) == 'received' for c in rule.get('conditions', []))
+
+
+class LoadedRules:
+    # One validated version of the rules file plus its compiled form
+    def __init__(self, version, raw_rules, recompile_interval=RULES_RECOMPILE_INTERVAL):
+        self.version = version
+        self.raw_rules = raw_rules
+        self.fingerprints = [rule_fingerprint(rule) for rule in raw_rules]
+        self.dated = [has_date_conditions(rule) for rule in raw_rules]
+        self.has_dates = any(self.dated)
+        self.recompile_interval = recompile_interval
+        self.compiled_at = None
+        self._compiled = None
+
+    def __len__(self):
+        return len(self.raw_rules)
+
+    def compiled(self, now=None):
+        # Rule sets without date conditions never go stale; the others are
+        # recompiled once their cutoffs are recompile_interval old.
+        now = now or datetime.now()
+        if (self._compiled is None or
+                (self.has_dates and abs((now - self.compiled_at).total_seconds()) >= self.recompile_interval)):
+            self._compiled = compile_rules(self.raw_rules, now=now)
+            self.compiled_at = now
+        return self._compiled
+
+    def rules_to_evaluate(self, rules, evaluated_fingerprints):
+        # Compiled rules an email still has to be checked against, given the
+        # fingerprints of the rule set that last evaluated it (None: never
+        # evaluated, or by a version this database doesn't know).
+        return [rule for rule, fingerprint in zip(rules, self.fingerprints)
+                if evaluated_fingerprints is None or fingerprint not in evaluated_fingerprints]
+
+
+class RulesManager:
+    # Watches the rules file's mtime and size; an edit is validated and, if it
+    # is valid, becomes the current rule set without a restart. Invalid edits
+    # are logged and the previous rule set stays in use.
+    def __init__(self, path=RULES_FILE, cache_size=RULES_CACHE_SIZE, recompile_interval=RULES_RECOMPILE_INTERVAL):
+        self.path = path
+        self.cache_size = cache_size
+        self.recompile_interval = recompile_interval
+        self.loaded = None
+        self._stat = None
+        self._cache = OrderedDict()
+
+    def _file_stat(self):
+        stat = os.stat(self.path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def _load(self, content):
+        version = content_version(content)
+        if version in self._cache:
+            self._cache.move_to_end(version)
+            return self._cache[version]
+        loaded = LoadedRules(version, parse_rules(content), self.recompile_interval)
+        self._cache[version] = loaded
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return loaded
+
+    def reload_if_changed(self):
+        # Returns True when a different rule set became current
+        stat = self._file_stat()
+        if self.loaded is not None and stat == self._stat:
+            return False
+        with open(self.path, 'rb') as f:
+            content = f.read()
+        self._stat = stat
+        try:
+            loaded = self._load(content)
+        except RuleValidationError as e:
+            if self.loaded is None:
+                raise RuleValidationError(f"{self.path}: {e}") from e
+            logger.error(f"Ignoring invalid edit of {self.path}, keeping rule set {self.loaded.version}: {e}")
+            return False
+        if self.loaded is not None and loaded.version == self.loaded.version:
+            return False
+        self.loaded = loaded
+        logger.info(f"Loaded rule set {loaded.version} ({len(loaded)} rules) from {self.path}.")
+        return True
+
+    def current(self):
+        self.reload_if_changed()
+        return self.loaded
@@ -0,0 +1,83 @@
+import re
+import logging
+from datetime import datetime
+from db import SEARCH_TABLE, SEARCH_COLUMNS, SEARCH_MIN_TERM, has_search_index
+from rule_engine import resolve_field
+from sql_rules import escape_like, fts_phrase
+from config import SEARCH_LIMIT
+
+logger = logging.getLogger(__name__)
+
+# bm25() weight of each indexed column, in SEARCH_COLUMNS order: a hit in the
+# sender or subject outranks one in the snippet or body
+SEARCH_WEIGHTS = (4.0, 3.0, 1.5, 1.0)
+
+# A term is a word or a "quoted phrase", optionally restricted to one field
+# (from:linkedin, subject:"job alert"). Terms match anywhere inside a word,
+# so `pay` (or `pay*`) also finds "payment".
+TERM_PATTERN = re.compile(r'(?:(\w+):)?(?:"([^"]*)"|(\S+))')
+
+
+class SearchError(Exception):
+    pass
+
+
+def parse_query(query):
+    # Returns [(column or None for every column, text)]
+    terms = []
+    for match in TERM_PATTERN.finditer(query):
+        field, phrase, word = match.groups()
+        column = resolve_field(field) if field else None
+        if column is not None and column not in SEARCH_COLUMNS:
+            # Not a field prefix after all (an URL, for instance): search the whole token
+            column, phrase, word = None, None, match.group(0)
+        text = phrase if phrase is not None else word.rstrip('*')
+        if text.strip():
+            terms.append((column, text.lower()))
+    return terms
+
+
+def build_search_sql(terms):
+    # Terms long enough for the trigram index go into one MATCH expression;
+    # shorter ones are checked with LIKE on the rows it returns.
+    phrases, filters, params = [], [], []
+    for column, text in terms:
+        if len(text) >= SEARCH_MIN_TERM:
+            phrases.append(fts_phrase(column, text))
+        else:
+            columns = [column] if column else SEARCH_COLUMNS
+            filters.append('(' + ' OR '.join(f"{SEARCH_TABLE}.{c} LIKE ? ESCAPE '\\'" for c in columns) + ')')
+            params.extend([f"%{escape_like(text)}%"] * len(columns))
+    if phrases:
+        filters.insert(0, f"{SEARCH_TABLE} MATCH ?")
+        params.insert(0, ' AND '.join(phrases))
+    return ' AND '.join(filters), params, bool(phrases)
+
+
+def search(conn, query, limit=SEARCH_LIMIT, offset=0):
+    # Best matches first (by bm25, then newest); without any indexable term
+    # the results are just the newest matching emails.
+    if not has_search_index(conn):
+        raise SearchError("The search index is disabled (config.SEARCH_INDEX) or unsupported by this SQLite build.")
+    terms = parse_query(query)
+    if not terms:
+        return []
+    where, params, ranked = build_search_sql(terms)
+    weights = ', '.join(str(weight) for weight in SEARCH_WEIGHTS)
+    score = f"-bm25({SEARCH_TABLE}, {weights})" if ranked else "0.0"
+    rows = conn.execute(f"""
+        SELECT emails.id, emails.sender, emails.subject, emails.snippet, emails.internal_date, {score} AS score
+        FROM {SEARCH_TABLE} JOIN emails ON emails.rowid = {SEARCH_TABLE}.rowid
+        WHERE {where}
+        ORDER BY score DESC, emails.internal_date DESC
+        LIMIT ? OFFSET ?
+    """, params + [limit, offset]).fetchall()
+    logger.debug(f"Search '{query}' returned {len(rows)} results.")
+    return [{'id': email_id, 'sender': sender, 'subject': subject, 'snippet': snippet,
+             'internal_date': internal_date, 'score': score}
+            for email_id, sender, subject, snippet, internal_date, score in rows]
+
+
+def format_result(result):
+    received = datetime.fromtimestamp(result['internal_date'] / 1000).strftime('%Y-%m-%d %H:%M')
+    return f"{received}  {result['sender'][:40]:40}  {result['subject']}"
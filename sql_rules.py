@@ -0,0 +1,104 @@
+import logging
+from datetime import datetime
+from rule_engine import resolve_field, date_cutoff_ms, DATE_PREDICATES, STRING_PREDICATES, SUBSTRING_PREDICATES
+from db import SEARCH_TABLE, SEARCH_MIN_TERM
+
+logger = logging.getLogger(__name__)
+
+# Email fields that map straight onto columns of the emails table
+SQL_COLUMNS = {'sender': 'sender', 'subject': 'subject', 'snippet': 'snippet', 'body': 'body'}
+# Labels live in email_labels, one row per label: a condition on them is a
+# lookup through its (email_id, label) primary key for each candidate email
+LABEL_EXISTS = "EXISTS (SELECT 1 FROM email_labels WHERE email_id = emails.id AND {})"
+
+
+class UnsupportedCondition(Exception):
+    pass
+
+
+def escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def fts_phrase(column, text):
+    # Quoted FTS5 phrase, restricted to `column` unless it's None; with the
+    # trigram tokenizer a phrase matches anywhere in the text, like LIKE '%text%'
+    phrase = '"' + text.replace('"', '""') + '"'
+    return f"{column} : {phrase}" if column else phrase
+
+
+def label_condition_to_sql(condition, predicate, needle):
+    # Matches any one of the email's labels, as the Python path does. That
+    # path sees the labels comma-joined, so needles that could span two labels
+    # (or match an email without any) stay there.
+    if not needle or ',' in needle:
+        raise UnsupportedCondition(condition)
+    if predicate in SUBSTRING_PREDICATES:
+        clause, params = LABEL_EXISTS.format("lower(label) LIKE ? ESCAPE '\\'"), [f"%{escape_like(needle)}%"]
+    else:
+        clause, params = LABEL_EXISTS.format("lower(label) = ?"), [needle]
+    if predicate in ('does_not_contain', 'does_not_equal'):
+        clause = f"NOT {clause}"
+    return clause, params
+
+
+def condition_to_sql(condition, now, use_index=False):
+    field = resolve_field(condition['field'])
+    predicate = condition['predicate'].lower()
+    value = condition['value']
+
+    if field == 'received':
+        if predicate not in DATE_PREDICATES:
+            return "0", []
+        # internal_date is epoch milliseconds, so date rules are plain range lookups
+        cutoff = date_cutoff_ms(predicate, value, now)
+        if predicate.startswith('less_than'):
+            return "internal_date > ?", [cutoff]
+        return "internal_date < ?", [cutoff]
+
+    if predicate not in STRING_PREDICATES:
+        return "0", []
+    needle = str(value).lower()
+    # SQLite only folds ASCII case, so anything else has to be matched in Python
+    if not needle.isascii():
+        raise UnsupportedCondition(condition)
+    if field == 'labels':
+        return label_condition_to_sql(condition, predicate, needle)
+    column = SQL_COLUMNS.get(field)
+    if column is None:
+        raise UnsupportedCondition(condition)
+
+    if use_index and predicate in SUBSTRING_PREDICATES and len(needle) >= SEARCH_MIN_TERM:
+        negate = "NOT " if predicate == 'does_not_contain' else ""
+        return (f"rowid {negate}IN (SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH ?)",
+                [fts_phrase(column, needle)])
+
+    column_expr = f"lower(coalesce({column}, ''))"
+    if predicate == 'contains':
+        return f"{column_expr} LIKE ? ESCAPE '\\'", [f"%{escape_like(needle)}%"]
+    if predicate == 'does_not_contain':
+        return f"{column_expr} NOT LIKE ? ESCAPE '\\'", [f"%{escape_like(needle)}%"]
+    if predicate == 'equals':
+        return f"{column_expr} = ?", [needle]
+    return f"{column_expr} != ?", [needle]
+
+
+def rule_to_sql(rule, now=None, use_index=False):
+    # Returns (where_clause, params), or None when some condition can only be
+    # evaluated in Python. use_index looks substring conditions up in the
+    # full-text index instead of scanning with LIKE.
+    now = now or datetime.now()
+    conditions = rule.get('conditions', [])
+    if not conditions:
+        return "1", []
+    clauses, params = [], []
+    try:
+        for condition in conditions:
+            clause, clause_params = condition_to_sql(condition, now, use_index)
+            clauses.append(f"({clause})")
+            params.extend(clause_params)
+    except UnsupportedCondition as e:
+        logger.debug(f"Rule '{rule.get('name')}' falls back to Python evaluation: {e}")
+        return None
+    joiner = " OR " if rule.get('predicate', 'All').lower() == 'any' else " AND "
+    return joiner.join(clauses), params
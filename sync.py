@@ -0,0 +1,135 @@
+import logging
+from itertools import islice
+from googleapiclient.errors import HttpError
+from db import store_emails, update_email_labels, get_sync_state, set_sync_state
+from fetch_store_emails import iter_inbox_emails, fetch_messages
+from metrics import record_request
+from config import FETCH_BATCH_SIZE, LIST_PAGE_SIZE, STORE_CHUNK_SIZE, FETCH_PROFILE
+
+logger = logging.getLogger(__name__)
+
+HISTORY_ID_KEY = 'history_id'
+HISTORY_TYPES = ['messageAdded', 'labelAdded', 'labelRemoved']
+
+# Kinds of the (kind, payload) events produced by iter_sync
+NEW_EMAILS = 'new_emails'
+CHANGED_EMAILS = 'changed_emails'
+HISTORY_ID = 'history_id'
+
+
+class HistoryExpiredError(Exception):
+    pass
+
+
+def iter_full_sync(service, batch_size=FETCH_BATCH_SIZE, chunk_size=STORE_CHUNK_SIZE, fetcher=None,
+                   profile=FETCH_PROFILE):
+    # Read the history id before listing so changes made during the listing
+    # are picked up by the next incremental sync.
+    record_request('getProfile')
+    history_id = service.users().getProfile(userId='me').execute()['historyId']
+    logger.info(f"Running full sync (history id {history_id})...")
+    emails = iter_inbox_emails(service, batch_size=batch_size, fetcher=fetcher, profile=profile)
+    while True:
+        chunk = list(islice(emails, chunk_size))
+        if not chunk:
+            break
+        yield (NEW_EMAILS, chunk)
+    yield (HISTORY_ID, history_id)
+
+
+def list_history_changes(service, start_history_id, page_size=LIST_PAGE_SIZE):
+    # Returns (changed message ids, latest history id)
+    changed = {}
+    latest_history_id = start_history_id
+    page_token = None
+    while True:
+        request = {
+            'userId': 'me',
+            'startHistoryId': start_history_id,
+            'historyTypes': HISTORY_TYPES,
+            'labelId': 'INBOX',
+            'maxResults': page_size,
+        }
+        if page_token:
+            request['pageToken'] = page_token
+        try:
+            record_request('history.list')
+            results = service.users().history().list(**request).execute()
+        except HttpError as e:
+            if e.resp.status == 404:
+                raise HistoryExpiredError(start_history_id) from e
+            raise
+        for record in results.get('history', []):
+            for key in ('messagesAdded', 'labelsAdded', 'labelsRemoved'):
+                for item in record.get(key, []):
+                    changed[item['message']['id']] = True
+        latest_history_id = results.get('historyId', latest_history_id)
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return list(changed), latest_history_id
+
+
+def iter_incremental_sync(service, start_history_id, batch_size=FETCH_BATCH_SIZE, chunk_size=STORE_CHUNK_SIZE,
+                          fetcher=None, profile=FETCH_PROFILE):
+    message_ids, latest_history_id = list_history_changes(service, start_history_id)
+    logger.info(f"Incremental sync from history id {start_history_id}: {len(message_ids)} changed messages.")
+
+    # Fetched a chunk at a time, so storing one chunk overlaps fetching the
+    # next and a large history (say, after a big rules run) isn't held in memory
+    for start in range(0, len(message_ids), chunk_size):
+        emails = fetch_messages(service, message_ids[start:start + chunk_size], batch_size=batch_size,
+                                fetcher=fetcher, profile=profile)
+        if emails:
+            yield (CHANGED_EMAILS, emails)
+    yield (HISTORY_ID, latest_history_id)
+
+
+def iter_sync(service, start_history_id, batch_size=FETCH_BATCH_SIZE, chunk_size=STORE_CHUNK_SIZE, fetcher=None,
+              profile=FETCH_PROFILE):
+    # The Gmail side of a sync as a stream of events for store_sync_event. It
+    # touches no database, so it can run on another thread than the writer.
+    if start_history_id is not None:
+        try:
+            events = iter_incremental_sync(service, start_history_id, batch_size, chunk_size, fetcher, profile)
+            first = next(events)
+        except HistoryExpiredError:
+            logger.warning(f"History id {start_history_id} has expired, falling back to full resync.")
+        else:
+            yield first
+            yield from events
+            return
+    yield from iter_full_sync(service, batch_size, chunk_size, fetcher, profile)
+
+
+def store_sync_event(conn, event):
+    # Returns the number of newly stored emails
+    kind, payload = event
+    if kind == HISTORY_ID:
+        set_sync_state(conn, HISTORY_ID_KEY, payload)
+        return 0
+    count = store_emails(payload, conn, chunk_size=len(payload))
+    if kind == CHANGED_EMAILS:
+        # Emails that were already stored only need their labels refreshed
+        update_email_labels(payload, conn)
+    return count
+
+
+def store_sync_events(conn, events):
+    return sum(store_sync_event(conn, event) for event in events)
+
+
+def full_sync(service, conn, batch_size=FETCH_BATCH_SIZE, chunk_size=STORE_CHUNK_SIZE, fetcher=None,
+              profile=FETCH_PROFILE):
+    return store_sync_events(conn, iter_full_sync(service, batch_size, chunk_size, fetcher, profile))
+
+
+def incremental_sync(service, conn, start_history_id, batch_size=FETCH_BATCH_SIZE, chunk_size=STORE_CHUNK_SIZE,
+                     fetcher=None, profile=FETCH_PROFILE):
+    return store_sync_events(conn, iter_incremental_sync(service, start_history_id, batch_size, chunk_size,
+                                                         fetcher, profile))
+
+
+def sync_mailbox(service, conn, batch_size=FETCH_BATCH_SIZE, chunk_size=STORE_CHUNK_SIZE, fetcher=None,
+                 profile=FETCH_PROFILE):
+    start_history_id = get_sync_state(conn, HISTORY_ID_KEY)
+    return store_sync_events(conn, iter_sync(service, start_history_id, batch_size, chunk_size, fetcher, profile))
@@ -0,0 +1,118 @@
+import json
+import threading
+import pytest
+from unittest.mock import patch
+from accounts import Account, AccountConfigError, MultiAccountRunner, load_accounts
+
+
+class FakeContext:
+    # Records the order steps run in and how many of its steps overlap
+    log = []
+    lock = threading.Lock()
+
+    def __init__(self, account):
+        self.name = account.name
+        self.steps_left = account.steps
+        self.running = 0
+        self.max_running = 0
+        self.error = None
+
+    def steps(self):
+        for _ in range(self.steps_left):
+            with self.lock:
+                self.running += 1
+                self.max_running = max(self.max_running, self.running)
+                FakeContext.log.append(self.name)
+            if self.name == "broken":
+                raise RuntimeError("token revoked")
+            with self.lock:
+                self.running -= 1
+            yield
+
+    def summary(self):
+        return {'account': self.name, 'stored': 0, 'quota_units': 0, 'error': str(self.error) if self.error else None}
+
+    def close(self):
+        pass
+
+
+class StepAccount:
+    def __init__(self, name, steps):
+        self.name = name
+        self.steps = steps
+
+
+@pytest.fixture(autouse=True)
+def clear_log():
+    FakeContext.log = []
+
+
+def test_load_accounts_fills_defaults(tmp_path):
+    path = tmp_path / "accounts.json"
+    path.write_text(json.dumps([{"name": "support"}, {"name": "sales", "db_file": "sales.db", "rules_file": "s.json"}]))
+
+    support, sales = load_accounts(str(path))
+
+    assert (support.token_file, support.db_file) == ("token_support.json", "emails_support.db")
+    assert (sales.db_file, sales.rules_file) == ("sales.db", "s.json")
+
+
+@pytest.mark.parametrize("entries, message", [
+    ([{"name": "a", "db_file": "x.db"}, {"name": "b", "db_file": "x.db"}], "db_file"),
+    ([{"name": "a"}, {"name": "a"}], "name"),
+    ([{"name": "a", "password": "x"}], "unknown keys"),
+    ([{"db_file": "x.db"}], "missing name"),
+])
+def test_load_accounts_rejects_bad_entries(tmp_path, entries, message):
+    path = tmp_path / "accounts.json"
+    path.write_text(json.dumps(entries))
+
+    with pytest.raises(AccountConfigError, match=message):
+        load_accounts(str(path))
+
+
+def test_runner_round_robins_so_large_mailbox_cannot_starve_others():
+    runner = MultiAccountRunner([StepAccount("big", 6), StepAccount("a", 2), StepAccount("b", 2)], workers=1,
+                                context_factory=FakeContext)
+
+    runner.run_once()
+
+    assert FakeContext.log == ["big", "a", "b", "big", "a", "b", "big", "big", "big", "big"]
+
+
+def test_runner_never_runs_two_steps_of_one_account_at_once():
+    runner = MultiAccountRunner([StepAccount("big", 50), StepAccount("small", 3)], workers=4,
+                                context_factory=FakeContext)
+
+    runner.run_once()
+
+    assert FakeContext.log.count("big") == 50
+    assert all(context.max_running == 1 for context in runner.contexts)
+
+
+def test_runner_isolates_failing_account():
+    runner = MultiAccountRunner([StepAccount("broken", 3), StepAccount("ok", 3)], workers=2,
+                                context_factory=FakeContext)
+
+    summaries = runner.run_once()
+
+    assert FakeContext.log.count("ok") == 3
+    assert FakeContext.log.count("broken") == 1
+    assert summaries[0]['error'] == "token revoked"
+    assert summaries[1]['error'] is None
+
+
+def test_account_defaults_use_name():
+    account = Account("ops")
+    assert (account.token_file, account.db_file) == ("token_ops.json", "emails_ops.db")
+
+
+@patch("fetch_store_emails.InstalledAppFlow")
+def test_account_without_token_fails_instead_of_blocking_a_worker(mock_flow, tmp_path):
+    account = Account("new", token_file=str(tmp_path / "token_new.json"), db_file=str(tmp_path / "emails_new.db"))
+
+    with MultiAccountRunner([account], workers=2) as runner:
+        summaries = runner.run_once()
+
+    mock_flow.from_client_secrets_file.assert_not_called()
+    assert "token_new.json" in summaries[0]['error']
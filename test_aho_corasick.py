@@ -0,0 +1,43 @@
+import random
+from aho_corasick import Automaton
+
+
+def naive_find(patterns, text):
+    return {i for i, p in enumerate(patterns) if p in text}
+
+
+def build(patterns):
+    automaton = Automaton()
+    for i, pattern in enumerate(patterns):
+        automaton.add(pattern, i)
+    return automaton.build()
+
+
+def test_find_overlapping_patterns():
+    patterns = ["he", "she", "his", "hers"]
+    assert build(patterns).find("ushers") == {0, 1, 3}
+
+
+def test_find_returns_nothing_for_unrelated_text():
+    assert build(["offer", "sale"]).find("meeting notes") == set()
+
+
+def test_empty_pattern_matches_every_text():
+    assert build(["", "abc"]).find("xyz") == {0}
+
+
+def test_same_pattern_can_carry_several_values():
+    automaton = Automaton()
+    automaton.add("job", "rule1")
+    automaton.add("job", "rule2")
+    assert automaton.find("new jobs") == {"rule1", "rule2"}
+
+
+def test_matches_naive_search_on_random_input():
+    rng = random.Random(3)
+    for _ in range(50):
+        patterns = [''.join(rng.choice("abc") for _ in range(rng.randint(1, 4))) for _ in range(20)]
+        automaton = build(patterns)
+        for _ in range(20):
+            text = ''.join(rng.choice("abcd") for _ in range(rng.randint(0, 30)))
+            assert automaton.find(text) == naive_find(patterns, text)
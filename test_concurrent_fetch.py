@@ -0,0 +1,197 @@
+import time
+import threading
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+from gmail_simulator import SimulatedMailbox
+from concurrent_fetch import TokenBucket, ConcurrentFetcher, fetch_messages_concurrent
+
+
+def make_message(msg_id):
+    return {
+        'id': msg_id,
+        'payload': {'headers': [{'name': 'From', 'value': 'a@example.com'}, {'name': 'Subject', 'value': msg_id}]},
+        'snippet': '',
+        'labelIds': ['INBOX'],
+        'internalDate': '1691664000000'
+    }
+
+
+class LatencyRequest:
+    def __init__(self, service, msg_id):
+        self.service = service
+        self.msg_id = msg_id
+
+    def execute(self):
+        self.service.calls += 1
+        if self.service.tracker is not None:
+            self.service.tracker.wait_for_overlap()
+        time.sleep(self.service.latency)
+        if self.service.rate_limited.pop(self.msg_id, None):
+            raise HttpError(httplib2.Response({'status': 429}), b'rate limited')
+        return make_message(self.msg_id)
+
+
+class LatencyService:
+    # Fake Gmail client that sleeps on every call and records which thread built it
+
+    def __init__(self, latency=0.02, rate_limited=(), tracker=None):
+        self.latency = latency
+        self.tracker = tracker
+        self.rate_limited = dict.fromkeys(rate_limited, True)
+        self.calls = 0
+        self.thread = threading.get_ident()
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def get(self, userId, id, **params):
+        return LatencyRequest(self, id)
+
+
+class OverlapTracker:
+    # Shared by the services of every worker: records the most calls in
+    # flight at once. With a target, each call waits (up to a timeout) until
+    # that many overlap, so the peak doesn't depend on thread scheduling.
+    def __init__(self, target=None):
+        self.target = target
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.peak = 0
+        self.reached = threading.Event()
+
+    def wait_for_overlap(self):
+        with self.lock:
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+            if self.target and self.peak >= self.target:
+                self.reached.set()
+        if self.target:
+            self.reached.wait(5)
+        with self.lock:
+            self.in_flight -= 1
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def unlimited():
+    return TokenBucket(rate=1e9)
+
+
+def test_token_bucket_waits_for_refill():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=10, capacity=10, clock=clock, sleep=clock.sleep)
+
+    bucket.acquire(10)
+    bucket.acquire(5)
+
+    assert clock.sleeps == [0.5]
+
+
+def test_token_bucket_charges_full_cost_of_large_batches():
+    clock = FakeClock()
+    limiter = TokenBucket(rate=250, clock=clock, sleep=clock.sleep)
+    mailbox = SimulatedMailbox(size=200)
+    ids = [mailbox.message_id(i) for i in range(200)]
+
+    with ConcurrentFetcher(mailbox.service, workers=0, rate_limiter=limiter) as fetcher:
+        emails = fetcher.fetch(ids, batch_size=100)
+
+    assert len(emails) == 200
+    # Two 500-unit batches against a 250-unit bucket: only the first 250 units
+    # were already there, the other 750 take three seconds to refill
+    assert limiter.consumed == 1000
+    assert sum(clock.sleeps) == pytest.approx(3.0)
+
+
+def test_token_bucket_backoff_halves_rate_once_per_cooldown():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=100, clock=clock, sleep=clock.sleep, cooldown=1.0)
+
+    bucket.backoff()
+    bucket.backoff()
+    assert bucket.rate == 50
+    assert bucket.tokens == 0
+
+    clock.now += 2
+    bucket.backoff()
+    assert bucket.rate == 25
+
+    for _ in range(100):
+        bucket.recover()
+    assert bucket.rate == 100
+
+
+def test_concurrent_fetch_overlaps_calls_across_workers():
+    ids = [f'm{i}' for i in range(40)]
+
+    sequential = OverlapTracker()
+    fetch_messages_concurrent(lambda: LatencyService(latency=0, tracker=sequential), ids, workers=1,
+                              rate_limiter=unlimited())
+
+    concurrent = OverlapTracker(target=8)
+    emails = fetch_messages_concurrent(lambda: LatencyService(latency=0, tracker=concurrent), ids, workers=8,
+                                       rate_limiter=unlimited())
+
+    assert [e['id'] for e in emails] == ids
+    assert sequential.peak == 1
+    assert concurrent.peak == 8
+
+
+def test_concurrent_fetch_builds_one_service_per_worker():
+    services = []
+    lock = threading.Lock()
+
+    def factory():
+        service = LatencyService(latency=0.005)
+        with lock:
+            services.append(service)
+        return service
+
+    with ConcurrentFetcher(factory, workers=4, rate_limiter=unlimited()) as fetcher:
+        fetcher.fetch([f'm{i}' for i in range(40)])
+
+    assert 1 <= len(services) <= 4
+    assert len({s.thread for s in services}) == len(services)
+    assert sum(s.calls for s in services) == 40
+
+
+def test_concurrent_fetch_backs_off_and_retries_rate_limited_messages():
+    service = LatencyService(latency=0, rate_limited=['m2'])
+    limiter = TokenBucket(rate=1000)
+
+    emails = fetch_messages_concurrent(lambda: service, ['m1', 'm2', 'm3'], workers=1, rate_limiter=limiter)
+
+    assert [e['id'] for e in emails] == ['m1', 'm2', 'm3']
+    assert service.calls == 4
+    assert limiter.rate < 1000
+
+
+def test_serial_fetcher_uses_calling_thread_and_tracks_quota():
+    services = []
+
+    def factory():
+        services.append(LatencyService(latency=0))
+        return services[-1]
+
+    limiter = unlimited()
+    with ConcurrentFetcher(factory, workers=0, rate_limiter=limiter) as fetcher:
+        emails = fetcher.fetch([f'm{i}' for i in range(5)])
+
+    assert [e['id'] for e in emails] == [f'm{i}' for i in range(5)]
+    assert len(services) == 1 and services[0].thread == threading.get_ident()
+    assert limiter.consumed == 5 * 5
@@ -0,0 +1,124 @@
+import sqlite3
+import threading
+import pytest
+from unittest.mock import patch, MagicMock
+from db import init_db, get_sync_state, set_sync_state
+from sync import store_sync_event, NEW_EMAILS, HISTORY_ID, HISTORY_ID_KEY
+import daemon
+from daemon import Daemon, jittered
+
+
+def make_email(email_id):
+    return {"id": email_id, "sender": "a@x.com", "subject": "Hi", "snippet": "", "labels": ["INBOX", "UNREAD"],
+            "internal_date": 1754827200000}
+
+
+@pytest.fixture
+def conn():
+    # The daemon's writer is the test's main thread; only the fetch thread runs elsewhere
+    conn = sqlite3.connect(":memory:")
+    init_db(conn=conn)
+    yield conn
+    conn.close()
+
+
+def test_jittered_stays_within_bounds():
+    assert jittered(100, 0.1, rng=lambda: 0.0) == pytest.approx(90)
+    assert jittered(100, 0.1, rng=lambda: 1.0) == pytest.approx(110)
+    assert jittered(100, 0, rng=lambda: 0.3) == 100
+
+
+def test_daemon_stores_chunks_and_keeps_state_between_cycles(conn):
+    set_sync_state(conn, HISTORY_ID_KEY, '10')
+    start_ids = []
+    cycles = [
+        [(NEW_EMAILS, [make_email("e1"), make_email("e2")]), (NEW_EMAILS, [make_email("e3")]), (HISTORY_ID, '20')],
+        [(HISTORY_ID, '30')],
+    ]
+
+    second_cycle_stored = threading.Event()
+
+    def fake_iter_sync(service, start_history_id, *args):
+        start_ids.append(start_history_id)
+        if len(start_ids) > len(cycles):
+            # Stop once the writer is done with both cycles
+            second_cycle_stored.wait(5)
+            runner.stop()
+            return
+        yield from cycles[len(start_ids) - 1]
+
+    def fake_store_sync_event(conn, event):
+        count = store_sync_event(conn, event)
+        if event == (HISTORY_ID, '30'):
+            second_cycle_stored.set()
+        return count
+
+    rule_calls = []
+
+    def fake_apply_rules(service, conn, **kwargs):
+        rule_calls.append((conn.execute("SELECT COUNT(*) FROM emails").fetchone()[0], kwargs))
+
+    runner = Daemon(MagicMock(), MagicMock(), conn, manager=MagicMock(), registry=MagicMock(),
+                    sync_interval=0, rules_interval=3600, queue_size=1)
+    with patch("daemon.iter_sync", side_effect=fake_iter_sync), \
+            patch("daemon.store_sync_event", side_effect=fake_store_sync_event), \
+            patch("daemon.apply_rules", side_effect=fake_apply_rules):
+        runner.run()
+
+    # The second cycle continues from the history id the first one produced
+    assert start_ids == ['10', '20', '30']
+    assert runner.sync_cycles == 2
+    assert get_sync_state(conn, HISTORY_ID_KEY) == '30'
+    # One rule cycle at start-up and one right after the new mail was stored
+    assert [count for count, _ in rule_calls] == [0, 3]
+    assert rule_calls[0][1]["registry"] is rule_calls[1][1]["registry"] is runner.registry
+    assert rule_calls[0][1]["manager"] is runner.manager
+
+
+def test_daemon_failed_sync_does_not_save_history_id(conn):
+    set_sync_state(conn, HISTORY_ID_KEY, '10')
+    calls = []
+
+    def fake_iter_sync(service, start_history_id, *args):
+        calls.append(start_history_id)
+        yield (NEW_EMAILS, [make_email("e1")])
+        if len(calls) == 1:
+            raise ConnectionError("network down")
+        yield (HISTORY_ID, '20')
+        runner.stop()
+
+    runner = Daemon(MagicMock(), MagicMock(), conn, registry=MagicMock(), sync_interval=0, rules_interval=3600)
+    with patch("daemon.iter_sync", side_effect=fake_iter_sync), patch("daemon.apply_rules"):
+        runner.run()
+
+    # The retry starts from the last saved history id
+    assert calls == ['10', '10']
+    assert get_sync_state(conn, HISTORY_ID_KEY) == '20'
+    assert conn.execute("SELECT COUNT(*) FROM emails").fetchone()[0] == 1
+
+
+def test_stop_unblocks_fetch_thread_waiting_on_full_queue(conn):
+    blocked = threading.Event()
+
+    def fake_iter_sync(service, start_history_id, *args):
+        for i in range(10):
+            if i == 1:
+                blocked.set()
+            yield (NEW_EMAILS, [make_email(f"e{i}")])
+
+    runner = Daemon(MagicMock(), MagicMock(), conn, registry=MagicMock(), sync_interval=0, rules_interval=3600,
+                    queue_size=1)
+
+    def stop_when_blocked(*args, **kwargs):
+        # Runs on the writer thread before it reads the queue
+        blocked.wait(5)
+        runner.stop()
+
+    with patch.object(daemon, "POLL_INTERVAL", 0.05), patch("daemon.iter_sync", side_effect=fake_iter_sync), \
+            patch("daemon.apply_rules", side_effect=stop_when_blocked):
+        runner.run()
+
+    # Chunks already queued are stored, nothing after the stop is fetched
+    stored = conn.execute("SELECT COUNT(*) FROM emails").fetchone()[0]
+    assert 1 <= stored <= 2
+    assert get_sync_state(conn, HISTORY_ID_KEY) is None
@@ -0,0 +1,98 @@
+import time
+import pytest
+from datetime import datetime, timedelta, timezone
+import process_rules
+import rule_engine
+from rule_engine import compile_rule, subtract_months, epoch_ms
+
+TIMEZONES = ["UTC", "America/New_York", "Asia/Kolkata", "Pacific/Chatham", "Australia/Lord_Howe"]
+
+
+@pytest.fixture(params=TIMEZONES)
+def local_tz(request, monkeypatch):
+    monkeypatch.setenv("TZ", request.param)
+    time.tzset()
+    # Legacy string conversions are cached and depend on the local timezone
+    rule_engine._legacy_epoch_ms.cache_clear()
+    yield request.param
+    monkeypatch.undo()
+    time.tzset()
+
+
+def to_ms(dt):
+    return int(dt.timestamp() * 1000)
+
+
+def matches(predicate, value, received, now=None):
+    rule = {"conditions": [{"field": "received", "predicate": predicate, "value": value}]}
+    return compile_rule(rule, now=now).matches({"received": received})
+
+
+def test_subtract_months_clamps_day():
+    assert subtract_months(datetime(2024, 3, 31, 8, 0), 1) == datetime(2024, 2, 29, 8, 0)
+    assert subtract_months(datetime(2025, 3, 31), 1) == datetime(2025, 2, 28)
+    assert subtract_months(datetime(2025, 1, 15), 1) == datetime(2024, 12, 15)
+    assert subtract_months(datetime(2025, 8, 20), 12) == datetime(2024, 8, 20)
+    assert subtract_months(datetime(2025, 8, 20), 0) == datetime(2025, 8, 20)
+
+
+def test_epoch_ms_accepts_ints_and_legacy_strings(local_tz):
+    assert epoch_ms(1754827200000) == 1754827200000
+    assert epoch_ms("2025-08-10 12:00:00") == to_ms(datetime(2025, 8, 10, 12, 0, 0))
+    assert epoch_ms("2025-08-10T12:00:00Z") == to_ms(datetime(2025, 8, 10, 12, tzinfo=timezone.utc))
+    assert epoch_ms(None) is None
+
+
+@pytest.mark.parametrize("predicate,value,delta", [
+    ("less_than_days", 30, timedelta(days=30)),
+    ("greater_than_days", 30, timedelta(days=30)),
+    ("less_than_days", 1, timedelta(days=1)),
+])
+def test_day_cutoffs_agree_with_interpreter(local_tz, predicate, value, delta):
+    now = datetime.now()
+    rule = {"conditions": [{"field": "received", "predicate": predicate, "value": value}]}
+    compiled = compile_rule(rule, now=now)
+    for offset in (timedelta(minutes=-5), timedelta(minutes=5), timedelta(hours=-2), timedelta(hours=2)):
+        email = {"received": to_ms(now - delta + offset)}
+        assert compiled.matches(email) == process_rules.match_rule(email, rule)
+
+
+@pytest.mark.parametrize("predicate", ["less_than_months", "greater_than_months"])
+def test_month_cutoffs_agree_with_interpreter(local_tz, predicate):
+    now = datetime.now()
+    rule = {"conditions": [{"field": "received", "predicate": predicate, "value": 3}]}
+    compiled = compile_rule(rule, now=now)
+    boundary = subtract_months(now, 3)
+    for offset in (timedelta(minutes=-5), timedelta(minutes=5), timedelta(days=-10), timedelta(days=10)):
+        email = {"received": to_ms(boundary + offset)}
+        assert compiled.matches(email) == process_rules.match_rule(email, rule)
+
+
+def test_aware_now_measures_elapsed_time_in_any_timezone(local_tz):
+    now = datetime(2025, 3, 20, 12, 0, tzinfo=timezone.utc)
+    just_inside = to_ms(now - timedelta(days=30) + timedelta(minutes=1))
+    just_outside = to_ms(now - timedelta(days=30) - timedelta(minutes=1))
+
+    assert matches("less_than_days", 30, just_inside, now=now)
+    assert not matches("less_than_days", 30, just_outside, now=now)
+    assert matches("greater_than_days", 30, just_outside, now=now)
+    assert not matches("greater_than_days", 30, just_inside, now=now)
+
+
+def test_naive_now_uses_local_wall_clock_across_dst(monkeypatch):
+    # DST starts in New York on 2025-03-09; 30 wall-clock days before
+    # 2025-03-20 12:00 EDT is 2025-02-18 12:00 EST, which is 29d 23h earlier.
+    monkeypatch.setenv("TZ", "America/New_York")
+    time.tzset()
+    try:
+        now = datetime(2025, 3, 20, 12, 0)
+        assert matches("greater_than_days", 30, to_ms(datetime(2025, 2, 18, 11, 30)), now=now)
+        assert matches("less_than_days", 30, to_ms(datetime(2025, 2, 18, 12, 30)), now=now)
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+
+
+def test_missing_date_never_matches():
+    assert not matches("less_than_days", 30, None)
+    assert not matches("greater_than_days", 30, None)
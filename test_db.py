@@ -5,7 +5,11 @@ import os
 
 # Add the project root to sys.path to import db module
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from db import init_db, store_emails
+from datetime import datetime
+from db import (
+    init_db, store_emails, connect, get_labels, emails_with_label, update_email_labels, refresh_fingerprints,
+    SCHEMA_VERSION
+)
 
 @pytest.fixture
 def in_memory_conn():
@@ -55,4 +59,191 @@ def test_store_emails_skips_existing_email(in_memory_conn):
     cursor = in_memory_conn.cursor()
     cursor.execute("SELECT COUNT(*) FROM emails WHERE id=?", ("email1",))
     count = cursor.fetchone()[0]
-    assert count == 1
\ No newline at end of file
+    assert count == 1
+
+def test_store_emails_consumes_generator_in_chunks(in_memory_conn):
+    init_db(conn=in_memory_conn)
+    stored_before_end = []
+
+    def generate():
+        for i in range(5):
+            if i == 4:
+                cursor = in_memory_conn.execute("SELECT COUNT(*) FROM emails")
+                stored_before_end.append(cursor.fetchone()[0])
+            yield {
+                "id": f"email{i}",
+                "sender": "alice@example.com",
+                "subject": "Hello",
+                "snippet": "Hi there!",
+                "labels": "INBOX",
+                "internal_date": "2025-08-10T12:00:00Z"
+            }
+
+    count = store_emails(generate(), conn=in_memory_conn, chunk_size=2)
+
+    assert count == 5
+    # The first two chunks were committed before the generator finished
+    assert stored_before_end == [4]
+
+
+def test_store_emails_counts_only_new_rows_and_keeps_processed_flag(in_memory_conn):
+    init_db(conn=in_memory_conn)
+    emails = [{
+        "id": f"email{i}",
+        "sender": "alice@example.com",
+        "subject": "Hello",
+        "snippet": "Hi there!",
+        "labels": "INBOX",
+        "internal_date": "2025-08-10T12:00:00Z"
+    } for i in range(5)]
+    store_emails(emails[:3], conn=in_memory_conn)
+    in_memory_conn.execute("UPDATE emails SET processed=1 WHERE id='email0'")
+
+    count = store_emails(emails, conn=in_memory_conn, chunk_size=2)
+
+    assert count == 2
+    cursor = in_memory_conn.execute("SELECT processed FROM emails WHERE id='email0'")
+    assert cursor.fetchone()[0] == 1
+
+
+def test_store_emails_does_not_read_before_inserting(in_memory_conn):
+    init_db(conn=in_memory_conn)
+    email = {"id": "e1", "sender": "a", "subject": "s", "snippet": "", "labels": ["INBOX", "UNREAD"],
+             "internal_date": 0}
+    store_emails([email], conn=in_memory_conn)
+    in_memory_conn.execute("DELETE FROM email_labels WHERE label='UNREAD'")
+    statements = []
+    in_memory_conn.set_trace_callback(statements.append)
+
+    count = store_emails([email, dict(email, id="e2")], conn=in_memory_conn)
+
+    assert count == 1
+    assert not any(statement.lstrip().upper().startswith("SELECT") for statement in statements)
+    # Labels are only written for the rows that were actually inserted
+    assert get_labels(in_memory_conn, "e1") == ["INBOX"]
+    assert get_labels(in_memory_conn, "e2") == ["INBOX", "UNREAD"]
+
+
+def test_init_db_inside_open_transaction(in_memory_conn):
+    in_memory_conn.execute("CREATE TABLE notes (text TEXT)")
+    in_memory_conn.execute("INSERT INTO notes VALUES ('pending')")
+    assert in_memory_conn.in_transaction
+
+    init_db(conn=in_memory_conn)
+
+    # The caller's transaction is still open, and now includes the schema
+    assert in_memory_conn.in_transaction
+    in_memory_conn.rollback()
+    assert in_memory_conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name='emails'").fetchone()[0] == 0
+
+
+def test_init_db_migrates_v0_schema(in_memory_conn):
+    in_memory_conn.execute("""
+        CREATE TABLE emails (id TEXT PRIMARY KEY, sender TEXT, subject TEXT, snippet TEXT, labels TEXT,
+                             internal_date TEXT, is_read INTEGER DEFAULT 0, processed INTEGER DEFAULT 0)
+    """)
+    in_memory_conn.execute("INSERT INTO emails VALUES ('e1', 'a@x.com', 'Hi', '', 'INBOX,UNREAD', '2025-08-10 12:00:00', 0, 1)")
+    in_memory_conn.commit()
+
+    init_db(conn=in_memory_conn)
+
+    row = in_memory_conn.execute("SELECT id, internal_date, processed FROM emails").fetchone()
+    assert row == ("e1", int(datetime(2025, 8, 10, 12, 0, 0).timestamp() * 1000), 1)
+    assert get_labels(in_memory_conn, "e1") == ["INBOX", "UNREAD"]
+    assert in_memory_conn.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION
+    # Running it again is a no-op
+    init_db(conn=in_memory_conn)
+    assert in_memory_conn.execute("SELECT COUNT(*) FROM email_labels").fetchone()[0] == 2
+
+
+def test_connect_enables_wal(tmp_path):
+    conn = connect(str(tmp_path / "emails.db"))
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    conn.close()
+
+
+def query_plan(conn, sql, params=()):
+    return ' '.join(row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params))
+
+
+def test_hot_queries_use_indexes(in_memory_conn):
+    init_db(conn=in_memory_conn)
+
+    unprocessed = query_plan(in_memory_conn, "SELECT id FROM emails WHERE is_read=0 AND processed=0 AND internal_date < ?", (0,))
+    by_date = query_plan(in_memory_conn, "SELECT id FROM emails WHERE internal_date > ?", (0,))
+    by_label = query_plan(in_memory_conn, "SELECT email_id FROM email_labels WHERE label=?", ("Jobs",))
+
+    assert "COVERING INDEX idx_emails_unprocessed" in unprocessed
+    assert "idx_emails_internal_date" in by_date
+    assert "COVERING INDEX idx_email_labels_label" in by_label
+
+
+def test_store_emails_writes_labels_to_join_table(in_memory_conn):
+    init_db(conn=in_memory_conn)
+    store_emails([{"id": "e1", "sender": "a", "subject": "s", "snippet": "", "labels": ["INBOX", "Jobs"],
+                   "internal_date": 1754827200000}], conn=in_memory_conn)
+
+    assert get_labels(in_memory_conn, "e1") == ["INBOX", "Jobs"]
+    assert emails_with_label(in_memory_conn, "Jobs") == ["e1"]
+
+
+def test_init_db_adds_body_column_to_v1_schema(in_memory_conn):
+    in_memory_conn.execute("""
+        CREATE TABLE emails (id TEXT PRIMARY KEY, sender TEXT, subject TEXT, snippet TEXT,
+                             internal_date INTEGER, is_read INTEGER DEFAULT 0, processed INTEGER DEFAULT 0)
+    """)
+    in_memory_conn.execute("PRAGMA user_version = 1")
+    in_memory_conn.execute("INSERT INTO emails VALUES ('e1', 'a@x.com', 'Hi', '', 1754827200000, 0, 0)")
+    in_memory_conn.commit()
+
+    init_db(conn=in_memory_conn)
+    store_emails([{"id": "e2", "sender": "b", "subject": "s", "snippet": "", "labels": [],
+                   "internal_date": 1754827200000, "body": "Full text"}], conn=in_memory_conn)
+
+    rows = in_memory_conn.execute("SELECT id, body FROM emails ORDER BY id").fetchall()
+    assert rows == [("e1", None), ("e2", "Full text")]
+
+
+def fingerprints(conn):
+    return dict(conn.execute("SELECT id, fingerprint FROM emails"))
+
+
+def test_fingerprint_follows_content_and_labels(in_memory_conn):
+    init_db(conn=in_memory_conn)
+    store_emails([{"id": "e1", "sender": "a", "subject": "s", "snippet": "", "labels": ["UNREAD", "INBOX"],
+                   "internal_date": 1754827200000}], conn=in_memory_conn)
+    stored = fingerprints(in_memory_conn)["e1"]
+
+    # Computed the same way from the stored row, whatever the label order
+    refresh_fingerprints(in_memory_conn, ["e1"])
+    update_email_labels([{"id": "e1", "labels": ["INBOX", "UNREAD"]}], in_memory_conn)
+    assert fingerprints(in_memory_conn)["e1"] == stored
+
+    update_email_labels([{"id": "e1", "labels": ["INBOX"]}], in_memory_conn)
+    assert fingerprints(in_memory_conn)["e1"] != stored
+
+
+def test_init_db_fingerprints_v3_rows(in_memory_conn):
+    in_memory_conn.execute("""
+        CREATE TABLE emails (id TEXT PRIMARY KEY, sender TEXT, subject TEXT, snippet TEXT, internal_date INTEGER,
+                             body TEXT, is_read INTEGER DEFAULT 0, processed INTEGER DEFAULT 0, rules_version TEXT)
+    """)
+    in_memory_conn.execute("PRAGMA user_version = 3")
+    in_memory_conn.executemany("INSERT INTO emails VALUES (?, 'a@x.com', 'Hi', '', 1754827200000, NULL, 0, ?, ?)",
+                               [("e1", 1, None), ("e2", 0, "v1"), ("e3", 0, None)])
+    in_memory_conn.commit()
+
+    init_db(conn=in_memory_conn)
+
+    rows = in_memory_conn.execute("SELECT id, fingerprint IS NOT NULL, evaluated_fingerprint IS fingerprint "
+                                  "FROM emails ORDER BY id").fetchall()
+    # Only e3 was never seen by the rules, so only it is queued
+    assert rows == [("e1", 1, 1), ("e2", 1, 1), ("e3", 1, 0)]
+
+
+def test_changed_rows_are_found_through_the_partial_index(in_memory_conn):
+    init_db(conn=in_memory_conn)
+
+    changed = query_plan(in_memory_conn, "SELECT rowid FROM emails WHERE evaluated_fingerprint IS NOT fingerprint")
+
+    assert "idx_emails_changed" in changed
@@ -1,17 +1,28 @@
 import os
+import sys
+import json
+import time
+import subprocess
 import pytest
 from unittest.mock import patch, MagicMock
 from unittest.mock import patch, mock_open
-from fetch_store_emails import gmail_authenticate, fetch_top_emails, get_or_create_label
+import httplib2
+from googleapiclient.errors import HttpError
+import fetch_store_emails
+from fetch_store_emails import (
+    gmail_authenticate, get_credentials, load_discovery_document, AuthorizationRequiredError, fetch_top_emails, get_or_create_label, fetch_messages_batched,
+    iter_message_ids, iter_inbox_emails, parse_message, FETCH_PROFILES
+)
 
 # -- gmail_authenticate tests --
 
 @patch("fetch_store_emails.os.path.exists")
 @patch("fetch_store_emails.Credentials.from_authorized_user_file")
 @patch("fetch_store_emails.InstalledAppFlow")
-@patch("fetch_store_emails.build")
+@patch("fetch_store_emails.load_discovery_document", return_value={"version": "v1"})
+@patch("fetch_store_emails.build_from_document")
 def test_gmail_authenticate_token_exists_valid(
-    mock_build, mock_flow, mock_cred_from_file, mock_path_exists
+    mock_build, mock_load_document, mock_flow, mock_cred_from_file, mock_path_exists
 ):
     # Token file exists and credentials valid
     mock_path_exists.return_value = True
@@ -24,15 +35,19 @@ def test_gmail_authenticate_token_exists_valid(
     service = gmail_authenticate()
 
     mock_cred_from_file.assert_called_once()
-    mock_build.assert_called_once_with('gmail', 'v1', credentials=mock_creds)
+    mock_build.assert_called_once_with({"version": "v1"}, credentials=mock_creds)
+    # A valid token is neither refreshed nor re-authorized
+    mock_creds.refresh.assert_not_called()
+    mock_flow.from_client_secrets_file.assert_not_called()
     assert service == "service-object"
 
 @patch("fetch_store_emails.os.path.exists")
 @patch("fetch_store_emails.Credentials.from_authorized_user_file")
 @patch("fetch_store_emails.InstalledAppFlow")
-@patch("fetch_store_emails.build")
+@patch("fetch_store_emails.load_discovery_document", return_value={"version": "v1"})
+@patch("fetch_store_emails.build_from_document")
 def test_gmail_authenticate_token_missing_or_invalid(
-    mock_build, mock_flow_class, mock_cred_from_file, mock_path_exists, tmp_path
+    mock_build, mock_load_document, mock_flow_class, mock_cred_from_file, mock_path_exists, tmp_path
 ):
     # Token file exists but creds invalid, so OAuth flow triggers
 
@@ -62,6 +77,119 @@ def test_gmail_authenticate_token_missing_or_invalid(
     mock_build.assert_called_once()
     assert service == "service-object"
 
+@patch("fetch_store_emails.os.path.exists", return_value=True)
+@patch("fetch_store_emails.Credentials.from_authorized_user_file")
+@patch("fetch_store_emails.InstalledAppFlow")
+@patch("fetch_store_emails.Request")
+def test_get_credentials_refreshes_expired_token(mock_request, mock_flow, mock_cred_from_file, mock_path_exists):
+    mock_creds = MagicMock(valid=False, expired=True, refresh_token="refresh")
+    mock_creds.refresh.side_effect = lambda request: setattr(mock_creds, "valid", True)
+    mock_creds.to_json.return_value = '{"token": "new"}'
+    mock_cred_from_file.return_value = mock_creds
+
+    with patch("builtins.open", new_callable=mock_open) as mock_file:
+        creds = get_credentials("token.json")
+
+    assert creds is mock_creds
+    mock_creds.refresh.assert_called_once_with(mock_request.return_value)
+    mock_file().write.assert_called_once_with('{"token": "new"}')
+    mock_flow.from_client_secrets_file.assert_not_called()
+
+@patch("fetch_store_emails.os.path.exists", return_value=True)
+@patch("fetch_store_emails.Credentials.from_authorized_user_file")
+@patch("fetch_store_emails.InstalledAppFlow")
+@patch("fetch_store_emails.Request")
+def test_get_credentials_reauthorizes_when_refresh_fails(mock_request, mock_flow, mock_cred_from_file, mock_path_exists):
+    from google.auth.exceptions import RefreshError
+    mock_creds = MagicMock(valid=False, expired=True, refresh_token="revoked")
+    mock_creds.refresh.side_effect = RefreshError("invalid_grant")
+    mock_cred_from_file.return_value = mock_creds
+    new_creds = MagicMock()
+    new_creds.to_json.return_value = '{"token": "fresh"}'
+    mock_flow.from_client_secrets_file.return_value.run_local_server.return_value = new_creds
+
+    with patch("builtins.open", new_callable=mock_open):
+        creds = get_credentials("token.json")
+
+    assert creds is new_creds
+    mock_flow.from_client_secrets_file.assert_called_once()
+
+@patch("fetch_store_emails.InstalledAppFlow")
+def test_get_credentials_non_interactive_raises_instead_of_oauth_flow(mock_flow, tmp_path):
+    with pytest.raises(AuthorizationRequiredError):
+        get_credentials(str(tmp_path / "missing.json"), interactive=False)
+    mock_flow.from_client_secrets_file.assert_not_called()
+
+# -- discovery document cache tests --
+
+@pytest.fixture
+def discovery_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(fetch_store_emails, "_discovery_document", None)
+    return str(tmp_path / "gmail.v1.discovery.json")
+
+def test_load_discovery_document_caches_on_disk(discovery_cache):
+    document = {"version": "v1", "revision": "1"}
+    with patch("fetch_store_emails._fetch_discovery_document", return_value=document) as mock_fetch:
+        assert load_discovery_document(discovery_cache) == document
+        # Memoized in the process...
+        assert load_discovery_document(discovery_cache) == document
+        # ...and read back from disk by the next one
+        fetch_store_emails._discovery_document = None
+        assert load_discovery_document(discovery_cache) == document
+    mock_fetch.assert_called_once()
+    with open(discovery_cache) as f:
+        assert json.load(f) == document
+
+@pytest.mark.parametrize("cached, age", [
+    ({"version": "v1", "revision": "old"}, 3600),
+    ({"version": "v2", "revision": "new"}, 0),
+])
+def test_load_discovery_document_refetches_stale_or_mismatched_cache(discovery_cache, cached, age):
+    with open(discovery_cache, "w") as f:
+        json.dump(cached, f)
+    os.utime(discovery_cache, (time.time() - age, time.time() - age))
+    document = {"version": "v1", "revision": "2"}
+    with patch("fetch_store_emails._fetch_discovery_document", return_value=document) as mock_fetch:
+        assert load_discovery_document(discovery_cache, max_age=60) == document
+    mock_fetch.assert_called_once()
+
+GMAIL_DOCUMENT = json.dumps({"name": "gmail", "version": "v1"})
+
+def mock_download():
+    response = MagicMock()
+    response.__enter__.return_value.read.return_value = GMAIL_DOCUMENT.encode('utf-8')
+    return patch("urllib.request.urlopen", return_value=response)
+
+def test_fetch_discovery_document_prefers_bundled_copy():
+    with patch("googleapiclient.discovery_cache.get_static_doc", return_value=GMAIL_DOCUMENT, create=True) as mock_static, \
+            mock_download() as mock_urlopen:
+        document = fetch_store_emails._fetch_discovery_document()
+    mock_static.assert_called_once_with('gmail', 'v1')
+    mock_urlopen.assert_not_called()
+    assert document == {"name": "gmail", "version": "v1"}
+
+def test_fetch_discovery_document_downloads_when_not_bundled():
+    with patch("googleapiclient.discovery_cache.get_static_doc", return_value=None, create=True) as mock_static, \
+            mock_download() as mock_urlopen:
+        document = fetch_store_emails._fetch_discovery_document()
+    mock_static.assert_called_once_with('gmail', 'v1')
+    assert mock_urlopen.call_args[0][0] == fetch_store_emails.DISCOVERY_URL.format(version='v1')
+    assert document == {"name": "gmail", "version": "v1"}
+
+def test_fetch_discovery_document_downloads_on_old_client():
+    # Client libraries before 2.0 have no get_static_doc
+    with patch.dict(sys.modules, {"googleapiclient.discovery_cache": None}), mock_download() as mock_urlopen:
+        document = fetch_store_emails._fetch_discovery_document()
+    mock_urlopen.assert_called_once()
+    assert document == {"name": "gmail", "version": "v1"}
+
+def test_importing_main_defers_google_client_libraries():
+    deferred = ("googleapiclient.discovery", "google_auth_oauthlib", "google.oauth2.credentials", "dateutil")
+    code = f"import sys, main; print(','.join(m for m in {deferred!r} if m in sys.modules))"
+    result = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == ""
+
 # -- fetch_top_emails tests --
 
 def test_fetch_top_emails_returns_emails():
@@ -124,4 +252,215 @@ def test_get_or_create_label_creates_new_label():
 
     label_id = get_or_create_label(mock_service, 'NewLabel')
 
-    assert label_id == 'NEW_LABEL_ID'
\ No newline at end of file
+    assert label_id == 'NEW_LABEL_ID'
+# -- fetch_messages_batched tests --
+
+def make_message(msg_id):
+    return {
+        'id': msg_id,
+        'payload': {'headers': [
+            {'name': 'From', 'value': f'{msg_id}@example.com'},
+            {'name': 'Subject', 'value': f'Subject {msg_id}'}
+        ]},
+        'snippet': 'snippet',
+        'labelIds': ['INBOX'],
+        'internalDate': '1691664000000'
+    }
+
+
+class FakeRequest:
+    def __init__(self, service, msg_id):
+        self.service = service
+        self.msg_id = msg_id
+
+    def resolve(self):
+        failures = self.service.failures.get(self.msg_id, 0)
+        if failures:
+            self.service.failures[self.msg_id] = failures - 1
+            raise HttpError(httplib2.Response({'status': 429}), b'rate limited')
+        if self.msg_id not in self.service.mailbox:
+            raise HttpError(httplib2.Response({'status': 404}), b'not found')
+        return self.service.mailbox[self.msg_id]
+
+    def execute(self):
+        self.service.round_trips += 1
+        return self.resolve()
+
+
+class FakeListRequest:
+    def __init__(self, service, maxResults, pageToken=None):
+        self.service = service
+        self.max_results = maxResults
+        self.start = int(pageToken or 0)
+
+    def execute(self):
+        self.service.round_trips += 1
+        self.service.list_calls += 1
+        ids = list(self.service.mailbox)
+        page = ids[self.start:self.start + self.max_results]
+        result = {'messages': [{'id': msg_id} for msg_id in page]}
+        if self.start + self.max_results < len(ids):
+            result['nextPageToken'] = str(self.start + self.max_results)
+        return result
+
+
+class FakeBatch:
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        self.service.round_trips += 1
+        self.service.batch_sizes.append(len(self.requests))
+        for request_id, request in self.requests:
+            try:
+                self.callback(request_id, request.resolve(), None)
+            except HttpError as e:
+                self.callback(request_id, None, e)
+
+
+class FakeGmailService:
+    # Local stand-in that counts HTTP round trips instead of talking to Gmail
+    def __init__(self, count, failures=None):
+        self.mailbox = {f'm{i}': make_message(f'm{i}') for i in range(count)}
+        self.failures = dict(failures or {})
+        self.round_trips = 0
+        self.list_calls = 0
+        self.batch_sizes = []
+        self.get_params = []
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def list(self, userId, maxResults, labelIds=None, pageToken=None):
+        return FakeListRequest(self, maxResults, pageToken)
+
+    def get(self, userId, id, **params):
+        self.get_params.append(params)
+        return FakeRequest(self, id)
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self, callback)
+
+
+def test_fetch_messages_batched_reduces_round_trips():
+    service = FakeGmailService(250)
+    ids = list(service.mailbox)
+
+    emails = fetch_messages_batched(service, ids, batch_size=50)
+
+    assert [e['id'] for e in emails] == ids
+    assert service.round_trips == 5
+    assert service.batch_sizes == [50] * 5
+
+
+def test_fetch_messages_batched_caps_batch_size():
+    service = FakeGmailService(150)
+
+    fetch_messages_batched(service, list(service.mailbox), batch_size=500)
+
+    assert service.batch_sizes == [100, 50]
+
+
+def test_fetch_messages_batched_retries_only_failed_items():
+    service = FakeGmailService(10, failures={'m3': 1, 'm7': 2})
+
+    emails = fetch_messages_batched(service, list(service.mailbox), batch_size=10, backoff=0)
+
+    assert len(emails) == 10
+    assert service.batch_sizes == [10, 2, 1]
+
+
+def test_fetch_messages_batched_skips_non_retryable_errors():
+    service = FakeGmailService(3)
+
+    emails = fetch_messages_batched(service, ['m0', 'missing', 'm2'], backoff=0)
+
+    assert [e['id'] for e in emails] == ['m0', 'm2']
+    assert service.round_trips == 1
+
+
+def test_fetch_messages_batched_gives_up_after_max_retries():
+    service = FakeGmailService(2, failures={'m1': 10})
+
+    emails = fetch_messages_batched(service, ['m0', 'm1'], max_retries=2, backoff=0)
+
+    assert [e['id'] for e in emails] == ['m0']
+    assert service.batch_sizes == [2, 1, 1]
+
+
+# -- pagination / streaming tests --
+
+def test_iter_message_ids_follows_next_page_token():
+    service = FakeGmailService(25)
+
+    ids = list(iter_message_ids(service, page_size=10))
+
+    assert ids == list(service.mailbox)
+    assert service.list_calls == 3
+
+
+def test_iter_message_ids_respects_max_messages():
+    service = FakeGmailService(25)
+
+    ids = list(iter_message_ids(service, page_size=10, max_messages=12))
+
+    assert ids == list(service.mailbox)[:12]
+    assert service.list_calls == 2
+
+
+def test_iter_inbox_emails_is_lazy():
+    service = FakeGmailService(100)
+
+    emails = iter_inbox_emails(service, page_size=20, batch_size=10)
+    first = next(emails)
+
+    # Only the first page and first batch have been requested so far
+    assert first['id'] == 'm0'
+    assert service.list_calls == 1
+    assert service.batch_sizes == [10]
+
+    rest = list(emails)
+    assert len(rest) == 99
+    assert service.list_calls == 5
+
+
+def test_fetch_requests_metadata_with_field_mask():
+    service = FakeGmailService(3)
+
+    fetch_messages_batched(service, list(service.mailbox), batch_size=10)
+
+    assert service.get_params == [{
+        'format': 'metadata',
+        'metadataHeaders': ['From', 'Subject'],
+        'fields': 'id,snippet,labelIds,internalDate,payload/headers',
+    }] * 3
+
+
+def test_fetch_full_profile_requests_payload():
+    service = FakeGmailService(2)
+
+    fetch_messages_batched(service, list(service.mailbox), batch_size=10, profile='full')
+
+    assert service.get_params == [FETCH_PROFILES['full']] * 2
+    assert service.get_params[0]['format'] == 'full'
+
+
+def test_parse_message_full_profile_decodes_plain_text_body():
+    msg = make_message('m1')
+    msg['payload']['mimeType'] = 'multipart/alternative'
+    msg['payload']['parts'] = [
+        {'mimeType': 'text/html', 'body': {'data': 'PGI-aGk8L2I-'}},
+        # base64url without padding, as Gmail returns it
+        {'mimeType': 'text/plain', 'body': {'data': 'SGVsbG8sIHdvcmxkIQ'}},
+    ]
+
+    assert parse_message(msg, 'full')['body'] == 'Hello, world!'
+    assert 'body' not in parse_message(msg, 'metadata')
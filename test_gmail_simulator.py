@@ -0,0 +1,125 @@
+import json
+import sqlite3
+import pytest
+from googleapiclient.errors import HttpError
+from db import init_db, get_labels
+from gmail_simulator import SimulatedMailbox, http_error
+from fetch_store_emails import iter_message_ids, fetch_messages_batched, is_retryable_error
+from label_registry import is_missing_label_error
+from concurrent_fetch import ConcurrentFetcher, TokenBucket
+from sync import sync_mailbox, HISTORY_ID_KEY
+from db import get_sync_state
+import process_rules
+from rules_manager import RulesManager
+
+RULES = [{
+    "name": "Jobs", "predicate": "any",
+    "conditions": [{"field": "from", "predicate": "contains", "value": "linkedin.com"}],
+    "actions": {"mark_as_read": True, "move_to_folder": "Jobs"}
+}]
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(":memory:")
+    init_db(conn=conn)
+    yield conn
+    conn.close()
+
+
+def test_list_pages_through_whole_mailbox():
+    mailbox = SimulatedMailbox(size=1234)
+
+    ids = list(iter_message_ids(mailbox.service(), page_size=500))
+
+    assert len(ids) == len(set(ids)) == 1234
+    assert mailbox.stats()['calls'] == {'messages.list': 3}
+
+
+def test_batched_get_counts_one_round_trip_per_batch():
+    mailbox = SimulatedMailbox(size=250)
+    service = mailbox.service()
+    ids = list(iter_message_ids(service))
+
+    emails = fetch_messages_batched(service, ids, batch_size=100)
+
+    assert len(emails) == 250
+    assert emails[0]['sender'] and emails[0]['subject']
+    stats = mailbox.stats()
+    assert stats['calls']['messages.get'] == 250
+    assert stats['round_trips'] == 1 + 3
+
+
+def test_quota_errors_are_retried_until_everything_is_fetched():
+    clock = [0.0]
+
+    def sleep(seconds):
+        clock[0] += seconds
+
+    # The client starts at four times the simulated quota and has to back off
+    mailbox = SimulatedMailbox(size=100, quota_per_second=250, clock=lambda: clock[0])
+    limiter = TokenBucket(rate=1000, clock=lambda: clock[0], sleep=sleep)
+    ids = [mailbox.message_id(i) for i in range(100)]
+
+    with ConcurrentFetcher(mailbox.service, workers=0, rate_limiter=limiter, max_retries=10) as fetcher:
+        emails = fetcher.fetch(ids, batch_size=100)
+
+    assert mailbox.stats()['quota_errors'] > 0
+    assert limiter.rate < 1000
+    assert [e['id'] for e in emails] == ids
+    assert is_retryable_error(http_error(429, "User-rate limit exceeded"))
+
+
+def test_batch_modify_rejects_unknown_labels():
+    mailbox = SimulatedMailbox(size=10)
+
+    with pytest.raises(HttpError) as excinfo:
+        mailbox.service().users().messages().batchModify(
+            userId='me', body={'ids': [mailbox.message_id(0)], 'addLabelIds': ['Label_404']}).execute()
+
+    assert is_missing_label_error(excinfo.value)
+
+
+def test_end_to_end_sync_rules_and_incremental_sync(conn, tmp_path, monkeypatch):
+    mailbox = SimulatedMailbox(size=300)
+    service = mailbox.service()
+    monkeypatch.setattr(process_rules, "load_rules", lambda: RULES)
+
+    assert sync_mailbox(service, conn, batch_size=50) == 300
+    process_rules.apply_rules(service, conn)
+
+    jobs = [row[0] for row in conn.execute("SELECT id FROM emails WHERE sender='jobs@linkedin.com'")]
+    jobs_label = next(l['id'] for l in mailbox.labels.values() if l['name'] == 'Jobs')
+    assert jobs and all(jobs_label in get_labels(conn, email_id) for email_id in jobs)
+    assert all(jobs_label in mailbox.message_labels(int(email_id, 16)) for email_id in jobs)
+
+    # Only the new messages and the ones the rules just modified are fetched again
+    new_ids = mailbox.add_messages(5)
+    gets_before = mailbox.stats()['calls']['messages.get']
+    assert sync_mailbox(service, conn, batch_size=50) == 5
+    assert mailbox.stats()['calls']['messages.get'] - gets_before == 5 + len(jobs)
+    assert get_sync_state(conn, HISTORY_ID_KEY) == str(mailbox.history_id)
+    assert {row[0] for row in conn.execute("SELECT id FROM emails")} >= set(new_ids)
+
+
+def test_sync_echo_of_rule_actions_does_not_requeue_emails(conn, tmp_path):
+    mailbox = SimulatedMailbox(size=300)
+    service = mailbox.service()
+    path = tmp_path / "rules.json"
+    path.write_text(json.dumps(RULES))
+    manager = RulesManager(str(path))
+
+    sync_mailbox(service, conn, batch_size=50)
+    process_rules.apply_rules(service, conn, manager=manager)
+    modified = conn.execute("SELECT COUNT(*) FROM emails WHERE sender='jobs@linkedin.com'").fetchone()[0]
+    # Gmail reports the rule's changes back through history...
+    gets_before = mailbox.stats()['calls']['messages.get']
+    sync_mailbox(service, conn, batch_size=50)
+    assert modified and mailbox.stats()['calls']['messages.get'] - gets_before == modified
+
+    # ...which leaves the stored state the rules already saw
+    queued = conn.execute(f"SELECT COUNT(*) FROM emails WHERE {process_rules.CHANGED_FILTER}").fetchone()[0]
+    assert queued == 0
+    loaded = manager.current()
+    scopes, _ = process_rules.evaluation_scopes(conn, loaded, loaded.compiled())
+    assert scopes == []
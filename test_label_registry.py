@@ -0,0 +1,105 @@
+import sqlite3
+import httplib2
+import pytest
+from unittest.mock import MagicMock
+from googleapiclient.errors import HttpError
+from db import init_db
+from label_registry import LabelRegistry, is_missing_label_error
+
+
+class FakeLabelsService:
+    def __init__(self, labels):
+        self.labels_store = list(labels)
+        self.list_calls = 0
+        self.create_calls = 0
+
+    def users(self):
+        return self
+
+    def labels(self):
+        return self
+
+    def list(self, userId):
+        self.list_calls += 1
+        request = MagicMock()
+        request.execute.return_value = {'labels': list(self.labels_store)}
+        return request
+
+    def create(self, userId, body):
+        self.create_calls += 1
+        label = {'id': f"Label_{len(self.labels_store) + 1}", 'name': body['name']}
+        self.labels_store.append(label)
+        request = MagicMock()
+        request.execute.return_value = label
+        return request
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(":memory:")
+    init_db(conn=conn)
+    yield conn
+    conn.close()
+
+
+def test_registry_lists_labels_once_and_is_case_insensitive():
+    service = FakeLabelsService([{'id': 'Label_1', 'name': 'Jobs'}, {'id': 'Label_2', 'name': 'Shopping'}])
+    registry = LabelRegistry(service)
+
+    assert registry.get_or_create('jobs') == 'Label_1'
+    assert registry.get_or_create('SHOPPING') == 'Label_2'
+    assert registry.get('Missing') is None
+    assert service.list_calls == 1
+
+
+def test_registry_creates_missing_labels_and_caches_them():
+    service = FakeLabelsService([])
+    registry = LabelRegistry(service)
+
+    resolved = registry.resolve_all(['Jobs', 'Shopping'])
+    assert registry.get_or_create('jobs') == resolved['Jobs']
+
+    assert service.list_calls == 1
+    assert service.create_calls == 2
+
+
+def test_registry_reuses_persisted_labels_within_ttl(conn):
+    service = FakeLabelsService([{'id': 'Label_1', 'name': 'Jobs'}])
+    clock = Clock()
+    LabelRegistry(service, conn, ttl=60, clock=clock).resolve_all(['Jobs', 'New'])
+
+    clock.now += 30
+    fresh = LabelRegistry(service, conn, ttl=60, clock=clock)
+    assert fresh.resolve_all(['Jobs', 'New']) == {'Jobs': 'Label_1', 'New': 'Label_2'}
+    assert service.list_calls == 1
+
+    clock.now += 60
+    LabelRegistry(service, conn, ttl=60, clock=clock).get('Jobs')
+    assert service.list_calls == 2
+
+
+def test_registry_invalidate_forces_relisting(conn):
+    service = FakeLabelsService([{'id': 'Label_1', 'name': 'Jobs'}])
+    registry = LabelRegistry(service, conn)
+    registry.get('Jobs')
+
+    registry.invalidate()
+    service.labels_store = [{'id': 'Label_9', 'name': 'Jobs'}]
+
+    assert registry.get('Jobs') == 'Label_9'
+    assert LabelRegistry(service, conn).get('Jobs') == 'Label_9'
+    assert service.list_calls == 2
+
+
+def test_is_missing_label_error():
+    assert is_missing_label_error(HttpError(httplib2.Response({'status': 404}), b''))
+    assert is_missing_label_error(HttpError(httplib2.Response({'status': 400}), b'{"error": {"message": "Invalid label: Label_7"}}'))
+    assert not is_missing_label_error(HttpError(httplib2.Response({'status': 500}), b''))
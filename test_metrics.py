@@ -0,0 +1,151 @@
+import json
+import sqlite3
+import pytest
+from unittest.mock import MagicMock
+import process_rules
+from db import init_db, store_emails
+from metrics import Metrics, METRICS, to_prometheus, export, profiled
+from rule_engine import compile_rules
+from gmail_simulator import SimulatedMailbox
+from label_registry import LabelRegistry
+from fetch_store_emails import fetch_messages_batched, parse_message
+
+
+@pytest.fixture(autouse=True)
+def reset_metrics():
+    METRICS.reset()
+    yield
+    METRICS.reset()
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(":memory:")
+    init_db(conn=conn)
+    yield conn
+    conn.close()
+
+
+def make_email(email_id, sender):
+    return {"id": email_id, "sender": sender, "subject": "Hi", "snippet": "", "labels": ["INBOX", "UNREAD"],
+            "internal_date": 1754827200000}
+
+
+def test_prometheus_text_format():
+    ticks = iter([1.0, 1.5])
+    metrics = Metrics(clock=lambda: next(ticks))
+    metrics.inc('api_calls', 3, method='messages.get')
+    metrics.inc('rule_hits', rule='Say "hi"')
+    with metrics.timer('stage', stage='fetch'):
+        pass
+
+    text = to_prometheus(metrics)
+
+    assert '# TYPE gmail_processor_api_calls_total counter' in text
+    assert 'gmail_processor_api_calls_total{method="messages.get"} 3' in text
+    assert 'gmail_processor_rule_hits_total{rule="Say \\"hi\\""} 1' in text
+    assert 'gmail_processor_stage_seconds_count{stage="fetch"} 1' in text
+    assert 'gmail_processor_stage_seconds_sum{stage="fetch"} 0.500000' in text
+
+
+def test_export_json(tmp_path):
+    METRICS.inc('db_rows', 5, table='emails', op='insert')
+    path = tmp_path / "metrics.json"
+
+    export(str(path))
+
+    assert json.loads(path.read_text())['counters'] == [
+        {'name': 'db_rows', 'labels': {'op': 'insert', 'table': 'emails'}, 'value': 5}]
+
+
+def test_fetch_counts_api_calls_and_requests():
+    mailbox = SimulatedMailbox(size=120)
+
+    fetch_messages_batched(mailbox.service(), [mailbox.message_id(i) for i in range(120)], batch_size=50)
+
+    assert METRICS.counter('api_calls', method='messages.get') == 120
+    assert METRICS.counter('http_requests') == 3
+    assert METRICS.timing('stage', stage='fetch')[0] == 1
+    assert METRICS.counter('message_bytes') > 0
+
+
+def test_rule_evaluations_hits_and_sampled_timings(conn):
+    store_emails([make_email(f"e{i}", "jobs@linkedin.com" if i < 3 else "bob@example.com") for i in range(10)],
+                 conn=conn)
+    rules = compile_rules([
+        {"name": "Jobs", "conditions": [{"field": "from", "predicate": "contains", "value": "linkedin"}]},
+        {"name": "Never", "conditions": [{"field": "subject", "predicate": "equals", "value": "nope"}]},
+    ])
+
+    process_rules.find_matches(conn, rules, timing_sample=5)
+
+    assert METRICS.counter('rule_evaluations', rule='Jobs') == 10
+    assert METRICS.counter('rule_hits', rule='Jobs') == 3
+    assert METRICS.counter('rule_hits', rule='Never') == 0
+    assert METRICS.counter('rule_seconds', rule='Never') > 0
+    assert METRICS.counter('db_rows', table='emails', op='insert') == 10
+
+
+def test_sql_path_records_evaluations_and_hits(conn):
+    store_emails([make_email(f"e{i}", "jobs@linkedin.com" if i < 3 else "bob@example.com") for i in range(10)],
+                 conn=conn)
+    rules = compile_rules([
+        {"name": "Jobs", "conditions": [{"field": "from", "predicate": "contains", "value": "linkedin"}]},
+        {"name": "Unicode", "conditions": [{"field": "subject", "predicate": "contains", "value": "ü"}]},
+    ])
+
+    process_rules.find_matches_sql(conn, rules)
+
+    assert METRICS.counter('rule_evaluations', rule='Jobs') == 10
+    assert METRICS.counter('rule_hits', rule='Jobs') == 3
+    # Evaluated in Python, counted once
+    assert METRICS.counter('rule_evaluations', rule='Unicode') == 10
+
+
+def test_failed_requests_are_counted():
+    service = MagicMock()
+    service.users().labels().list().execute.side_effect = ConnectionError("network down")
+
+    with pytest.raises(ConnectionError):
+        LabelRegistry(service).refresh()
+
+    assert METRICS.counter('api_calls', method='labels.list') == 1
+
+
+def test_apply_actions_logs_once_per_rule(conn, caplog):
+    store_emails([make_email(f"e{i}", "jobs@linkedin.com") for i in range(50)], conn=conn)
+    rules = compile_rules([{"name": "Jobs", "actions": {"mark_as_read": True},
+                            "conditions": [{"field": "from", "predicate": "contains", "value": "linkedin"}]}])
+    matches = process_rules.find_matches(conn, rules)
+
+    with caplog.at_level("INFO", logger="process_rules"):
+        process_rules.apply_actions(MagicMock(), conn, matches, registry=MagicMock())
+
+    matched_lines = [r.message for r in caplog.records if "matched" in r.message]
+    assert matched_lines == ["Rule 'Jobs' matched 50 emails. Applied label 'None' and marked as read: True."]
+
+
+def test_profiled_writes_stats(tmp_path):
+    path = tmp_path / "run.prof"
+
+    with profiled(str(path)):
+        sum(range(1000))
+
+    assert path.stat().st_size > 0
+
+
+def test_profiled_logs_top_functions_instead_of_printing(tmp_path, caplog, capsys):
+    with caplog.at_level("DEBUG", logger="metrics"):
+        with profiled(str(tmp_path / "run.prof"), top=5):
+            sum(range(1000))
+
+    assert capsys.readouterr().out == ""
+    assert any("cumulative time" in record.getMessage() and "ncalls" in record.getMessage()
+               for record in caplog.records)
+
+
+def test_message_bytes_counts_utf8_bytes():
+    parse_message({"id": "m1", "internalDate": "0", "snippet": "héllo",
+                   "payload": {"headers": [{"name": "From", "value": "ä@x.de"}, {"name": "Subject", "value": "€"}]}})
+
+    assert METRICS.counter('message_bytes') == len("héllo".encode()) + len("ä@x.de".encode()) + len("€".encode())
@@ -0,0 +1,77 @@
+import random
+import sqlite3
+import pytest
+from unittest.mock import patch
+from datetime import datetime, timedelta
+from db import init_db, store_emails, connect
+from rule_engine import compile_rules
+import process_rules
+import parallel_rules
+from parallel_rules import find_matches_parallel, database_path
+
+NOW = datetime(2025, 8, 20, 12, 0, 0)
+WORDS = ["job", "sale", "offer", "hiring", "linkedin.com", "ajio.in", "invoice"]
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = connect(str(tmp_path / "emails.db"))
+    init_db(conn=conn)
+    rng = random.Random(2)
+    store_emails([{
+        "id": f"e{i}",
+        "sender": f"x@{rng.choice(WORDS)}",
+        "subject": ' '.join(rng.sample(WORDS, 3)),
+        "snippet": "",
+        "labels": ["INBOX", "UNREAD"],
+        "internal_date": int((NOW - timedelta(days=rng.randint(0, 60), hours=6)).timestamp() * 1000)
+    } for i in range(500)], conn=conn)
+    yield conn
+    conn.close()
+
+
+def make_rules():
+    rng = random.Random(4)
+    return [{"name": f"r{i}", "predicate": rng.choice(["all", "any"]), "actions": {},
+             "conditions": [{"field": rng.choice(["from", "subject"]), "predicate": rng.choice(["contains", "equals"]),
+                             "value": rng.choice(WORDS)},
+                            {"field": "received", "predicate": "greater_than_days", "value": rng.randint(1, 60)}]}
+            for i in range(20)]
+
+
+def as_names(matches):
+    return sorted((email["id"], [rule.name for rule in rules]) for email, rules in matches)
+
+
+def test_parallel_matches_agree_with_serial(conn):
+    raw_rules = make_rules()
+    rules = compile_rules(raw_rules, now=NOW)
+
+    serial = process_rules.find_matches(conn, rules)
+    parallel = find_matches_parallel(conn, raw_rules, rules, workers=2, chunk_size=64, now=NOW)
+
+    assert as_names(parallel) == as_names(serial)
+    # Rule objects in the result are the parent's compiled rules
+    assert all(rule in rules.rules for _, matched in parallel for rule in matched)
+
+
+def test_parallel_requires_file_database():
+    conn = sqlite3.connect(":memory:")
+    init_db(conn=conn)
+    assert database_path(conn) is None
+    with pytest.raises(ValueError):
+        find_matches_parallel(conn, [], compile_rules([]), workers=2)
+
+
+def test_sql_pushdown_sends_python_only_rules_to_workers(conn):
+    # Non-ASCII needles can't be matched case-insensitively in SQLite
+    raw_rules = make_rules() + [{"name": "umlaut", "predicate": "any", "actions": {},
+                                 "conditions": [{"field": "subject", "predicate": "does_not_contain", "value": "Ä"}]}]
+    rules = compile_rules(raw_rules, now=NOW)
+
+    with patch("parallel_rules.find_matches_parallel", wraps=parallel_rules.find_matches_parallel) as parallel:
+        matches = process_rules.find_all_matches(conn, raw_rules, rules, use_sql=True, workers=2, chunk_size=64,
+                                                 now=NOW)
+
+    assert as_names(matches) == as_names(process_rules.find_matches(conn, rules))
+    assert [rule.name for rule in parallel.call_args.args[2]] == ["umlaut"]
@@ -1,7 +1,10 @@
+import sqlite3
 import pytest
 from unittest import mock
 from unittest.mock import patch, MagicMock, mock_open
 import process_rules  # import your module under test
+from db import init_db, store_emails
+from rule_engine import compile_rules
 
 @patch("builtins.open", new_callable=mock_open, read_data='[{"name":"rule1"}]')
 @patch("json.load")
@@ -52,50 +55,92 @@ def test_match_rule_unknown_predicate_logs_warning(monkeypatch):
     assert any("Unknown predicate" in msg for msg in logs)
 
 @patch("process_rules.load_rules")
-@patch("sqlite3.connect")
-def test_apply_rules(mock_connect, mock_load_rules):
-    # Setup mock rules
+def test_apply_rules(mock_load_rules):
     mock_load_rules.return_value = [
         {
             "name": "Mark Read and Label",
-            "conditions": {"from": ["alice"]},
+            "conditions": [{"field": "from", "predicate": "contains", "value": "alice"}],
             "predicate": "All",
             "actions": {"mark_as_read": True, "label": "TestLabel"}
         }
     ]
+    conn = sqlite3.connect(":memory:")
+    init_db(conn=conn)
+    store_emails([
+        {"id": "email1", "sender": "alice@example.com", "subject": "Hello", "snippet": "snippet",
+         "labels": ["INBOX", "UNREAD"], "internal_date": 1754827200000},
+        {"id": "email2", "sender": "bob@example.com", "subject": "Hi", "snippet": "snippet",
+         "labels": ["INBOX", "UNREAD"], "internal_date": 1754827200000},
+    ], conn=conn)
 
-    # Setup mock DB connection and cursor
-    mock_conn = MagicMock()
-    mock_cursor = MagicMock()
-    mock_connect.return_value = mock_conn
-    mock_conn.cursor.return_value = mock_cursor
+    # The label doesn't exist yet, so the registry creates it
+    mock_service = MagicMock()
+    mock_service.users().labels().list().execute.return_value = {"labels": []}
+    mock_service.users().labels().create().execute.return_value = {"id": "LabelID123"}
 
-    # Fake emails returned from DB - tuple: (id, sender, subject, snippet, labels, internal_date, is_read, processed)
-    mock_cursor.fetchall.return_value = [
-        ("email1", "alice@example.com", "Hello", "snippet", "INBOX,UNREAD", "2025-08-10", 0, 0),
-        ("email2", "bob@example.com", "Hi", "snippet", "INBOX", "2025-08-10", 0, 0)
-    ]
+    process_rules.apply_rules(mock_service, conn)
 
-    # Mock service and its chain of calls
-    mock_service = MagicMock()
-    mock_modify = MagicMock()
-    mock_service.users().messages().modify.return_value = mock_modify
-    mock_modify.execute.return_value = None
-
-    # Patch get_or_create_label to return a fake label id
-    with patch("process_rules.get_or_create_label", return_value="LabelID123"):
-        process_rules.apply_rules(mock_service, mock_conn)   # <-- pass mock_conn here
-
-    # Validate DB queries and commits called at least once
-    mock_cursor.execute.assert_any_call("SELECT * FROM emails WHERE is_read=0 AND processed=0")
-    assert mock_conn.commit.call_count >= 1
-
-    # Validate that modify API called once for matched email only (email1 from alice)
-    mock_service.users().messages().modify.assert_called_once_with(
-        userId='me',
-        id="email1",
-        body={
-            "removeLabelIds": ["UNREAD"],
-            "addLabelIds": ["LabelID123"]  # label id returned by mocked get_or_create_label
-        }
-    )
\ No newline at end of file
+    mock_service.users().labels().create.assert_called_with(
+        userId='me', body={"name": "TestLabel", "labelListVisibility": "labelShow", "messageListVisibility": "show"})
+    # One batchModify for the matched email, no per-message modify calls
+    mock_service.users().messages().batchModify.assert_called_once_with(
+        userId='me', body={"ids": ["email1"], "removeLabelIds": ["UNREAD"], "addLabelIds": ["LabelID123"]})
+    mock_service.users().messages().modify.assert_not_called()
+    rows = conn.execute("SELECT id, is_read, processed FROM emails ORDER BY id").fetchall()
+    assert rows == [("email1", 1, 1), ("email2", 0, 0)]
+    conn.close()
+
+def make_match(email_id, rules):
+    email = {"id": email_id, "sender": "a@example.com", "subject": "s", "snippet": "", "labels": "INBOX,UNREAD"}
+    return email, rules
+
+
+def test_merge_label_changes_later_rules_win():
+    merged = process_rules.merge_label_changes([(["L1"], ["UNREAD"]), (["UNREAD"], [])])
+    assert merged == (("L1", "UNREAD"), ())
+
+
+def make_registry(**label_ids):
+    registry = MagicMock()
+    registry.get_or_create.side_effect = lambda name: label_ids[name]
+    return registry
+
+
+def test_apply_actions_groups_batch_modify_by_signature():
+    conn = sqlite3.connect(":memory:")
+    init_db(conn=conn)
+    promo, jobs = compile_rules([
+        {"name": "Promo", "actions": {"mark_as_read": True, "move_to_folder": "Promo"}},
+        {"name": "Jobs", "actions": {"mark_as_read": True, "move_to_folder": "Jobs"}},
+    ])
+    matches = [make_match(f"p{i}", [promo]) for i in range(2500)] + [make_match(f"j{i}", [jobs]) for i in range(10)]
+    store_emails([dict(email, internal_date=0) for email, _ in matches], conn=conn)
+    service = MagicMock()
+    registry = make_registry(Promo="id-Promo", Jobs="id-Jobs")
+
+    processed = process_rules.apply_actions(service, conn, matches, registry)
+
+    batch_modify = service.users().messages().batchModify
+    bodies = [c.kwargs["body"] for c in batch_modify.call_args_list]
+    assert [len(b["ids"]) for b in bodies] == [1000, 1000, 500, 10]
+    assert bodies[0]["addLabelIds"] == ["id-Promo"] and bodies[0]["removeLabelIds"] == ["UNREAD"]
+    assert bodies[3]["addLabelIds"] == ["id-Jobs"]
+    service.users().messages().modify.assert_not_called()
+    # Labels are resolved once per rule
+    assert registry.get_or_create.call_count == 2
+    assert processed == 2510
+    assert conn.execute("SELECT COUNT(*) FROM emails WHERE processed=1").fetchone()[0] == 2510
+
+
+def test_apply_actions_leaves_failed_batches_unprocessed():
+    conn = sqlite3.connect(":memory:")
+    init_db(conn=conn)
+    [promo] = compile_rules([{"name": "Promo", "actions": {"mark_as_read": True, "move_to_folder": "Promo"}}])
+    matches = [make_match(f"p{i}", [promo]) for i in range(1500)]
+    store_emails([dict(email, internal_date=0) for email, _ in matches], conn=conn)
+    service = MagicMock()
+    service.users().messages().batchModify().execute.side_effect = [None, Exception("backend error")]
+
+    process_rules.apply_actions(service, conn, matches, make_registry(Promo="id-Promo"))
+
+    assert conn.execute("SELECT COUNT(*) FROM emails WHERE processed=1").fetchone()[0] == 1000
@@ -0,0 +1,117 @@
+import random
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock
+import process_rules
+from rule_engine import compile_rule, compile_rules, ContainsIndex
+
+NOW = datetime(2025, 8, 20, 12, 0, 0)
+
+
+def make_email(sender="alice@linkedin.com", subject="We are hiring", days_old=1, now=NOW):
+    return {
+        "id": "email1",
+        "sender": sender,
+        "subject": subject,
+        "snippet": "",
+        "labels": "INBOX,UNREAD",
+        "received": (now - timedelta(days=days_old, hours=12)).strftime('%Y-%m-%d %H:%M:%S'),
+    }
+
+
+def matches(condition, email, now=NOW):
+    return compile_rule({"conditions": [condition]}, now=now).matches(email)
+
+
+def test_from_field_matches_sender():
+    condition = {"field": "From", "predicate": "Contains", "value": "LinkedIn.com"}
+    assert matches(condition, make_email()) is True
+    assert matches(condition, make_email(sender="bob@example.com")) is False
+
+
+def test_string_predicates():
+    email = make_email(subject="Big Sale")
+    assert matches({"field": "subject", "predicate": "equals", "value": "big sale"}, email)
+    assert not matches({"field": "subject", "predicate": "does_not_equal", "value": "BIG SALE"}, email)
+    assert matches({"field": "subject", "predicate": "does_not_contain", "value": "job"}, email)
+
+
+def test_date_predicates_use_precomputed_cutoff():
+    older = {"field": "received", "predicate": "greater_than_days", "value": 30}
+    newer = {"field": "received", "predicate": "less_than_days", "value": 30}
+    assert matches(older, make_email(days_old=45)) and not matches(newer, make_email(days_old=45))
+    assert matches(newer, make_email(days_old=2)) and not matches(older, make_email(days_old=2))
+
+
+def test_unknown_predicate_never_matches():
+    assert matches({"field": "subject", "predicate": "starts_with", "value": "x"}, make_email()) is False
+
+
+def test_rule_set_returns_every_matching_rule():
+    rule_set = compile_rules([
+        {"name": "jobs", "conditions": [{"field": "subject", "predicate": "contains", "value": "hiring"}]},
+        {"name": "shop", "conditions": [{"field": "subject", "predicate": "contains", "value": "sale"}]},
+        {"name": "linkedin", "conditions": [{"field": "from", "predicate": "contains", "value": "linkedin"}]},
+    ])
+    assert [rule.name for rule in rule_set.matching_rules(make_email())] == ["jobs", "linkedin"]
+
+
+def test_all_rule_short_circuits():
+    rule = compile_rule({"predicate": "All", "conditions": [{"field": "subject", "predicate": "contains", "value": "x"}]})
+    spy = MagicMock(return_value=True)
+    rule.conditions.append(spy)
+    assert rule.matches(make_email()) is False
+    spy.assert_not_called()
+
+
+def test_any_rule_short_circuits():
+    rule = compile_rule({"predicate": "Any", "conditions": [{"field": "subject", "predicate": "contains", "value": "hiring"}]})
+    spy = MagicMock(return_value=False)
+    rule.conditions.append(spy)
+    assert rule.matches(make_email()) is True
+    spy.assert_not_called()
+
+
+def test_rule_without_conditions_matches_everything():
+    assert compile_rule({"name": "catch all", "actions": {}}).matches(make_email()) is True
+
+
+def test_compiled_rules_agree_with_interpreter():
+    rng = random.Random(7)
+    words = ["hiring", "sale", "job", "offer", "linkedin.com", "ajio.in"]
+    rules = []
+    for i in range(30):
+        conditions = [{"field": rng.choice(["from", "subject"]),
+                       "predicate": rng.choice(["contains", "does_not_contain", "equals", "does_not_equal"]),
+                       "value": rng.choice(words)} for _ in range(rng.randint(1, 4))]
+        conditions.append({"field": "received", "predicate": rng.choice(["less_than_days", "greater_than_days"]),
+                           "value": rng.randint(1, 60)})
+        rules.append({"name": f"r{i}", "predicate": rng.choice(["all", "any"]), "conditions": conditions, "actions": {}})
+    compiled = compile_rules(rules)
+    for _ in range(200):
+        email = make_email(sender=f"x@{rng.choice(words)}", subject=' '.join(rng.sample(words, 2)),
+                           days_old=rng.randint(0, 90), now=datetime.now())
+        for rule, compiled_rule in zip(rules, compiled):
+            assert compiled_rule.matches(email) == process_rules.match_rule(email, rule)
+
+
+def test_contains_index_automaton_and_linear_scan_agree():
+    rng = random.Random(11)
+    needles = [(i, "subject", ''.join(rng.choice("abcde") for _ in range(rng.randint(1, 4)))) for i in range(100)]
+    automaton_index = ContainsIndex(needles, min_automaton_needles=1)
+    linear_index = ContainsIndex(needles, min_automaton_needles=1000)
+    for _ in range(100):
+        view = {"subject": ''.join(rng.choice("abcdef ") for _ in range(40))}
+        assert automaton_index.search(view) == linear_index.search(view)
+
+
+def test_large_rule_set_uses_automaton_and_agrees_with_interpreter():
+    rng = random.Random(5)
+    words = [f"w{i:03d}" for i in range(300)]
+    rules = [{"name": f"r{i}", "predicate": "any", "actions": {},
+              "conditions": [{"field": "subject", "predicate": rng.choice(["contains", "does_not_contain"]),
+                              "value": rng.choice(words)} for _ in range(3)]} for i in range(100)]
+    rule_set = compile_rules(rules)
+    for _ in range(100):
+        email = make_email(subject=' '.join(rng.sample(words, 10)))
+        expected = [rule["name"] for rule in rules if process_rules.match_rule(email, rule)]
+        assert [rule.name for rule in rule_set.matching_rules(email)] == expected
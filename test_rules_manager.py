@@ -0,0 +1,172 @@
+import os
+import json
+import sqlite3
+import pytest
+from pathlib import Path
+from datetime import datetime, timedelta
+from unittest.mock import patch, MagicMock
+import process_rules
+from db import init_db, store_emails, update_email_labels
+from metrics import METRICS
+from rules_manager import RulesManager, RuleValidationError, validate_rules
+
+JOBS_RULE = {
+    "name": "Jobs", "predicate": "any",
+    "conditions": [{"field": "from", "predicate": "contains", "value": "linkedin.com"}],
+    "actions": {"mark_as_read": True, "move_to_folder": "Jobs"}
+}
+LUNCH_RULE = {
+    "name": "Lunch", "predicate": "all",
+    "conditions": [{"field": "subject", "predicate": "equals", "value": "lunch"}],
+    "actions": {"mark_as_read": True}
+}
+
+
+def write_rules(path, rules, mtime):
+    path.write_text(json.dumps(rules))
+    # Distinct mtimes even when the filesystem clock is coarse
+    os.utime(path, ns=(mtime, mtime))
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(":memory:")
+    init_db(conn=conn)
+    store_emails([{"id": email_id, "sender": sender, "subject": subject, "snippet": "", "labels": ["INBOX", "UNREAD"],
+                   "internal_date": 1754827200000}
+                  for email_id, sender, subject in [("e1", "jobs@linkedin.com", "New job"),
+                                                    ("e2", "bob@example.com", "Lunch"),
+                                                    ("e3", "ann@example.com", "Notes")]], conn=conn)
+    yield conn
+    conn.close()
+
+
+@pytest.mark.parametrize("rule, message", [
+    ({"name": "r", "conditions": [{"field": "to", "predicate": "contains", "value": "x"}]}, "unknown field"),
+    ({"name": "r", "conditions": [{"field": "subject", "predicate": "starts_with", "value": "x"}]}, "unknown predicate"),
+    ({"name": "r", "conditions": [{"field": "received", "predicate": "less_than_days", "value": "soon"}]},
+     "whole number"),
+    ({"name": "r", "conditions": [{"field": "subject", "value": "x"}]}, "field, predicate and value"),
+    ({"name": "r", "predicate": "most", "conditions": []}, "'all' or 'any'"),
+    ({"name": "r", "actions": {"archive": True}}, "unknown actions"),
+    ({"name": "r", "actions": {"mark_as_read": "yes"}}, "true or false"),
+    ({"conditions": []}, "missing name"),
+])
+def test_validate_rules_rejects_bad_rules(rule, message):
+    with pytest.raises(RuleValidationError, match=message):
+        validate_rules([JOBS_RULE, rule])
+
+
+def test_validate_rules_accepts_sample_rules():
+    with open(Path(__file__).parent / "rules.JSON") as f:
+        rules = json.load(f)
+    assert validate_rules(rules) == rules
+
+
+def test_manager_raises_on_invalid_initial_file(tmp_path):
+    path = tmp_path / "rules.json"
+    path.write_text("[{")
+
+    with pytest.raises(RuleValidationError, match="Invalid JSON"):
+        RulesManager(str(path)).current()
+
+
+def test_manager_reloads_on_change_and_keeps_last_valid_rules(tmp_path):
+    path = tmp_path / "rules.json"
+    write_rules(path, [JOBS_RULE], 1_000_000_000)
+    manager = RulesManager(str(path))
+    first = manager.current()
+    compiled = first.compiled()
+
+    # Unchanged file: same object, same compiled rules, nothing re-read
+    with patch("builtins.open") as mock_open:
+        assert manager.current() is first
+    mock_open.assert_not_called()
+
+    write_rules(path, [JOBS_RULE, LUNCH_RULE], 2_000_000_000)
+    second = manager.current()
+    assert second.version != first.version
+    assert [rule.name for rule in second.compiled()] == ["Jobs", "Lunch"]
+
+    write_rules(path, [{"name": "broken", "conditions": [{"field": "to"}]}], 3_000_000_000)
+    assert manager.current() is second
+
+    # Reverting to earlier content is served from the cache
+    write_rules(path, [JOBS_RULE], 4_000_000_000)
+    assert manager.current() is first
+    assert first.compiled() is compiled
+
+
+def run_apply_rules(conn, manager):
+    service = MagicMock()
+    service.users().labels().list().execute.return_value = {'labels': [{'id': 'Label_1', 'name': 'Jobs'}]}
+    with patch("process_rules.find_matches", wraps=process_rules.find_matches) as spy:
+        process_rules.apply_rules(service, conn, manager=manager)
+    return [[rule.name for rule in call.args[1]] for call in spy.call_args_list]
+
+
+def test_apply_rules_only_evaluates_changed_rules(tmp_path, conn):
+    path = tmp_path / "rules.json"
+    write_rules(path, [JOBS_RULE], 1_000_000_000)
+    manager = RulesManager(str(path))
+
+    assert run_apply_rules(conn, manager) == [["Jobs"]]
+    version = manager.loaded.version
+    assert conn.execute("SELECT id, processed, rules_version FROM emails ORDER BY id").fetchall() == [
+        ("e1", 1, version), ("e2", 0, version), ("e3", 0, version)]
+
+    # Nothing changed: no email needs evaluating
+    assert run_apply_rules(conn, manager) == []
+
+    # A new rule is checked against the unprocessed emails on its own
+    write_rules(path, [JOBS_RULE, LUNCH_RULE], 2_000_000_000)
+    assert run_apply_rules(conn, manager) == [["Lunch"]]
+    assert conn.execute("SELECT id, processed, rules_version FROM emails ORDER BY id").fetchall() == [
+        ("e1", 1, version), ("e2", 1, manager.loaded.version), ("e3", 0, manager.loaded.version)]
+
+
+def test_apply_rules_reevaluates_date_rules_only_past_their_cutoff(tmp_path, conn):
+    start = datetime.now()
+    store_emails([{"id": "e4", "sender": "new@example.com", "subject": "Fresh", "snippet": "", "labels": ["INBOX"],
+                   "internal_date": int(start.timestamp() * 1000)}], conn=conn)
+    age_days = (start - datetime.fromtimestamp(1754827200)).days
+    path = tmp_path / "rules.json"
+    old_rule = {"name": "Old", "conditions": [{"field": "received", "predicate": "greater_than_days",
+                                               "value": age_days + 5}],
+                "actions": {"mark_as_read": True}}
+    write_rules(path, [JOBS_RULE, old_rule], 1_000_000_000)
+    manager = RulesManager(str(path))
+
+    assert run_apply_rules(conn, manager) == [["Jobs", "Old"]]
+    # Same cutoffs, nothing changed: nothing to evaluate
+    assert run_apply_rules(conn, manager) == []
+
+    # A week later e2 and e3 have crossed Old's cutoff; only they are checked, and only against Old
+    METRICS.reset()
+    with patch("rules_manager.datetime") as clock:
+        clock.now.return_value = start + timedelta(days=7)
+        assert run_apply_rules(conn, manager) == [["Old"]]
+    assert METRICS.counter('rule_evaluations', rule='Old') == 2
+    assert conn.execute("SELECT id, is_read FROM emails ORDER BY id").fetchall() == [
+        ("e1", 1), ("e2", 1), ("e3", 1), ("e4", 0)]
+
+
+def test_apply_rules_reevaluates_emails_whose_labels_changed(tmp_path, conn):
+    path = tmp_path / "rules.json"
+    starred = {"name": "Starred", "conditions": [{"field": "labels", "predicate": "contains", "value": "STARRED"}],
+               "actions": {"move_to_folder": "Jobs"}}
+    write_rules(path, [starred], 1_000_000_000)
+    manager = RulesManager(str(path))
+    assert run_apply_rules(conn, manager) == [["Starred"]]
+
+    # Re-syncing identical labels doesn't queue anything; a starred email does
+    update_email_labels([{"id": "e2", "labels": ["INBOX", "UNREAD"]}], conn)
+    assert run_apply_rules(conn, manager) == []
+    update_email_labels([{"id": "e3", "labels": ["INBOX", "UNREAD", "STARRED"]}], conn)
+    METRICS.reset()
+    assert run_apply_rules(conn, manager) == [["Starred"]]
+    assert METRICS.counter('rule_evaluations', rule='Starred') == 1
+    assert conn.execute("SELECT processed FROM emails WHERE id='e3'").fetchone() == (1,)
+
+    # The label the rule added doesn't make it run again
+    assert run_apply_rules(conn, manager) == []
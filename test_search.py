@@ -0,0 +1,126 @@
+import sqlite3
+import pytest
+import process_rules
+from db import init_db, store_emails, has_search_index, rebuild_search_index
+from rule_engine import compile_rules
+from sql_rules import rule_to_sql
+from search import search, parse_query, SearchError
+
+BASE_MS = 1754827200000
+
+
+def make_email(email_id, sender, subject, snippet="", body=None, days_old=0):
+    return {"id": email_id, "sender": sender, "subject": subject, "snippet": snippet, "body": body,
+            "labels": "INBOX,UNREAD", "internal_date": BASE_MS - days_old * 86400000}
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(":memory:")
+    init_db(conn=conn)
+    yield conn
+    conn.close()
+
+
+def result_ids(results):
+    return [result["id"] for result in results]
+
+
+def test_store_emails_keeps_index_in_sync(conn):
+    store_emails([make_email("e1", "billing@amazon.com", "Your invoice"),
+                  make_email("e2", "jobs@linkedin.com", "New jobs for you")], conn=conn)
+
+    assert result_ids(search(conn, "invoice")) == ["e1"]
+    assert result_ids(search(conn, "linkedin")) == ["e2"]
+
+    conn.execute("UPDATE emails SET subject='Refund issued' WHERE id='e1'")
+    conn.execute("UPDATE emails SET processed=1 WHERE id='e2'")
+    conn.execute("DELETE FROM emails WHERE id='e2'")
+    assert search(conn, "invoice") == []
+    assert result_ids(search(conn, "refund")) == ["e1"]
+    assert search(conn, "linkedin") == []
+
+
+def test_search_matches_substrings_fields_and_short_terms(conn):
+    store_emails([make_email("e1", "billing@amazon.com", "Payment received", days_old=2),
+                  make_email("e2", "pay@bank.com", "Statement", days_old=1),
+                  make_email("e3", "news@site.com", "Weekly digest", body="Pay day is coming")], conn=conn)
+
+    assert set(result_ids(search(conn, "pay*"))) == {"e1", "e2", "e3"}
+    assert result_ids(search(conn, "from:pay")) == ["e2"]
+    assert result_ids(search(conn, 'subject:"payment rec"')) == ["e1"]
+    # Two-letter terms are below the trigram size and fall back to LIKE, newest first
+    assert result_ids(search(conn, "ba")) == ["e2"]
+    assert result_ids(search(conn, "pay ek")) == ["e3"]
+
+
+def test_search_ranks_sender_and_subject_above_body(conn):
+    store_emails([make_email("e1", "a@x.com", "Hello", body="quarterly report attached"),
+                  make_email("e2", "b@x.com", "Quarterly report")], conn=conn)
+
+    assert result_ids(search(conn, "quarterly report")) == ["e2", "e1"]
+    assert result_ids(search(conn, "quarterly", limit=1, offset=1)) == ["e1"]
+
+
+def test_parse_query_keeps_unknown_prefixes_as_text():
+    assert parse_query('https://example.com from:Bob "two words"') == [
+        (None, "https://example.com"), ("sender", "bob"), (None, "two words")]
+
+
+def test_index_built_for_existing_rows_and_dropped_when_disabled(conn):
+    init_db(conn=conn, search_index=False)
+    assert not has_search_index(conn)
+    store_emails([make_email("e1", "a@x.com", "Old invoice")], conn=conn)
+
+    init_db(conn=conn)
+
+    assert result_ids(search(conn, "invoice")) == ["e1"]
+    rebuild_search_index(conn)
+    assert result_ids(search(conn, "invoice")) == ["e1"]
+
+
+def test_search_without_index_raises(conn):
+    init_db(conn=conn, search_index=False)
+    with pytest.raises(SearchError):
+        search(conn, "invoice")
+
+
+def test_contains_rules_use_the_index(conn):
+    where, params = rule_to_sql({"conditions": [
+        {"field": "subject", "predicate": "contains", "value": 'Say "Hi"'},
+        {"field": "from", "predicate": "does_not_contain", "value": "ab"},
+    ]}, use_index=True)
+    assert "emails_fts MATCH ?" in where and "NOT LIKE" in where
+    assert params == ['subject : "say ""hi"""', "%ab%"]
+
+    store_emails([make_email(f"e{i}", f"user{i}@{'linkedin' if i % 3 == 0 else 'example'}.com", f"Offer {i}%_off")
+                  for i in range(30)], conn=conn)
+    rules = compile_rules([
+        {"name": "Jobs", "conditions": [{"field": "from", "predicate": "contains", "value": "LinkedIn"}]},
+        {"name": "Others", "predicate": "any", "conditions": [
+            {"field": "from", "predicate": "does_not_contain", "value": "linkedin"},
+            {"field": "subject", "predicate": "contains", "value": "5%_o"}]},
+    ])
+    indexed = process_rules.find_matches_sql(conn, rules, use_index=True)
+    scanned = process_rules.find_matches_sql(conn, rules, use_index=False)
+
+    def by_id(matches):
+        return {email["id"]: [rule.name for rule in matched] for email, matched in matches}
+    assert by_id(indexed) == by_id(scanned) == by_id(process_rules.find_matches(conn, rules))
+
+
+def test_search_looks_up_the_index_instead_of_scanning(conn):
+    store_emails([make_email("needle", "rare@sender.org", "Quarterly zebra report"),
+                  make_email("other", "bob@example.com", "Lunch")], conn=conn)
+    statements = []
+    conn.set_trace_callback(statements.append)
+    results = search(conn, "zebra")
+    conn.set_trace_callback(None)
+
+    assert result_ids(results) == ["needle"]
+    # The traced statement has its parameters bound, so it can be explained as is
+    query = next(statement for statement in statements if "bm25" in statement)
+    plan = [row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN {query}")]
+    assert any(step.startswith("SCAN emails_fts VIRTUAL TABLE INDEX 0:M") for step in plan)
+    assert "SEARCH emails USING INTEGER PRIMARY KEY (rowid=?)" in plan
+    assert not any(step.startswith("SCAN emails ") or step == "SCAN emails" for step in plan)
@@ -0,0 +1,137 @@
+import random
+import sqlite3
+from datetime import datetime, timedelta
+from unittest.mock import patch, MagicMock
+import pytest
+import process_rules
+from db import init_db, store_emails, get_labels
+from rule_engine import compile_rules
+from sql_rules import rule_to_sql
+
+NOW = datetime(2025, 8, 20, 12, 0, 0)
+
+
+def make_email(email_id, sender, subject, days_old):
+    return {
+        "id": email_id,
+        "sender": sender,
+        "subject": subject,
+        "snippet": "",
+        "labels": "INBOX,UNREAD",
+        "internal_date": int((NOW - timedelta(days=days_old, hours=6)).timestamp() * 1000)
+    }
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(":memory:")
+    init_db(conn=conn)
+    yield conn
+    conn.close()
+
+
+def matched_ids(matches):
+    return {email["id"]: [rule.name for rule in rules] for email, rules in matches}
+
+
+def test_rule_to_sql_builds_where_clause():
+    where, params = rule_to_sql({"predicate": "any", "conditions": [
+        {"field": "from", "predicate": "contains", "value": "LinkedIn"},
+        {"field": "received", "predicate": "greater_than_days", "value": 30},
+    ]}, now=NOW)
+    assert " OR " in where
+    assert "sender" in where and "internal_date < ?" in where
+    assert params == ["%linkedin%", int(datetime(2025, 7, 21, 12, 0, 0).timestamp() * 1000)]
+
+
+def test_rule_to_sql_escapes_like_wildcards(conn):
+    store_emails([make_email("e1", "a@x.com", "100% off", 1), make_email("e2", "a@x.com", "1000 off", 1)], conn=conn)
+    where, params = rule_to_sql({"conditions": [{"field": "subject", "predicate": "contains", "value": "0%"}]})
+    rows = conn.execute(f"SELECT id FROM emails WHERE {where}", params).fetchall()
+    assert rows == [("e1",)]
+
+
+def test_rule_to_sql_falls_back_for_non_ascii_values():
+    assert rule_to_sql({"conditions": [{"field": "subject", "predicate": "contains", "value": "Ünïcode"}]}) is None
+
+
+def test_sql_and_python_evaluation_agree(conn):
+    rng = random.Random(1)
+    words = ["job", "sale", "offer", "hiring", "linkedin.com", "ajio.in", "Ünïcode", "50%_off"]
+    emails = [make_email(f"e{i}", f"x@{rng.choice(words)}", ' '.join(rng.sample(words, 3)), rng.randint(0, 60))
+              for i in range(300)]
+    store_emails(emails, conn=conn)
+    rules = compile_rules([
+        {"name": f"r{i}", "predicate": rng.choice(["all", "any"]), "actions": {},
+         "conditions": [{"field": rng.choice(["from", "subject", "received"]),
+                         "predicate": rng.choice(["contains", "does_not_contain", "equals", "does_not_equal"]),
+                         "value": rng.choice(words)} if rng.random() < 0.7 else
+                        {"field": "received", "predicate": rng.choice(["less_than_days", "greater_than_days"]),
+                         "value": rng.randint(1, 60)} for _ in range(rng.randint(1, 3))]}
+        for i in range(40)
+    ], now=NOW)
+
+    python_matches = matched_ids(process_rules.find_matches(conn, rules))
+    sql_matches = matched_ids(process_rules.find_matches_sql(conn, rules, now=NOW))
+
+    assert sql_matches == python_matches
+
+
+@patch("process_rules.load_rules")
+def test_apply_rules_sql_mode_updates_rows_in_bulk(mock_load_rules, conn):
+    store_emails([make_email("e1", "jobs@linkedin.com", "New job", 1),
+                  make_email("e2", "bob@example.com", "Lunch", 1)], conn=conn)
+    mock_load_rules.return_value = [{
+        "name": "Jobs", "predicate": "any",
+        "conditions": [{"field": "from", "predicate": "contains", "value": "linkedin.com"}],
+        "actions": {"mark_as_read": True, "move_to_folder": "Jobs"}
+    }]
+    service = MagicMock()
+    service.users().labels().list().execute.return_value = {'labels': [{'id': 'Label_1', 'name': 'jobs'}]}
+
+    process_rules.apply_rules(service, conn, use_sql=True)
+
+    service.users().messages().batchModify.assert_called_once_with(
+        userId='me', body={"ids": ["e1"], "removeLabelIds": ["UNREAD"], "addLabelIds": ["Label_1"]})
+    rows = conn.execute("SELECT id, is_read, processed FROM emails ORDER BY id").fetchall()
+    assert rows == [("e1", 1, 1), ("e2", 0, 0)]
+    assert get_labels(conn, "e1") == ["INBOX", "Label_1"]
+    assert get_labels(conn, "e2") == ["INBOX", "UNREAD"]
+
+
+def test_body_rules_agree_between_sql_and_python(conn):
+    with_body = dict(make_email("e1", "a@x.com", "Hi", 1), body="Your Invoice is attached")
+    store_emails([with_body, make_email("e2", "b@x.com", "Hi", 1)], conn=conn)
+    rules = compile_rules([{"name": "Invoices", "predicate": "all", "actions": {},
+                            "conditions": [{"field": "body", "predicate": "contains", "value": "invoice"}]}], now=NOW)
+
+    assert matched_ids(process_rules.find_matches_sql(conn, rules, now=NOW)) == {"e1": ["Invoices"]}
+    assert matched_ids(process_rules.find_matches(conn, rules)) == {"e1": ["Invoices"]}
+
+
+def test_label_rules_run_in_sql_and_agree_with_python(conn):
+    store_emails([dict(make_email("e1", "a@x.com", "Hi", 1), labels="INBOX,UNREAD,STARRED"),
+                  dict(make_email("e2", "b@x.com", "Hi", 1), labels="INBOX,UNREAD,Label_7"),
+                  dict(make_email("e3", "c@x.com", "Hi", 1), labels="INBOX,UNREAD")], conn=conn)
+    raw_rules = [{"name": f"{predicate} {value}", "predicate": "all", "actions": {},
+                  "conditions": [{"field": "labels", "predicate": predicate, "value": value}]}
+                 for predicate in ("contains", "does_not_contain", "equals", "does_not_equal")
+                 for value in ("starred", "Label_7", "label_", "box")]
+
+    assert all(rule_to_sql(rule, now=NOW) is not None for rule in raw_rules)
+    rules = compile_rules(raw_rules, now=NOW)
+    sql_matches = matched_ids(process_rules.find_matches_sql(conn, rules, now=NOW))
+    assert sql_matches == matched_ids(process_rules.find_matches(conn, rules))
+    assert sql_matches["e1"][:2] == ["contains starred", "contains box"]
+    # equals compares whole labels, case-insensitively
+    assert "equals Label_7" in sql_matches["e2"] and "equals label_" not in sql_matches["e2"]
+
+
+def test_label_conditions_look_labels_up_by_primary_key(conn):
+    where, params = rule_to_sql({"conditions": [{"field": "labels", "predicate": "equals", "value": "STARRED"}]},
+                                now=NOW)
+    plan = ' '.join(row[-1] for row in conn.execute(
+        f"EXPLAIN QUERY PLAN SELECT id FROM emails WHERE {where}", params))
+
+    assert "SEARCH email_labels USING PRIMARY KEY (email_id=?)" in plan
+    assert "SCAN email_labels" not in plan
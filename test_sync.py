@@ -0,0 +1,96 @@
+import sqlite3
+import httplib2
+import pytest
+from unittest.mock import patch, MagicMock
+from googleapiclient.errors import HttpError
+from db import init_db, store_emails, get_sync_state, set_sync_state, get_labels
+import sync
+
+
+def make_email(email_id, labels="INBOX,UNREAD"):
+    return {
+        "id": email_id,
+        "sender": "alice@example.com",
+        "subject": "Hello",
+        "snippet": "Hi there!",
+        "labels": labels,
+        "internal_date": 1754827200000
+    }
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(":memory:")
+    init_db(conn=conn)
+    yield conn
+    conn.close()
+
+
+def test_sync_mailbox_runs_full_sync_without_history_id(conn):
+    service = MagicMock()
+    service.users().getProfile().execute.return_value = {'historyId': '100'}
+
+    with patch("sync.iter_inbox_emails", return_value=iter([make_email("e1"), make_email("e2")])):
+        count = sync.sync_mailbox(service, conn)
+
+    assert count == 2
+    assert get_sync_state(conn, sync.HISTORY_ID_KEY) == '100'
+
+
+def test_sync_mailbox_fetches_only_history_changes(conn):
+    store_emails([make_email("e1")], conn=conn)
+    set_sync_state(conn, sync.HISTORY_ID_KEY, '100')
+
+    service = MagicMock()
+    service.users().history().list().execute.side_effect = [
+        {'history': [{'messagesAdded': [{'message': {'id': 'e2'}}]}], 'nextPageToken': 'p2', 'historyId': '110'},
+        {'history': [{'labelsRemoved': [{'message': {'id': 'e1'}}]}], 'historyId': '120'},
+    ]
+    fetched = [make_email("e2"), make_email("e1", labels="INBOX")]
+
+    with patch("sync.fetch_messages", return_value=fetched) as mock_fetch, \
+            patch("sync.iter_inbox_emails") as mock_full:
+        count = sync.sync_mailbox(service, conn)
+
+    mock_full.assert_not_called()
+    assert mock_fetch.call_args[0][1] == ['e2', 'e1']
+    assert count == 1
+    assert get_labels(conn, "e1") == ["INBOX"]
+    assert get_sync_state(conn, sync.HISTORY_ID_KEY) == '120'
+
+
+def test_sync_mailbox_falls_back_to_full_sync_when_history_expired(conn):
+    set_sync_state(conn, sync.HISTORY_ID_KEY, '1')
+
+    service = MagicMock()
+    service.users().history().list().execute.side_effect = HttpError(httplib2.Response({'status': 404}), b'')
+    service.users().getProfile().execute.return_value = {'historyId': '500'}
+
+    with patch("sync.iter_inbox_emails", return_value=iter([make_email("e1")])) as mock_full:
+        count = sync.sync_mailbox(service, conn)
+
+    mock_full.assert_called_once()
+    assert count == 1
+    assert get_sync_state(conn, sync.HISTORY_ID_KEY) == '500'
+
+
+def test_incremental_sync_fetches_one_chunk_at_a_time():
+    service = MagicMock()
+    service.users().history().list().execute.return_value = {
+        'history': [{'messagesAdded': [{'message': {'id': f'e{i}'}} for i in range(5)]}], 'historyId': '120'}
+    fetched = []
+
+    def fake_fetch(service, message_ids, **kwargs):
+        fetched.append(list(message_ids))
+        return [make_email(message_id) for message_id in message_ids]
+
+    with patch("sync.fetch_messages", side_effect=fake_fetch):
+        events = sync.iter_incremental_sync(service, '100', chunk_size=2)
+        kind, chunk = next(events)
+        # Only the first chunk has been fetched when it is handed over
+        assert fetched == [['e0', 'e1']]
+        rest = list(events)
+
+    assert kind == sync.CHANGED_EMAILS and [e['id'] for e in chunk] == ['e0', 'e1']
+    assert fetched == [['e0', 'e1'], ['e2', 'e3'], ['e4']]
+    assert rest[-1] == (sync.HISTORY_ID, '120')
@@ -0,0 +1,93 @@
+import sqlite3
+import pytest
+from unittest.mock import MagicMock
+from db import init_db, store_emails, get_labels
+from unit_of_work import UnitOfWork, PendingAction, recover_pending
+
+
+class Crash(BaseException):
+    pass
+
+
+class CountingConnection:
+    # sqlite3.Connection.commit can't be patched, so wrap the connection instead
+    def __init__(self, conn):
+        self.conn = conn
+        self.commits = 0
+
+    def commit(self):
+        self.commits += 1
+        self.conn.commit()
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(":memory:")
+    init_db(conn=conn)
+    store_emails([{"id": f"e{i}", "sender": "a@x.com", "subject": "s", "snippet": "", "labels": ["INBOX", "UNREAD"],
+                   "internal_date": 0} for i in range(10)], conn=conn)
+    yield conn
+    conn.close()
+
+
+def make_action(email_id):
+    return PendingAction(email_id, ("Label_1",), ("UNREAD",), 1)
+
+
+def count(conn, sql):
+    return conn.execute(sql).fetchone()[0]
+
+
+def test_unit_of_work_commits_once_per_batch_stage(conn):
+    counting = CountingConnection(conn)
+    service = MagicMock()
+
+    with UnitOfWork(service, counting, batch_size=4) as uow:
+        for i in range(10):
+            uow.add(make_action(f"e{i}"))
+
+    # Three batches (4, 4, 2), each journaled and then committed
+    assert counting.commits == 6
+    assert service.users().messages().batchModify.call_count == 3
+    assert count(conn, "SELECT COUNT(*) FROM emails WHERE processed=1 AND is_read=1") == 10
+    assert count(conn, "SELECT COUNT(*) FROM action_journal") == 0
+    assert get_labels(conn, "e0") == ["INBOX", "Label_1"]
+
+
+def test_crash_leaves_journal_and_recovery_replays_it(conn):
+    crashing = MagicMock()
+    crashing.users().messages().batchModify().execute.side_effect = Crash()
+
+    with pytest.raises(Crash):
+        with UnitOfWork(crashing, conn, batch_size=5) as uow:
+            for i in range(10):
+                uow.add(make_action(f"e{i}"))
+
+    # The first batch was journaled but never committed as processed
+    assert count(conn, "SELECT COUNT(*) FROM action_journal") == 5
+    assert count(conn, "SELECT COUNT(*) FROM emails WHERE processed=1") == 0
+
+    service = MagicMock()
+    assert recover_pending(service, conn) == 5
+
+    service.users().messages().batchModify.assert_called_once_with(
+        userId='me', body={"ids": [f"e{i}" for i in range(5)], "removeLabelIds": ["UNREAD"], "addLabelIds": ["Label_1"]})
+    assert count(conn, "SELECT COUNT(*) FROM action_journal") == 0
+    assert count(conn, "SELECT COUNT(*) FROM emails WHERE processed=1") == 5
+    # Nothing left to replay
+    assert recover_pending(service, conn) == 0
+
+
+def test_failed_batch_modify_is_not_committed(conn):
+    service = MagicMock()
+    service.users().messages().batchModify().execute.side_effect = Exception("backend error")
+
+    with UnitOfWork(service, conn) as uow:
+        uow.add(make_action("e0"))
+
+    assert uow.applied_count == 0
+    assert count(conn, "SELECT processed FROM emails WHERE id='e0'") == 0
+    assert count(conn, "SELECT COUNT(*) FROM action_journal") == 0
@@ -0,0 +1,141 @@
+import json
+import logging
+from collections import namedtuple
+from db import refresh_fingerprints
+from label_registry import is_missing_label_error
+from metrics import METRICS, record_request
+from config import GMAIL_BATCH_MODIFY_LIMIT, APPLY_BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+# One email's net change: Gmail label ids to add/remove and the resulting read
+# flag. email_labels stores the same ids, as sync does, so the next sync echoing
+# the change back from Gmail leaves the stored labels (and fingerprint) as they are.
+PendingAction = namedtuple('PendingAction', 'email_id add_ids remove_ids is_read')
+
+
+def batch_modify(service, message_ids, add_labels, remove_labels, chunk_size=GMAIL_BATCH_MODIFY_LIMIT, registry=None):
+    # Returns the ids whose batchModify call succeeded
+    succeeded = []
+    for start in range(0, len(message_ids), chunk_size):
+        chunk = message_ids[start:start + chunk_size]
+        record_request('messages.batchModify')
+        try:
+            service.users().messages().batchModify(
+                userId='me',
+                body={
+                    "ids": chunk,
+                    "removeLabelIds": list(remove_labels),
+                    "addLabelIds": list(add_labels)
+                }
+            ).execute()
+            succeeded.extend(chunk)
+        except Exception as e:
+            METRICS.inc('api_errors', method='messages.batchModify')
+            logger.error(f"batchModify failed for {len(chunk)} emails: {e}")
+            if registry is not None and is_missing_label_error(e):
+                # A cached label id no longer exists; re-list labels next time
+                registry.invalidate()
+    return succeeded
+
+
+def _row_to_action(row):
+    email_id, add_ids, remove_ids, is_read = row
+    return PendingAction(email_id, tuple(json.loads(add_ids)), tuple(json.loads(remove_ids)), is_read)
+
+
+class UnitOfWork:
+    # Buffers per-email actions and flushes them in batches:
+    #   1. the batch is written to action_journal and committed,
+    #   2. Gmail is updated with one batchModify per label-change signature,
+    #   3. the DB updates for the calls that succeeded and the removal of the
+    #      batch's journal rows are committed together.
+    # A crash between 1 and 3 leaves the journal rows behind; batchModify is
+    # idempotent, so recover_pending can simply replay them.
+    def __init__(self, service, conn, registry=None, batch_size=APPLY_BATCH_SIZE, rules_version=None):
+        self.service = service
+        # Rule-set version recorded on the emails this unit of work processes
+        self.rules_version = rules_version
+        self.conn = conn
+        self.registry = registry
+        self.batch_size = batch_size
+        self.pending = []
+        self.applied_count = 0
+        self.group_count = 0
+
+    def add(self, action):
+        self.pending.append(action)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def _journal(self, batch):
+        self.conn.executemany("""
+            INSERT INTO action_journal (email_id, add_ids, remove_ids, is_read)
+            VALUES (?, ?, ?, ?)
+        """, [(a.email_id, json.dumps(list(a.add_ids)), json.dumps(list(a.remove_ids)), a.is_read)
+              for a in batch])
+        self.conn.commit()
+
+    def _execute(self, batch):
+        groups = {}
+        for action in batch:
+            groups.setdefault((action.add_ids, action.remove_ids), []).append(action.email_id)
+        applied = set()
+        for (add_ids, remove_ids), message_ids in groups.items():
+            if add_ids or remove_ids:
+                applied.update(batch_modify(self.service, message_ids, add_ids, remove_ids, registry=self.registry))
+            else:
+                applied.update(message_ids)
+        self.group_count += len(groups)
+        return applied
+
+    def _commit(self, batch, applied):
+        done = [a for a in batch if a.email_id in applied]
+        # Failed actions are dropped from the journal too: their emails stay
+        # unprocessed and are evaluated again on the next run.
+        self.conn.executemany("INSERT OR IGNORE INTO email_labels (email_id, label) VALUES (?, ?)",
+                              [(a.email_id, label) for a in done for label in a.add_ids])
+        self.conn.executemany("DELETE FROM email_labels WHERE email_id=? AND label=?",
+                              [(a.email_id, label) for a in done for label in a.remove_ids])
+        # The rules have now seen the email in its post-action state
+        refresh_fingerprints(self.conn, [a.email_id for a in done])
+        self.conn.executemany("UPDATE emails SET is_read=?, processed=1, rules_version=coalesce(?, rules_version), "
+                              "evaluated_fingerprint=fingerprint WHERE id=?",
+                              [(a.is_read, self.rules_version, a.email_id) for a in done])
+        self.conn.executemany("DELETE FROM action_journal WHERE email_id=?", [(a.email_id,) for a in batch])
+        self.conn.commit()
+        METRICS.inc('db_rows', len(done), table='emails', op='update')
+        self.applied_count += len(done)
+
+    def flush(self):
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        self._journal(batch)
+        self._commit(batch, self._execute(batch))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # On error the unflushed actions were never journaled or sent, so
+        # their emails simply stay unprocessed.
+        if exc_type is None:
+            self.flush()
+
+
+def recover_pending(service, conn, registry=None, batch_size=APPLY_BATCH_SIZE):
+    rows = conn.execute("""
+        SELECT email_id, add_ids, remove_ids, is_read
+        FROM action_journal ORDER BY seq
+    """).fetchall()
+    if not rows:
+        return 0
+    logger.warning(f"Replaying {len(rows)} journaled actions from an interrupted run...")
+    actions = [_row_to_action(row) for row in rows]
+    uow = UnitOfWork(service, conn, registry, batch_size)
+    for start in range(0, len(actions), batch_size):
+        batch = actions[start:start + batch_size]
+        # The batch is already journaled; only steps 2 and 3 are replayed
+        uow._commit(batch, uow._execute(batch))
+    return uow.applied_count